@@ -1,39 +1,32 @@
 import socket
-import struct
 import threading
 import time
 
+import discovery
+import protocol
+import receiver
+import socketTuning
+
 
-MAGIC_COOKIE = 0xabcddcba
-OFFER_TYPE = 0x2
 BUFFER_SIZE = 1024
 
 def receive_offers():
-    """Listen for UDP offers from servers."""
-    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as udp_socket:
-        udp_socket.bind(("", 37020))
-        while True:
-            data, server = udp_socket.recvfrom(1024)
-            cookie, message_type, udp_port, tcp_port = struct.unpack('>IBHH', data)
-            if cookie == MAGIC_COOKIE and message_type == OFFER_TYPE:
-                print(f"Received offer from {server[0]} on TCP port {tcp_port}")
-                perform_tcp_test(server[0], tcp_port)
+    """Listen for UDP offers from servers and test the one with the lowest RTT."""
+    with discovery.Discovery(37020) as servers:
+        best, _ = servers.choose()
+    print(f"Received offer from {best.address} on TCP port {best.tcp_port}")
+    perform_tcp_test(best.address, best.tcp_port)
 
 def perform_tcp_test(server_ip, tcp_port):
     """Perform a TCP test by requesting data."""
     file_size = int(input("Enter the file size in bytes: "))
-    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as tcp_socket:
-        tcp_socket.connect((server_ip, tcp_port))
-        tcp_socket.sendall(f"{file_size}\n".encode())
-        received_data = 0
+    with socketTuning.connect_tcp((server_ip, tcp_port)) as tcp_socket:
+        tcp_socket.sendall(protocol.encode_request(file_size))
         start_time = time.time()
-        while received_data < file_size:
-            data = tcp_socket.recv(BUFFER_SIZE)
-            if not data:
-                break
-            received_data += len(data)
+        receiver.receive_stream(tcp_socket, file_size)
         end_time = time.time()
         print(f"TCP transfer completed in {end_time - start_time:.2f} seconds.")
+        print(f"TCP socket: {socketTuning.describe(tcp_socket)}")
 
 
 def get_user_input():
@@ -49,8 +42,7 @@ def get_user_input():
 
 def send_tcp_request(server_ip, server_tcp_port, file_size):
     try:
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as tcp_socket:
-            tcp_socket.connect((server_ip, server_tcp_port))
+        with socketTuning.connect_tcp((server_ip, server_tcp_port)) as tcp_socket:
             tcp_socket.sendall(f"{file_size}\n".encode())
             print(f"TCP request sent to {server_ip}:{server_tcp_port} for file size {file_size} bytes")
     except Exception as e:
@@ -59,7 +51,7 @@ def send_tcp_request(server_ip, server_tcp_port, file_size):
 
 def send_udp_request(server_ip, server_udp_port, file_size):
     try:
-        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as udp_socket:
+        with socketTuning.tune_udp(socket.socket(socket.AF_INET, socket.SOCK_DGRAM)) as udp_socket:
             message = f"{file_size}".encode()
             udp_socket.sendto(message, (server_ip, server_udp_port))
             print(f"UDP request sent to {server_ip}:{server_udp_port} for file size {file_size} bytes")
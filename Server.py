@@ -1,16 +1,27 @@
 import socket
-import struct
 import threading
 import time
 
+import eventLog
+import intervalReport
+import payloadSource
+import protocol
+import receiver
+import socketTuning
+import tcpSender
+import udpSender
+from payloadSource import PayloadSource
+from protocol import MAGIC_COOKIE, OFFER_TYPE
+from segmentTracker import SegmentTracker
+
 
-MAGIC_COOKIE = 0xabcddcba
-OFFER_TYPE = 0x2
-REQUEST_TYPE = 0x3
-PAYLOAD_TYPE = 0x4
 SERVER_TCP_PORT = 4000
 SERVER_UDP_PORT = 3000
 BUFFER_SIZE = 1024
+TCP_CHUNK_SIZE = tcpSender.DEFAULT_CHUNK_SIZE
+UDP_PAYLOAD = PayloadSource(2 ** 63 - 1, fill=b'B')
+
+log = eventLog.get_logger("Server")
 
 def start_server(tcp_port, udp_port):
     tcp_thread = threading.Thread(target=start_tcp_server, args=(tcp_port,))
@@ -25,76 +36,76 @@ def broadcast_offers():
     """Broadcast UDP offer messages to clients."""
     with socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP) as udp_socket:
         udp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
-        message = build_message(OFFER_TYPE, f"{SERVER_UDP_PORT} {SERVER_TCP_PORT}")
+        message = protocol.encode_offer(SERVER_UDP_PORT, SERVER_TCP_PORT)
         while True:
             udp_socket.sendto(message, ('<broadcast>', 37020))
-            print_in_color("Broadcast offer message sent.", color='yellow')
+            log.debug("Broadcast offer message sent.")
             time.sleep(1)
 
 
 def start_tcp_server(ip_server, server_port):
     """TCP server to handle incoming connections and send data."""
     with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as tcp_socket:
+        socketTuning.tune_tcp(tcp_socket)
         tcp_socket.bind(("", SERVER_TCP_PORT))
         tcp_socket.listen()
         while True:
             client_conn, client_addr = tcp_socket.accept()
-            print_in_color(f"DBG: Server listening on {ip_server}:{server_port}", color="green") #לשנות
+            log.debug("Accepted %s on %s:%s", client_addr, ip_server, server_port)
             threading.Thread(target=handle_tcp_client, args=(client_conn, client_addr)).start()
 
 
-def handle_tcp_client(client_socket, address):
+def handle_tcp_client(client_socket, address, chunk_size=TCP_CHUNK_SIZE):
     try:
-        data = client_socket.recv(1024).decode().strip()
-        if data:
-            file_size = int(data)
-            print(f"TCP request for {file_size} bytes from {address}")
-            sent = 0
-            while sent < file_size:
-                to_send = min(1024, file_size - sent)
-                client_socket.send(b'A' * to_send)
-                sent += to_send
+        socketTuning.tune_tcp(client_socket)
+        request = protocol.parse_request(client_socket.recv(1024))
+        if request is not None:
+            file_size = request.file_size
+            log.info("TCP request for %d bytes from %s", file_size, address)
+            sent, elapsed = tcpSender.send_stream(client_socket, file_size,
+                                                  tcpSender.payload_for(request, chunk_size=chunk_size))
+            log.info("TCP sent %s to %s; socket: %s", tcpSender.format_rate(sent, elapsed), address,
+                     socketTuning.describe(client_socket))
     except Exception as e:
-        print(f"Error handling TCP client {address}: {e}")
+        log.error("Error handling TCP client %s: %s", address, e)
     finally:
         client_socket.close()
-        print(f"TCP connection closed with {address}")
+        log.debug("TCP connection closed with %s", address)
 
 def handle_udp_client(server_socket, buffer_size, timeout=1):
     server_socket.settimeout(timeout)
     try:
         while True:
             data, address = server_socket.recvfrom(buffer_size)
-            file_size = int(data.decode().strip())
-            print(f"UDP request for {file_size} bytes from {address}")
-            segments = (file_size + buffer_size - 1) // buffer_size
-            for i in range(segments):
-                payload = b'B' * min(buffer_size, file_size - (i * buffer_size))
-                server_socket.sendto(payload, address)
-            print(f"All UDP packets sent to {address}")
+            request = protocol.parse_request(data)
+            if request is None:
+                continue
+            if not request.segment_size:
+                request = request._replace(segment_size=buffer_size)
+            log.info("UDP request for %d bytes from %s", request.file_size, address)
+            segment_size, sent, _, _ = udpSender.send_response(server_socket, address,
+                                                              payloadSource.for_request(request, UDP_PAYLOAD), request)
+            log.info("All %d UDP packets (%d bytes each) sent to %s", sent, segment_size, address)
     except socket.timeout:
-        print("UDP listen timed out - no data received for 1 second")
+        log.info("UDP listen timed out - no data received for %s seconds", timeout)
     finally:
-        print("UDP server socket closed")
+        log.info("UDP server socket closed")
 
 def start_udp_server(udp_port):
     with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as server_socket:
+        socketTuning.tune_udp(server_socket)
         server_socket.bind(('', udp_port))
-        print(f"UDP Server is listening on port {udp_port}")
+        log.info("UDP Server is listening on port %d", udp_port)
         handle_udp_client(server_socket, 1024)
 
 def send_payload(sock, addr, file_size):
-    segments = (file_size + 1023) // 1024
-    for i in range(segments):
-        payload = b'A' * min(1024, file_size - (i * 1024))
-        packet = struct.pack('>IBQQ', MAGIC_COOKIE, PAYLOAD_TYPE, segments, i + 1) + payload
-        sock.sendto(packet, addr)
-        print(f"Sent segment {i + 1}/{segments}to{addr}")
+    sent, elapsed = udpSender.send_segments(sock, addr, PayloadSource(file_size, fill=b'A'), BUFFER_SIZE)
+    log.info("Sent %d segments to %s in %.2fs", sent, addr, elapsed)
 
 
 def build_message(message_type, content=''):
     """Builds a formatted UDP message."""
-    return struct.pack('>IB', MAGIC_COOKIE, message_type) + content.encode()
+    return protocol.PREFIX.pack(MAGIC_COOKIE, message_type) + content.encode()
 
 
 def send_udp_message(host, port, message, segment_size=512):
@@ -107,6 +118,9 @@ def send_udp_message(host, port, message, segment_size=512):
     :param segment_size: The size of each UDP payload segment.
     """
     message_type = 0x3  # Assuming a predefined message type for simplicity.
+    trace = eventLog.Sampler(log)
+    if not trace.enabled:
+        trace = None
     with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
         total_length = len(message)
         total_segments = (total_length + segment_size - 1) // segment_size  # Calculate how many segments are needed
@@ -116,24 +130,23 @@ def send_udp_message(host, port, message, segment_size=512):
             segment_content = message[start_index:end_index]
             message_packet = build_message(message_type, segment_content)
             sock.sendto(message_packet, (host, port))
-            print(f"Message segment {segment_number + 1}/{total_segments} sent to{host}:{port}")
+            if trace is not None:
+                trace.event("Message segment %d/%d sent to %s:%s", segment_number + 1, total_segments, host, port)
 
 
 def parse_offer_message(data):
     """Parse an offer message."""
-    try:
-        format = '>IBHH'  # Big-endian: 4 bytes, 1 byte, 2 bytes, 2 bytes
-        magic_cookie, msg_type, udp_port, tcp_port = struct.unpack(format, data)
-        if magic_cookie != 0xabcddcba or msg_type != 0x2:
-            raise ValueError("Invalid offer message")
-        return {
-            "magic_cookie": magic_cookie,
-            "msg_type": msg_type,
-            "udp_port": udp_port,
-            "tcp_port": tcp_port
-        }
-    except struct.error:
+    if len(data) != protocol.OFFER.size:
         raise ValueError("Malformed offer message")
+    offer = protocol.decode_offer(data)
+    if offer is None:
+        raise ValueError("Invalid offer message")
+    return {
+        "magic_cookie": MAGIC_COOKIE,
+        "msg_type": OFFER_TYPE,
+        "udp_port": offer.udp_port,
+        "tcp_port": offer.tcp_port
+    }
 
 
 def print_in_color(message, color):
@@ -142,62 +155,85 @@ def print_in_color(message, color):
 
 
 
-def tcp_transfer(server_ip, server_tcp_port, file_size, transfer_id):
+def tcp_transfer(server_ip, server_tcp_port, file_size, transfer_id, counters=None):
     try:
         start_time = time.time()
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as tcp_socket:
-            tcp_socket.connect((server_ip, server_tcp_port))
-            tcp_socket.sendall(f"{file_size}\n".encode())
+        with socketTuning.connect_tcp((server_ip, server_tcp_port)) as tcp_socket:
+            tcp_socket.sendall(protocol.encode_request(file_size))
 
-            received_data = b''
-            while len(received_data) < file_size:
-                data = tcp_socket.recv(1024)
-                if not data:
-                    break
-                received_data += data
+            received = receiver.receive_stream(tcp_socket, file_size, counters=counters)
+            if counters is not None:
+                counters.done = True
 
             end_time = time.time()
             transfer_time = end_time - start_time
-            speed = (len(received_data) * 8) / transfer_time  # speed in bits/second
+            speed = (received * 8) / transfer_time  # speed in bits/second
 
             print(f"TCP transfer #{transfer_id} finished, total time: {transfer_time:.2f} seconds, total speed: {speed:.2f} bits/second")
+            print(f"TCP transfer #{transfer_id} socket: {socketTuning.describe(tcp_socket)}")
 
     except Exception as e:
         print(f"Error during TCP transfer #{transfer_id}: {e}")
 
-def udp_transfer(server_ip, server_udp_port, file_size, transfer_id):
+def udp_transfer(server_ip, server_udp_port, file_size, transfer_id, segment_size=BUFFER_SIZE, counters=None):
     try:
         start_time = time.time()
-        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as udp_socket:
-            udp_socket.sendto(f"{file_size}".encode(), (server_ip, server_udp_port))
+        with socketTuning.tune_udp(socket.socket(socket.AF_INET, socket.SOCK_DGRAM)) as udp_socket:
+            # The server never sends segments larger than requested, so size everything from the request
+            segment_size = udpSender.clamp_segment_size(segment_size)
+            udp_socket.sendto(protocol.encode_request(file_size, 0, segment_size), (server_ip, server_udp_port))
 
             received_size = 0
-            expected_packets = (file_size + 1023) // 1024
-            received_packets = 0
+            expected_packets = (file_size + segment_size - 1) // segment_size
+            tracker = None
+            buffer = receiver.allocate_buffer(protocol.PAYLOAD_HEADER_SIZE + segment_size)
 
             while received_size < file_size:
                 udp_socket.settimeout(1.5)  # Set a timeout longer than the server's send interval
                 try:
-                    data, _ = udp_socket.recvfrom(1024)
-                    received_packets += 1
-                    received_size += len(data)
+                    data, _ = receiver.receive_datagram(udp_socket, buffer)
+                    header = protocol.decode_payload_header(data)
+                    if header is None:
+                        continue
+                    if tracker is None:
+                        tracker = SegmentTracker(header[0])
+                        expected_packets = header[0]
+                        if counters is not None:
+                            counters.tracker = tracker
+                    if tracker.add(header[1]):
+                        received_size += len(data) - protocol.PAYLOAD_HEADER_SIZE
+                    if counters is not None:
+                        counters.bytes += len(data) - protocol.PAYLOAD_HEADER_SIZE
+                        counters.packets += 1
+                        counters.arrival(header[2], protocol.timestamp())
                 except socket.timeout:
                     break  # Break the loop if no data received for 1 second
+            if counters is not None:
+                counters.done = True
 
             end_time = time.time()
             transfer_time = end_time - start_time
             speed = (received_size * 8) / transfer_time  # speed in bits/second
+            received_packets = tracker.received if tracker else 0
             success_rate = (received_packets / expected_packets) * 100 if expected_packets > 0 else 100
 
             print(f"UDP transfer #{transfer_id} finished, total time: {transfer_time:.2f} seconds, total speed: {speed:.2f} bits/second, percentage of packets received successfully: {success_rate:.2f}%")
+            print(f"UDP transfer #{transfer_id} socket: {socketTuning.describe(udp_socket)}")
 
     except Exception as e:
         print(f"Error during UDP transfer #{transfer_id}: {e}")
 
-def start_transfers(server_ip, server_tcp_port, server_udp_port, file_size):
-    tcp_thread = threading.Thread(target=tcp_transfer, args=(server_ip, server_tcp_port, file_size, 1))
-    udp_thread = threading.Thread(target=udp_transfer, args=(server_ip, server_udp_port, file_size, 2))
+def start_transfers(server_ip, server_tcp_port, server_udp_port, file_size, interval=intervalReport.DEFAULT_INTERVAL):
+    reporter = intervalReport.IntervalReporter(interval) if interval else None
+    tcp_counters = reporter.add("TCP-1") if reporter else None
+    udp_counters = reporter.add("UDP-2") if reporter else None
+    tcp_thread = threading.Thread(target=tcp_transfer, args=(server_ip, server_tcp_port, file_size, 1, tcp_counters))
+    udp_thread = threading.Thread(target=udp_transfer, args=(server_ip, server_udp_port, file_size, 2, BUFFER_SIZE, udp_counters))
+    if reporter:
+        reporter.start()
     tcp_thread.start()
     udp_thread.start()
     tcp_thread.join()
     udp_thread.join()
+    if reporter:
+        reporter.stop()
@@ -0,0 +1,306 @@
+"""
+Admission control and fair bandwidth sharing for the servers.
+
+An Admission caps the sessions a server runs at once. A TCP session over the
+cap waits in a bounded FIFO queue, holding its connection open, until a
+running session finishes; UDP sessions are never queued. A session that
+finds the queue full, or waits longer than queue_timeout, gets a busy
+message with a retry-after hint instead.
+
+Every admitted session also gets a Share of the server's egress capacity.
+Capacity is divided max-min fairly between clients (by address), then
+between each client's sessions, so a client gets no more by opening more
+connections or asking for an unpaced stream; UDP sessions that asked for a
+bitrate below their share leave the rest to the others. Shares are
+recomputed whenever a session starts or ends.
+
+Clients go through connect_when_admitted() and request_when_admitted(),
+which back off and retry as long as the server answers busy.
+"""
+import asyncio
+import collections
+import contextlib
+import math
+import socket
+import threading
+import time
+
+import eventLog
+import pacer
+import protocol
+import socketTuning
+import workerPool
+
+DEFAULT_MAX_QUEUED = 64
+DEFAULT_QUEUE_TIMEOUT = 10
+RETRY_AFTER = 1.0  # seconds, scaled up by how long the queue is
+REPORT_INTERVAL = 5
+BUSY_RETRIES = 5  # times a client retries a server that turned it away
+ANSWER_WAIT = 1  # seconds a UDP client waits for the first answer to its request
+
+log = eventLog.get_logger("admission")
+
+
+def max_min(capacity, demands):
+    """Split capacity max-min fairly across demands (0 for unlimited); returns the allocations in order."""
+    allocations = [0.0] * len(demands)
+    order = sorted(range(len(demands)), key=lambda i: demands[i] or math.inf)
+    remaining = capacity
+    for position, i in enumerate(order):
+        allocations[i] = min(demands[i] or math.inf, remaining / (len(order) - position))
+        remaining -= allocations[i]
+    return allocations
+
+
+class Share:
+    """One session's slice of the egress capacity; pacer is None while the session is unpaced."""
+
+    def __init__(self, client, kind, demand_bps, bucket=None):
+        self.client = client
+        self.kind = kind
+        self.demand_bps = demand_bps
+        self.pacer = bucket
+        self.started = time.monotonic()
+
+    @property
+    def rate_bps(self):
+        return self.pacer.rate_bps if self.pacer is not None else 0
+
+    def describe(self):
+        demand = f"{self.demand_bps} bits/second" if self.demand_bps else "unlimited"
+        rate = f"{self.rate_bps:.0f} bits/second" if self.pacer is not None else "unpaced"
+        return f"{self.client} {self.kind.upper()} {rate} (asked {demand}, {time.monotonic() - self.started:.1f}s)"
+
+
+class FairShare:
+    """Divides capacity_bps bits/second of egress between the running sessions; 0 leaves them unpaced."""
+
+    def __init__(self, capacity_bps=0):
+        self.capacity_bps = capacity_bps
+        self.lock = threading.Lock()
+        self.shares = []
+
+    def add(self, client, kind, demand_bps=0):
+        if not self.capacity_bps:
+            share = Share(client, kind, demand_bps, pacer.make_pacer(demand_bps))
+        else:
+            share = Share(client, kind, demand_bps, pacer.TokenBucket(self.capacity_bps))
+        with self.lock:
+            self.shares.append(share)
+            self._rebalance()
+        return share
+
+    def remove(self, share):
+        with self.lock:
+            self.shares.remove(share)
+            self._rebalance()
+
+    def _rebalance(self):
+        if not self.capacity_bps or not self.shares:
+            return
+        clients = collections.defaultdict(list)
+        for share in self.shares:
+            clients[share.client].append(share)
+        groups = list(clients.values())
+        demands = [0 if any(not share.demand_bps for share in group) else sum(share.demand_bps for share in group)
+                   for group in groups]
+        for group, allocation in zip(groups, max_min(self.capacity_bps, demands)):
+            for share, rate in zip(group, max_min(allocation, [share.demand_bps for share in group])):
+                share.pacer.set_rate(rate)
+
+    def snapshot(self):
+        """The running sessions' shares, oldest first."""
+        with self.lock:
+            return list(self.shares)
+
+
+class _Waiter:
+    def __init__(self, wake):
+        self.wake = wake
+        self.granted = False
+
+
+class Admission:
+    """
+    Caps concurrent sessions at max_sessions (0 for no cap) with a queue of max_queued waiting sessions.
+
+    A finishing session hands its slot straight to the longest waiter, so
+    waiters are admitted in arrival order. Admitted, queued and rejected
+    sessions are counted in workerPool.STATS.
+    """
+
+    def __init__(self, max_sessions=0, max_queued=DEFAULT_MAX_QUEUED, queue_timeout=DEFAULT_QUEUE_TIMEOUT,
+                 egress_bps=0):
+        self.max_sessions = max_sessions
+        self.max_queued = max_queued
+        self.queue_timeout = queue_timeout
+        self.shares = FairShare(egress_bps)
+        self.lock = threading.Lock()
+        self.active = 0
+        self.waiters = collections.deque()
+
+    def _try_enter(self, waiter):
+        """Under the lock: admit (True), queue waiter (None), or reject (False)."""
+        if not self.max_sessions or self.active < self.max_sessions:
+            self.active += 1
+            workerPool.record("admitted")
+            return True
+        if waiter is None or len(self.waiters) >= self.max_queued:
+            workerPool.record("rejected")
+            return False
+        self.waiters.append(waiter)
+        workerPool.record("queued")
+        workerPool.record("queued_sessions")
+        return None
+
+    def _settle(self, waiter):
+        """After a wait: True if the slot was handed over, otherwise leave the queue and count a rejection."""
+        with self.lock:
+            if waiter.granted:
+                return True
+            self.waiters.remove(waiter)
+            workerPool.record("queued_sessions", -1)
+            workerPool.record("rejected")
+            return False
+
+    def enter(self, wait=True):
+        """Take a session slot, waiting in the queue up to queue_timeout if wait; False means turned away."""
+        event = threading.Event()
+        waiter = _Waiter(event.set) if wait else None
+        with self.lock:
+            admitted = self._try_enter(waiter)
+        if admitted is not None:
+            return admitted
+        event.wait(self.queue_timeout)
+        return self._settle(waiter)
+
+    async def enter_async(self, wait=True):
+        """enter() for coroutines: waits in the queue without blocking the event loop."""
+        loop = asyncio.get_running_loop()
+        granted = loop.create_future()
+
+        def wake():
+            loop.call_soon_threadsafe(lambda: granted.done() or granted.set_result(None))
+
+        waiter = _Waiter(wake) if wait else None
+        with self.lock:
+            admitted = self._try_enter(waiter)
+        if admitted is not None:
+            return admitted
+        try:
+            await asyncio.wait_for(granted, self.queue_timeout)
+        except asyncio.TimeoutError:
+            pass
+        except asyncio.CancelledError:
+            if self._settle(waiter):
+                self.leave()
+            raise
+        return self._settle(waiter)
+
+    def leave(self):
+        with self.lock:
+            if self.waiters:
+                waiter = self.waiters.popleft()
+                workerPool.record("queued_sessions", -1)
+                waiter.granted = True
+                waiter.wake()
+            else:
+                self.active -= 1
+
+    def retry_after_ms(self):
+        """How long a turned-away client should wait before trying again."""
+        backlog = len(self.waiters) / self.max_sessions if self.max_sessions else 0
+        return int(RETRY_AFTER * (1 + backlog) * 1000)
+
+    @contextlib.contextmanager
+    def session(self, client, kind, demand_bps=0, wait=True):
+        """
+        Run one session if admitted, yielding its Share, or None if it was turned away.
+
+        The session counts towards the load gauge (workerPool.active_session) while it runs.
+        """
+        if not self.enter(wait):
+            yield None
+            return
+        try:
+            with self._running(client, kind, demand_bps) as share:
+                yield share
+        finally:
+            self.leave()
+
+    @contextlib.asynccontextmanager
+    async def session_async(self, client, kind, demand_bps=0, wait=True):
+        """session() for coroutines."""
+        if not await self.enter_async(wait):
+            yield None
+            return
+        try:
+            with self._running(client, kind, demand_bps) as share:
+                yield share
+        finally:
+            self.leave()
+
+    @contextlib.contextmanager
+    def _running(self, client, kind, demand_bps):
+        share = self.shares.add(client, kind, demand_bps)
+        try:
+            with workerPool.active_session():
+                yield share
+        finally:
+            self.shares.remove(share)
+
+
+def report_shares(admission, interval=REPORT_INTERVAL):
+    """Log every running session's share each interval seconds while there are any; runs forever."""
+    while True:
+        time.sleep(interval)
+        shares = admission.shares.snapshot()
+        if shares:
+            log.info("%d sessions, %d queued: %s", len(shares), len(admission.waiters),
+                     "; ".join(share.describe() for share in shares))
+
+
+def connect_when_admitted(server_ip, tcp_port, request):
+    """
+    Connect and send request, reconnecting while the server answers busy; returns the socket, or None if it stayed busy.
+
+    Waits for the first byte of the answer (left unread), so the caller's
+    timing starts after any time spent queued at the server.
+    """
+    for attempt in range(BUSY_RETRIES + 1):
+        sock = socketTuning.connect_tcp((server_ip, tcp_port))
+        sock.sendall(request)
+        retry_after = protocol.decode_busy(sock.recv(protocol.BUSY.size, socket.MSG_PEEK))
+        if retry_after is None:
+            return sock
+        sock.close()
+        if attempt < BUSY_RETRIES:
+            print(f"TCP server busy, retrying in {retry_after / 1000:.1f} seconds")
+            time.sleep(retry_after / 1000)
+    return None
+
+
+def request_when_admitted(udp_socket, server, request):
+    """
+    Send a UDP request, resending it while the server answers busy; False if it stayed busy.
+
+    The first answer is peeked at, not read, so the caller still receives it.
+    """
+    timeout = udp_socket.gettimeout()
+    udp_socket.settimeout(max(timeout or 0, ANSWER_WAIT))
+    try:
+        for attempt in range(BUSY_RETRIES + 1):
+            udp_socket.sendto(request, server)
+            try:
+                retry_after = protocol.decode_busy(udp_socket.recv(protocol.BUSY.size, socket.MSG_PEEK))
+            except socket.timeout:
+                return True  # no answer yet; the caller's own timeout decides
+            if retry_after is None:
+                return True
+            udp_socket.recv(protocol.BUSY.size)
+            if attempt < BUSY_RETRIES:
+                print(f"UDP server busy, retrying in {retry_after / 1000:.1f} seconds")
+                time.sleep(retry_after / 1000)
+        return False
+    finally:
+        udp_socket.settimeout(timeout)
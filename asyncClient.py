@@ -0,0 +1,256 @@
+"""
+Single-threaded client engine: any number of TCP and UDP sessions on one asyncio loop.
+
+TCP sessions are BufferedProtocols that all read into one shared buffer, and
+UDP sessions are connected datagram endpoints, so a session costs a socket
+and a few objects rather than a thread. run() waits for every session and
+returns one result dict per session.
+"""
+import asyncio
+import socket
+import time
+
+import asyncServer
+import intervalReport
+import protocol
+import receiver
+import socketTuning
+import udpSender
+from segmentTracker import SegmentTracker
+
+CONNECT_CONCURRENCY = 256  # connections being set up at once, to stay inside the server's listen backlog
+UDP_IDLE_TIMEOUT = 1
+OPEN_ENDED_SEGMENTS = 64 * 1024
+UNLIMITED = 2 ** 63 - 1
+
+# The received bytes are only counted, so every TCP session can read into the same buffer
+_shared_buffer = receiver.allocate_buffer()
+
+
+def new_result(name, kind):
+    return {"name": name, "protocol": kind, "bytes": 0, "packets": 0, "segments": 0, "lost": 0,
+            "elapsed": 0.0, "error": None, "socket": None, "jitter_ns": 0.0}
+
+
+class TcpSession(asyncio.BufferedProtocol):
+    """Reads one TCP download until limit bytes or end of stream."""
+
+    def __init__(self, result, limit, counters=None):
+        self.result = result
+        self.limit = limit
+        self.counters = counters
+        self.transport = None
+        self.finished = asyncio.get_running_loop().create_future()
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def get_buffer(self, sizehint):
+        return _shared_buffer
+
+    def buffer_updated(self, nbytes):
+        result = self.result
+        if not result["bytes"]:
+            retry_after = protocol.decode_busy(_shared_buffer[:nbytes])
+            if retry_after is not None:
+                result["error"] = f"server busy, retry after {retry_after} ms"
+                self.transport.close()
+                return
+        result["bytes"] += nbytes
+        result["packets"] += 1
+        if self.counters is not None:
+            self.counters.bytes += nbytes
+            self.counters.packets += 1
+        if result["bytes"] >= self.limit:
+            self.transport.close()
+
+    def eof_received(self):
+        return False
+
+    def connection_lost(self, exc):
+        if not self.finished.done():
+            self.finished.set_result(exc)
+
+
+class UdpSession(asyncio.DatagramProtocol):
+    """Receives one UDP payload stream, tracking segments until complete, done or idle."""
+
+    def __init__(self, result, counters=None):
+        self.result = result
+        self.counters = counters
+        self.tracker = None
+        self.open_ended = False
+        self.last_arrival = time.perf_counter()
+        self.finished = asyncio.get_running_loop().create_future()
+
+    def datagram_received(self, data, address):
+        self.last_arrival = time.perf_counter()
+        header = protocol.decode_payload_header(data)
+        if header is None:
+            retry_after = protocol.decode_busy(data)
+            if retry_after is not None:
+                self.result["error"] = f"server busy, retry after {retry_after} ms"
+                self.finish()
+                return
+            sent_segments = protocol.decode_done(data)
+            if sent_segments is not None:
+                if self.tracker is not None:
+                    self.tracker.resize(max(sent_segments, self.tracker.highest + 1))
+                    self.open_ended = False
+                self.finish()
+            return
+        total_segments, segment, sent_ns = header
+        tracker = self.tracker
+        if tracker is None:
+            self.open_ended = total_segments == 0
+            tracker = self.tracker = SegmentTracker(total_segments or OPEN_ENDED_SEGMENTS)
+            if self.counters is not None:
+                self.counters.tracker = tracker
+        if self.open_ended and segment >= tracker.total_segments:
+            tracker.resize(max(segment + 1, tracker.total_segments * 2))
+        payload_bytes = len(data) - protocol.PAYLOAD_HEADER_SIZE
+        if tracker.add(segment):
+            self.result["bytes"] += payload_bytes
+        self.result["packets"] += 1
+        if self.counters is not None:
+            self.counters.bytes += payload_bytes
+            self.counters.packets += 1
+            self.counters.arrival(sent_ns, protocol.timestamp())
+        if tracker.complete and not self.open_ended:
+            self.finish()
+
+    def error_received(self, exc):
+        self.result["error"] = str(exc)
+        self.finish()
+
+    def finish(self):
+        if not self.finished.done():
+            self.finished.set_result(None)
+
+
+async def tcp_session(name, server_ip, tcp_port, file_size, connecting, duration=0, counters=None):
+    """Run one TCP download; with a duration it streams for that many seconds instead."""
+    loop = asyncio.get_running_loop()
+    result = new_result(name, "tcp")
+    start = time.perf_counter()
+    try:
+        async with connecting:
+            # Tuned before connecting, since the receive buffer fixes the window scale
+            sock = socketTuning.tune_tcp(socket.socket(socket.AF_INET, socket.SOCK_STREAM))
+            sock.setblocking(False)
+            try:
+                await loop.sock_connect(sock, (server_ip, tcp_port))
+            except OSError:
+                sock.close()
+                raise
+            transport, session = await loop.create_connection(
+                lambda: TcpSession(result, (file_size or UNLIMITED) if duration else file_size, counters), sock=sock)
+        result["socket"] = socketTuning.describe(sock)
+        transport.write(protocol.encode_request(file_size, duration_ms=int(duration * 1000)))
+        if duration:
+            try:
+                await asyncio.wait_for(asyncio.shield(session.finished), duration)
+            except asyncio.TimeoutError:
+                transport.write(protocol.encode_stop())
+        error = await session.finished
+        if error is not None:
+            result["error"] = str(error)
+    except OSError as e:
+        result["error"] = str(e)
+    result["elapsed"] = time.perf_counter() - start
+    if counters is not None:
+        counters.done = True
+    return result
+
+
+async def udp_session(name, server_ip, udp_port, file_size, bitrate=0, segment_size=udpSender.DEFAULT_SEGMENT_SIZE,
+                      duration=0, counters=None):
+    """Run one UDP download; ends when complete, on the server's done message or after UDP_IDLE_TIMEOUT idle."""
+    loop = asyncio.get_running_loop()
+    result = new_result(name, "udp")
+    if counters is None:
+        counters = intervalReport.TransferCounters(name)  # for the jitter in the results
+    start = time.perf_counter()
+    try:
+        transport, session = await loop.create_datagram_endpoint(
+            lambda: UdpSession(result, counters), remote_addr=(server_ip, udp_port))
+    except OSError as e:
+        result["error"] = str(e)
+        return result
+    sock = socketTuning.tune_udp(transport.get_extra_info("socket"))
+    result["socket"] = socketTuning.describe(sock)
+    try:
+        transport.sendto(protocol.encode_request(file_size, bitrate, udpSender.clamp_segment_size(segment_size),
+                                                 int(duration * 1000)))
+        deadline = start + duration if duration else None
+        while not session.finished.done():
+            now = time.perf_counter()
+            if deadline is not None and now >= deadline:
+                transport.sendto(protocol.encode_stop())
+                deadline = None
+            wait = session.last_arrival + UDP_IDLE_TIMEOUT - now
+            if wait <= 0:
+                break
+            if deadline is not None:
+                wait = min(wait, deadline - now)
+            await asyncio.wait([session.finished], timeout=wait)
+    finally:
+        transport.close()
+    tracker = session.tracker
+    if tracker is not None:
+        if session.open_ended:
+            # The done message was lost; assume nothing after the highest segment seen
+            tracker.resize(tracker.highest + 1)
+        result["segments"] = tracker.total_segments
+        result["lost"] = tracker.lost
+    result["elapsed"] = (session.last_arrival if tracker is not None else time.perf_counter()) - start
+    result["jitter_ns"] = counters.jitter_ns
+    counters.done = True
+    return result
+
+
+async def run_sessions(server_ip, tcp_port, udp_port, file_size, tcp_sessions, udp_sessions, bitrate=0,
+                       segment_size=udpSender.DEFAULT_SEGMENT_SIZE, duration=0, reporter=None):
+    """Start every session at once and return their results, TCP sessions first."""
+    connecting = asyncio.Semaphore(CONNECT_CONCURRENCY)
+    sessions = []
+    for i in range(tcp_sessions):
+        name = f"TCP-{i + 1}"
+        sessions.append(tcp_session(name, server_ip, tcp_port, file_size, connecting, duration,
+                                    reporter.add(name) if reporter else None))
+    for i in range(udp_sessions):
+        name = f"UDP-{i + 1}"
+        sessions.append(udp_session(name, server_ip, udp_port, file_size, bitrate, segment_size, duration,
+                                    reporter.add(name) if reporter else None))
+    return await asyncio.gather(*sessions)
+
+
+def run(server_ip, tcp_port, udp_port, file_size, tcp_sessions, udp_sessions, bitrate=0,
+        segment_size=udpSender.DEFAULT_SEGMENT_SIZE, duration=0, reporter=None):
+    """Drive every session from this thread and return one result dict per session once all have finished."""
+    asyncServer.raise_fd_limit()
+    return asyncio.run(run_sessions(server_ip, tcp_port, udp_port, file_size, tcp_sessions, udp_sessions,
+                                    bitrate, segment_size, duration, reporter))
+
+
+def print_results(results, elapsed):
+    """Print a line per failed session and a summary per protocol."""
+    for result in results:
+        if result["error"]:
+            print(f"[{result['name']}] failed: {result['error']}")
+    for kind in ("tcp", "udp"):
+        rows = [result for result in results if result["protocol"] == kind]
+        if not rows:
+            continue
+        nbytes = sum(result["bytes"] for result in rows)
+        failed = sum(1 for result in rows if result["error"])
+        line = (f"{kind.upper()}: {len(rows)} sessions ({failed} failed), {nbytes} bytes in {elapsed:.2f} seconds, "
+                f"total speed: {nbytes * 8 / elapsed:.2f} bits/second")
+        if kind == "udp":
+            segments = sum(result["segments"] for result in rows)
+            lost = sum(result["lost"] for result in rows)
+            jitter = sum(result["jitter_ns"] for result in rows) / len(rows)
+            line += f", lost {lost}/{segments} segments, mean jitter {jitter / intervalReport.NS_PER_MS:.3f} ms"
+        print(line)
+        for tuning in sorted({result["socket"] for result in rows if result["socket"]}):
+            print(f"{kind.upper()} socket: {tuning}")
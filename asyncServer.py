@@ -0,0 +1,428 @@
+import asyncio
+import logging
+import os
+import queue
+import select
+import socket
+import time
+
+import admission
+import eventLog
+import pacer
+import payloadSource
+import protocol
+import socketTuning
+import tcpInfo
+import tcpSender
+import udpSender
+import workerPool
+from payloadSource import PayloadSource
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+WRITE_HIGH_WATER = 256 * 1024
+LISTEN_BACKLOG = 4096
+UDP_YIELD_EVERY = 64
+SEND_WAIT = 0.01  # seconds a reliable session's thread waits for room in the socket buffer before retrying
+
+log = eventLog.get_logger("asyncServer")
+
+
+def raise_fd_limit():
+    """Raise the open-files soft limit to the hard limit so thousands of sessions fit."""
+    if resource is None:
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if hard == resource.RLIM_INFINITY or soft < hard:
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+        except (ValueError, OSError):
+            pass
+
+
+class BlockingSender:
+    """
+    A duplicate of the server's non-blocking UDP socket for a worker thread, whose sends wait for room.
+
+    udpSender.send_reliable() sends on it directly; the transport's own
+    buffering is for the event loop's thread only.
+    """
+
+    def __init__(self, transport):
+        self.sock = socket.socket(fileno=os.dup(transport.get_extra_info("socket").fileno()))
+
+    def _send(self, send, *args):
+        while True:
+            try:
+                return send(*args)
+            except BlockingIOError:
+                select.select([], [self.sock], [], SEND_WAIT)
+
+    def sendto(self, data, address):
+        return self._send(self.sock.sendto, data, address)
+
+    def sendmsg(self, buffers, ancdata, flags, address):
+        return self._send(self.sock.sendmsg, buffers, ancdata, flags, address)
+
+    def close(self):
+        self.sock.close()
+
+
+class UdpPayloadProtocol(asyncio.DatagramProtocol):
+    """Serves UDP payload requests, one task per request, respecting transport flow control."""
+
+    def __init__(self, buffer_size, gate):
+        self.buffer_size = buffer_size
+        self.gate = gate
+        self.payload = PayloadSource(2 ** 63 - 1, fill=b'B')
+        self.transport = None
+        self.writable = asyncio.Event()
+        self.writable.set()
+        self.sessions = set()
+        self.stop_requests = set()
+        self.inboxes = {}  # address -> queue of the stop and nack messages of its reliable session
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, address):
+        if protocol.peek_type(data) == protocol.PING_TYPE:
+            self.transport.sendto(protocol.encode_pong(data), address)
+            return
+        inbox = self.inboxes.get(address)
+        if inbox is not None and (protocol.is_stop(data) or protocol.peek_type(data) == protocol.NACK_TYPE):
+            inbox.put(data)
+            return
+        if protocol.is_stop(data):
+            self.stop_requests.add(address)
+            return
+        request = protocol.parse_request(data)
+        if request is None:
+            return
+        request = request._replace(segment_size=udpSender.clamp_segment_size(request.segment_size or self.buffer_size))
+        if request.duration_ms:
+            log.info("UDP request for %d ms in %d-byte segments at %s bits/second from %s",
+                     request.duration_ms, request.segment_size, request.bitrate or "unpaced", address)
+        else:
+            log.info("UDP request for %d bytes in %d-byte segments at %s bits/second from %s",
+                     request.file_size, request.segment_size, request.bitrate or "unpaced", address)
+        self.stop_requests.discard(address)
+        task = asyncio.ensure_future(self.run_session(address, request))
+        self.sessions.add(task)
+        task.add_done_callback(self.sessions.discard)
+
+    def pause_writing(self):
+        self.writable.clear()
+
+    def resume_writing(self):
+        self.writable.set()
+
+    async def run_session(self, address, request):
+        async with self.gate.session_async(address[0], "udp", request.bitrate, wait=False) as share:
+            if share is None:
+                log.info("UDP client %s turned away, server busy", address)
+                self.transport.sendto(protocol.encode_busy(self.gate.retry_after_ms()), address)
+                return
+            # Echo the request back with the agreed segment size, as the threaded servers do
+            self.transport.sendto(protocol.encode_request(*request), address)
+            if request.flags & protocol.FLAG_RELIABLE:
+                await self.send_reliable(address, request, share.pacer)
+            else:
+                await self.send_segments(address, request, share.pacer)
+
+    async def send_reliable(self, address, request, bucket=None):
+        """
+        Send a reliable request with udpSender.send_reliable() on a worker thread, fed the client's nacks.
+
+        Retransmission needs the blocking sender loop of the threaded servers,
+        so each reliable session takes one of the loop's executor threads.
+        """
+        inbox = self.inboxes[address] = queue.Queue()
+
+        def feedback():
+            messages = []
+            while not inbox.empty():
+                messages.append(inbox.get_nowait())
+            return messages
+
+        if bucket is None:
+            bucket = pacer.make_pacer(request.bitrate)
+        sender = BlockingSender(self.transport)
+        try:
+            stats = await asyncio.get_running_loop().run_in_executor(
+                None, udpSender.send_reliable, sender, address, payloadSource.for_request(request, self.payload),
+                request.segment_size, request.file_size, feedback, bucket)
+        finally:
+            sender.close()
+            self.inboxes.pop(address, None)
+        size = request.file_size if stats["complete"] else 0
+        workerPool.record("udp_sessions")
+        workerPool.record("udp_bytes", size)
+        log.info("Reliable UDP to %s %s: %d segments in %d datagrams (%.1f%% retransmitted), %d backoffs, window %d",
+                 address, "complete" if stats["complete"] else "abandoned", stats["segments"], stats["sent"],
+                 stats["retransmitted"] / max(stats["segments"], 1) * 100, stats["backoffs"], stats["window"])
+
+    async def send_segments(self, address, request, bucket=None):
+        """
+        Send numbered segments a batch at a time; the transport copies whatever it cannot send at once.
+
+        bucket paces the session, by default at the bitrate it asked for.
+        """
+        bitrate, segment_size = request.bitrate, request.segment_size
+        if bucket is None:
+            bucket = pacer.make_pacer(bitrate)
+        start = time.perf_counter()
+        if request.duration_ms:
+            file_size = min(request.file_size or len(self.payload), len(self.payload))
+            deadline = start + request.duration_ms / 1000
+        else:
+            file_size = request.file_size
+            deadline = None
+        segments = udpSender.segment_count(file_size, segment_size)
+        if segments == 0:
+            return
+        batch_size = UDP_YIELD_EVERY if bucket is None else max(1, bucket.burst // (protocol.PAYLOAD_HEADER_SIZE + segment_size))
+        batch = udpSender.DatagramBatch(payloadSource.for_request(request, self.payload), 0 if deadline else segments,
+                                        segment_size, batch_size, use_gso=False)
+        size = batch.datagram_size
+        sent = 0
+        for first in range(0, segments, batch.batch_size):
+            if (deadline and time.perf_counter() >= deadline) or address in self.stop_requests:
+                break
+            count = min(batch.batch_size, segments - first)
+            delay = bucket.reserve(count * size) if bucket is not None else 0.0
+            if delay > 0:
+                await asyncio.sleep(delay)
+            if not self.writable.is_set():
+                await self.writable.wait()
+            elif delay == 0:
+                await asyncio.sleep(0)
+            nbytes = batch.fill(first, count)
+            for offset in range(0, nbytes, size):
+                length = size
+                if offset + size == nbytes and first + count == segments and file_size % segment_size:
+                    # The last datagram only carries the remainder of the file
+                    length = protocol.PAYLOAD_HEADER_SIZE + file_size % segment_size
+                self.transport.sendto(batch.view[offset:offset + length], address)
+            sent += count
+        if deadline:
+            for _ in range(udpSender.DONE_REPEAT):
+                self.transport.sendto(protocol.encode_done(sent), address)
+        self.stop_requests.discard(address)
+        file_size = min(file_size, sent * segment_size)
+        workerPool.record("udp_sessions")
+        workerPool.record("udp_bytes", file_size)
+        log.info("All UDP packets sent to %s, %s", address, pacer.rate_report(file_size, time.perf_counter() - start, bitrate))
+
+
+async def pace(bucket, nbytes):
+    """Charge nbytes to bucket, if any, and sleep off any overdraft."""
+    if bucket is not None:
+        delay = bucket.reserve(nbytes)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+async def send_for(loop, reader, writer, payload, duration, limit=0, bucket=None):
+    """
+    Send the payload file for duration seconds, until the client sends anything (a stop message or EOF), or limit bytes.
+
+    With a bucket (a TokenBucket) each sendfile() call sends at most one burst.
+    """
+    stop = asyncio.ensure_future(reader.read(64))
+    start = time.perf_counter()
+    deadline = start + duration
+    sent = 0
+    count = tcpSender.timed_chunk(0, 0, payload.size)
+    try:
+        while (not limit or sent < limit) and not stop.done() and time.perf_counter() < deadline:
+            position = sent % payload.size
+            count = min(count, payload.size - position)
+            if limit:
+                count = min(count, limit - sent)
+            if bucket is not None:
+                count = min(count, bucket.burst)
+            done = await loop.sendfile(writer.transport, payload.file, position, count)
+            if done == 0:
+                break
+            sent += done
+            await pace(bucket, done)
+            count = tcpSender.timed_chunk(sent, time.perf_counter() - start, payload.size)
+    finally:
+        stop.cancel()
+    return sent
+
+
+async def send_stream(loop, writer, payload, length, offset=0, bucket=None):
+    """Send length bytes of the logical file starting at offset, repeating the payload file; returns bytes sent."""
+    sent = 0
+    while sent < length:
+        position = (offset + sent) % payload.size
+        count = min(payload.size - position, length - sent)
+        if bucket is not None:
+            count = min(count, bucket.burst)
+        done = await loop.sendfile(writer.transport, payload.file, position, count)
+        if done == 0:
+            break
+        sent += done
+        await pace(bucket, done)
+    return sent
+
+
+async def send_ranges(loop, reader, writer, payload, data, bucket=None):
+    """Answer range requests until the client closes; data holds the bytes read so far. Returns (bytes, ranges)."""
+    size = protocol.REQUEST.size
+    sent = ranges = 0
+    while True:
+        if len(data) < size:
+            try:
+                data += await reader.readexactly(size - len(data))
+            except asyncio.IncompleteReadError:
+                break
+        request = protocol.decode_request(data[:size])
+        data = data[size:]
+        if request is None or not request.flags & protocol.FLAG_RANGE:
+            break
+        done = await send_stream(loop, writer, payload, request.file_size, request.offset, bucket)
+        sent += done
+        ranges += 1
+        if done < request.file_size:
+            break
+    return sent, ranges
+
+
+async def echo(reader, writer, data):
+    """Send back every byte the client sends until it closes; data holds what followed the echo request."""
+    sock = writer.get_extra_info('socket')
+    if sock is not None:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    echoed = 0
+    while True:
+        if data:
+            writer.write(data)
+            echoed += len(data)
+            await writer.drain()
+        data = await reader.read(64 * 1024)
+        if not data:
+            return echoed
+
+
+async def linger(reader, writer, timeout=tcpSender.LINGER_SECONDS):
+    """Half-close and wait for the client to close, so a late stop message cannot reset the connection."""
+    if writer.can_write_eof():
+        writer.write_eof()
+    try:
+        await asyncio.wait_for(reader.read(), timeout)
+    except (asyncio.TimeoutError, ConnectionError):
+        pass
+
+
+async def handle_tcp_stream(reader, writer, payload, gate):
+    """Stream the requested number of bytes to one TCP client with loop.sendfile() once gate (an Admission) lets it in."""
+    loop = asyncio.get_running_loop()
+    address = writer.get_extra_info('peername')
+    writer.transport.set_write_buffer_limits(high=WRITE_HIGH_WATER)
+    sock = socketTuning.tune_tcp(writer.get_extra_info('socket'))
+    try:
+        async with gate.session_async(address[0], "tcp") as share:
+            if share is None:
+                log.info("TCP client %s turned away, server busy", address)
+                writer.write(protocol.encode_busy(gate.retry_after_ms()))
+                await linger(reader, writer)
+                return
+            with tcpInfo.sampled(sock) as info:
+                data = await reader.read(1024)
+                request = protocol.parse_request(data)
+                if request is not None:
+                    file_size = request.file_size
+                    data_file = tcpSender.payload_for(request, payload)
+                    start = time.perf_counter()
+                    sent = 0
+                    if request.flags & protocol.FLAG_FILE:
+                        log.info("TCP file request from %s, but files are only served by main.py", address)
+                        writer.write(protocol.encode_file(protocol.FILE_NOT_SERVED))
+                        await linger(reader, writer)
+                    elif request.flags & protocol.FLAG_ECHO:
+                        log.info("TCP echo request from %s", address)
+                        sent = await echo(reader, writer, data[protocol.REQUEST.size:])
+                    elif request.flags & protocol.FLAG_RANGE:
+                        sent, ranges = await send_ranges(loop, reader, writer, data_file, data, share.pacer)
+                        log.info("TCP answered %d range requests from %s", ranges, address)
+                    elif request.duration_ms:
+                        log.info("TCP request for %d ms from %s", request.duration_ms, address)
+                        sent = await send_for(loop, reader, writer, data_file, request.duration_ms / 1000, file_size,
+                                              share.pacer)
+                        await linger(reader, writer)
+                    else:
+                        log.info("TCP request for %d bytes from %s", file_size, address)
+                        sent = await send_stream(loop, writer, data_file, file_size, bucket=share.pacer)
+                    workerPool.record("tcp_sessions")
+                    workerPool.record("tcp_bytes", sent)
+                    log.info("TCP sent %s to %s; socket: %s", tcpSender.format_rate(sent, time.perf_counter() - start), address,
+                             socketTuning.describe(sock))
+            log.info("TCP path to %s: %s", address, info.summary())
+    except Exception as e:
+        log.error("Error handling TCP client %s: %s", address, e)
+    finally:
+        writer.close()
+        log.debug("TCP connection closed with %s", address)
+
+
+async def broadcast_offers(message, broadcast_port, interval=1):
+    """Broadcast the offer message from inside the event loop, with this process's current load added."""
+    offer = protocol.decode_offer(message)
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP) as udp_socket:
+        udp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        udp_socket.setblocking(False)
+        failures = eventLog.Sampler(log, interval=60, level=logging.WARNING)
+        while True:
+            try:
+                message = protocol.encode_offer(offer.udp_port, offer.tcp_port, workerPool.current_load())
+                udp_socket.sendto(message, ('<broadcast>', broadcast_port))
+            except OSError as e:
+                failures.event("Broadcast offer failed: %s", e)
+            await asyncio.sleep(interval)
+
+
+async def serve(tcp_port, udp_port, broadcast_port, offer_message, buffer_size=1024,
+                chunk_size=tcpSender.DEFAULT_CHUNK_SIZE, reuse_port=False, gate=None):
+    """
+    Run the TCP server, UDP payload socket and offer broadcaster (unless offer_message is None) on one loop.
+
+    gate (an Admission) limits the sessions; by default there is no limit.
+    """
+    loop = asyncio.get_running_loop()
+    payload = tcpSender.shared_payload(chunk_size)
+    if gate is None:
+        gate = admission.Admission()
+
+    tcp_server = await asyncio.start_server(
+        lambda reader, writer: handle_tcp_stream(reader, writer, payload, gate),
+        host="", port=tcp_port, backlog=LISTEN_BACKLOG, reuse_address=True, reuse_port=reuse_port or None)
+    udp_transport, _ = await loop.create_datagram_endpoint(
+        lambda: UdpPayloadProtocol(buffer_size, gate), local_addr=("0.0.0.0", udp_port), reuse_port=reuse_port or None)
+    # Connections accepted from now on inherit the listeners' buffers
+    for listener in tcp_server.sockets:
+        socketTuning.tune_tcp(listener)
+    udp_socket = socketTuning.tune_udp(udp_transport.get_extra_info('socket'))
+    log.info("Event-loop server listening on TCP %d and UDP %d; UDP socket: %s", tcp_port, udp_port,
+             socketTuning.describe(udp_socket))
+
+    try:
+        async with tcp_server:
+            tasks = [tcp_server.serve_forever()]
+            if offer_message is not None:
+                tasks.append(broadcast_offers(offer_message, broadcast_port))
+            await asyncio.gather(*tasks)
+    finally:
+        udp_transport.close()
+
+
+def run(tcp_port, udp_port, broadcast_port, offer_message, buffer_size=1024,
+        chunk_size=tcpSender.DEFAULT_CHUNK_SIZE, reuse_port=False, gate=None):
+    """Start the asyncio engine and block until it is stopped."""
+    raise_fd_limit()
+    asyncio.run(serve(tcp_port, udp_port, broadcast_port, offer_message, buffer_size, chunk_size, reuse_port, gate))
@@ -0,0 +1,306 @@
+"""
+Loopback benchmark: run each server engine and drive it with concurrent clients.
+
+Every run in the matrix (engine x protocol x file size x segment size x
+connections) records throughput, packets/second, server and client CPU time
+and peak RSS. Results are written as JSON; with --baseline they are compared
+against an earlier results file and slower or costlier runs are flagged.
+
+    python benchmark.py --output results.json --save_baseline baseline.json
+    python benchmark.py --baseline baseline.json
+"""
+import json
+import multiprocessing
+import os
+import platform
+import socket
+import sys
+import threading
+import time
+
+import eventLog
+import main
+import protocol
+import receiver
+import serverSide
+import udpSender
+from segmentTracker import SegmentTracker
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+HOST = "127.0.0.1"
+ENGINES = ("main", "threads", "asyncio")
+PROTOCOLS = ("tcp", "udp")
+FILE_SIZES = (10 * 1024 * 1024, 100 * 1024 * 1024)
+SEGMENT_SIZES = (1024, 8192, 60000)
+CONNECTIONS = (1, 4)
+DEFAULT_THRESHOLD = 0.10
+STARTUP_TIMEOUT = 5
+UDP_IDLE_TIMEOUT = 1
+
+
+def resource_usage():
+    """CPU seconds and peak RSS (KiB on Linux) of the calling process."""
+    if resource is None:
+        return {"cpu": time.process_time(), "peak_rss_kb": 0}
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return {"cpu": usage.ru_utime + usage.ru_stime, "peak_rss_kb": usage.ru_maxrss}
+
+
+def find_free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind((HOST, 0))
+        return sock.getsockname()[1]
+
+
+# === Server side ===
+def server_target(engine, max_file_size):
+    """Return (target, args, tcp_port, udp_port) that starts one engine."""
+    if engine == "main":
+        tcp_port, udp_port = find_free_port(), find_free_port()
+        return main.start_server, (tcp_port, udp_port, max_file_size), tcp_port, udp_port
+    return serverSide.main, (engine,), serverSide.SERVER_TCP_PORT, serverSide.SERVER_UDP_PORT
+
+
+def _server_main(target, args, control):
+    sys.stdout = open(os.devnull, "w")
+    eventLog.setup("WARNING")
+    threading.Thread(target=target, args=args, daemon=True).start()
+    while control.recv() == "usage":
+        control.send(resource_usage())
+
+
+class BenchServer:
+    """One server engine in a child process that reports its own CPU time and peak RSS on request."""
+
+    def __init__(self, engine, max_file_size):
+        self.engine = engine
+        target, args, self.tcp_port, self.udp_port = server_target(engine, max_file_size)
+        self.control, child = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(target=_server_main, args=(target, args, child), daemon=True)
+
+    def start(self):
+        self.process.start()
+        deadline = time.monotonic() + STARTUP_TIMEOUT
+        while time.monotonic() < deadline:
+            try:
+                socket.create_connection((HOST, self.tcp_port), timeout=1).close()
+                # The UDP listener starts alongside TCP; give it a moment to bind
+                time.sleep(0.2)
+                return
+            except OSError:
+                time.sleep(0.1)
+        self.stop()
+        raise RuntimeError(f"{self.engine} server did not start listening on port {self.tcp_port}")
+
+    def usage(self):
+        self.control.send("usage")
+        return self.control.recv()
+
+    def stop(self):
+        if self.process.is_alive():
+            self.control.send("stop")
+            self.process.join(timeout=2)
+            if self.process.is_alive():
+                self.process.terminate()
+
+
+# === Client side ===
+def tcp_client(port, file_size, results, buffer_size=receiver.DEFAULT_BUFFER_SIZE):
+    """Download file_size bytes; packets counts recv calls."""
+    buffer = receiver.allocate_buffer(buffer_size)
+    received = reads = 0
+    with socket.create_connection((HOST, port)) as sock:
+        sock.sendall(protocol.encode_request(file_size))
+        while received < file_size:
+            n = sock.recv_into(buffer)
+            if n == 0:
+                break
+            received += n
+            reads += 1
+    results.append({"bytes": received, "packets": reads, "lost": 0})
+
+
+def udp_client(port, file_size, segment_size, results):
+    """Download file_size bytes as datagrams until complete or idle for UDP_IDLE_TIMEOUT."""
+    buffer = receiver.allocate_buffer(protocol.PAYLOAD_HEADER_SIZE + udpSender.MAX_SEGMENT_SIZE)
+    tracker = None
+    received = packets = 0
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.settimeout(UDP_IDLE_TIMEOUT)
+        sock.sendto(protocol.encode_request(file_size, 0, segment_size), (HOST, port))
+        while tracker is None or not tracker.complete:
+            try:
+                data, _ = receiver.receive_datagram(sock, buffer)
+            except socket.timeout:
+                break
+            header = protocol.decode_payload_header(data)
+            if header is None:
+                continue
+            if tracker is None:
+                tracker = SegmentTracker(header[0])
+            packets += 1
+            if tracker.add(header[1]):
+                received += len(data) - protocol.PAYLOAD_HEADER_SIZE
+    results.append({"bytes": received, "packets": packets, "lost": tracker.lost if tracker else 0})
+
+
+def run_case(server, proto, file_size, segment_size, connections):
+    """Run one matrix cell against a started server and return its result row."""
+    results = []
+    if proto == "tcp":
+        target, args = tcp_client, (server.tcp_port, file_size, results)
+    else:
+        target, args = udp_client, (server.udp_port, file_size, segment_size, results)
+    threads = [threading.Thread(target=target, args=args) for _ in range(connections)]
+
+    server_before = server.usage()
+    client_before = resource_usage()
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    client_after = resource_usage()
+    server_after = server.usage()
+
+    # UDP ends on an idle timeout when segments are lost; don't count the wait
+    if proto == "udp" and any(result["lost"] for result in results):
+        elapsed = max(elapsed - UDP_IDLE_TIMEOUT, 1e-9)
+    nbytes = sum(result["bytes"] for result in results)
+    packets = sum(result["packets"] for result in results)
+    return {
+        "engine": server.engine,
+        "protocol": proto,
+        "file_size": file_size,
+        "segment_size": segment_size,
+        "connections": connections,
+        "bytes": nbytes,
+        "packets": packets,
+        "lost_segments": sum(result["lost"] for result in results),
+        "elapsed": elapsed,
+        "throughput_bps": nbytes * 8 / elapsed,
+        "packets_per_sec": packets / elapsed,
+        "server_cpu": server_after["cpu"] - server_before["cpu"],
+        "client_cpu": client_after["cpu"] - client_before["cpu"],
+        "server_peak_rss_kb": server_after["peak_rss_kb"],
+        "client_peak_rss_kb": client_after["peak_rss_kb"],
+    }
+
+
+def matrix(protocols, file_sizes, segment_sizes, connections):
+    """Yield (protocol, file_size, segment_size, connections); segment size only varies for UDP."""
+    for proto in protocols:
+        for file_size in file_sizes:
+            for segment_size in (segment_sizes if proto == "udp" else (None,)):
+                for count in connections:
+                    yield proto, file_size, segment_size, count
+
+
+def run_benchmarks(engines=ENGINES, protocols=PROTOCOLS, file_sizes=FILE_SIZES, segment_sizes=SEGMENT_SIZES,
+                   connections=CONNECTIONS, repeat=1):
+    """Run the whole matrix, one server process per engine; keeps the fastest of repeat runs per cell."""
+    results = []
+    for engine in engines:
+        server = BenchServer(engine, max(file_sizes))
+        server.start()
+        try:
+            for case in matrix(protocols, file_sizes, segment_sizes, connections):
+                best = max((run_case(server, *case) for _ in range(repeat)), key=lambda row: row["throughput_bps"])
+                print(format_row(best))
+                results.append(best)
+        finally:
+            server.stop()
+    return results
+
+
+# === Results and baselines ===
+def case_key(row):
+    return row["engine"], row["protocol"], row["file_size"], row["segment_size"], row["connections"]
+
+
+def format_row(row):
+    segment = f"{row['segment_size']}B segments" if row["segment_size"] else "stream"
+    line = (f"{row['engine']:8} {row['protocol']} {row['file_size']:>11} bytes {segment:>17} x{row['connections']}: "
+            f"{row['throughput_bps'] / 1e9:7.2f} Gbit/s, {row['packets_per_sec']:>10,.0f} packets/s, "
+            f"cpu server {row['server_cpu']:.2f}s client {row['client_cpu']:.2f}s")
+    if row["lost_segments"]:
+        line += f", lost {row['lost_segments']} segments"
+    return line
+
+
+def compare(results, baseline, threshold=DEFAULT_THRESHOLD):
+    """
+    Flag runs that got slower or costlier than the baseline run of the same case.
+
+    A run regresses when its throughput drops, or its server CPU per byte
+    grows, by more than threshold (a fraction). Adds a "regressions" list to
+    each row and returns the rows that have any.
+    """
+    previous = {case_key(row): row for row in baseline}
+    flagged = []
+    for row in results:
+        old = previous.get(case_key(row))
+        row["regressions"] = []
+        if old is None:
+            continue
+        if row["throughput_bps"] < old["throughput_bps"] * (1 - threshold):
+            row["regressions"].append(
+                f"throughput {row['throughput_bps'] / old['throughput_bps'] - 1:+.1%}")
+        if row["bytes"] and old["bytes"] and old["server_cpu"] > 0:
+            old_cost = old["server_cpu"] / old["bytes"]
+            cost = row["server_cpu"] / row["bytes"]
+            if cost > old_cost * (1 + threshold):
+                row["regressions"].append(f"server cpu/byte {cost / old_cost - 1:+.1%}")
+        if row["regressions"]:
+            flagged.append(row)
+    return flagged
+
+
+def write_results(path, results):
+    document = {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "results": results,
+    }
+    with open(path, "w") as file:
+        json.dump(document, file, indent=2)
+
+
+def load_results(path):
+    with open(path) as file:
+        return json.load(file)["results"]
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Loopback benchmark of the server engines.")
+    parser.add_argument("--engines", nargs="+", choices=ENGINES, default=list(ENGINES), help="Server engines to run.")
+    parser.add_argument("--protocols", nargs="+", choices=PROTOCOLS, default=list(PROTOCOLS), help="Transfers to run.")
+    parser.add_argument("--file_sizes", nargs="+", type=int, default=list(FILE_SIZES), help="Bytes per connection.")
+    parser.add_argument("--segment_sizes", nargs="+", type=int, default=list(SEGMENT_SIZES), help="UDP segment sizes in bytes.")
+    parser.add_argument("--connections", nargs="+", type=int, default=list(CONNECTIONS), help="Concurrent connections per run.")
+    parser.add_argument("--repeat", type=int, default=1, help="Runs per case; the fastest is kept.")
+    parser.add_argument("--output", default="benchmark_results.json", help="Where to write the results.")
+    parser.add_argument("--baseline", default=None, help="Earlier results file to check for regressions.")
+    parser.add_argument("--save_baseline", default=None, help="Also write the results to this baseline path.")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD, help="Allowed slowdown as a fraction.")
+    args = parser.parse_args()
+
+    results = run_benchmarks(args.engines, args.protocols, args.file_sizes, args.segment_sizes,
+                             args.connections, args.repeat)
+    regressions = compare(results, load_results(args.baseline), args.threshold) if args.baseline else []
+    write_results(args.output, results)
+    if args.save_baseline:
+        write_results(args.save_baseline, results)
+    print(f"Wrote {len(results)} results to {args.output}")
+    for row in regressions:
+        print(f"REGRESSION {format_row(row)}: {', '.join(row['regressions'])}")
+    sys.exit(1 if regressions else 0)
@@ -1,21 +1,22 @@
 import socket
-import struct
 import threading
 import time
 
 from tqdm import tqdm
 import ANSI_colors as ac
-from SeverSide import UDP_PAYLOAD_SIZE, TCP_PAYLOAD_SIZE
+import discovery
+import protocol
+import receiver
+import socketTuning
+import udpSender
+from segmentTracker import SegmentTracker
+from SeverSide import UDP_PAYLOAD_SIZE
 
 # ===== CONSTANTS =====
 BROADCAST_PORT = 8082
 UDP_TIMEOUT = 10
 TCP_TIMEOUT = 10
-MAGIC_COOKIE = 0xabcddcba
-MESSAGE_TYPE = 0x3
-RESPONSE_MESSAGE_TYPE = 0x4  # זה מתקבל בהודעת השרת
-PAYLOAD_FMT = "!I B Q Q"     # פורמט המבנה (magic_cookie, message_type, total_segments, current_segment)
-PAYLOAD_HEADER_SIZE = struct.calcsize(PAYLOAD_FMT)
+PAYLOAD_HEADER_SIZE = protocol.PAYLOAD_HEADER_SIZE
 
 # ===== פונקציית main =====
 def main():
@@ -73,38 +74,25 @@ def prompt_for_non_negative_int(message):
 # ===== שלב 2: פונקציית גילוי השרת (Broadcast) =====
 def discover_server():
     print(f"{ac.BOLD}● Listening for server offers on broadcast...{ac.RESET}")
-    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
-        s.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
-        s.bind(("", BROADCAST_PORT))
-        while True:
-            try:
-                data, address = s.recvfrom(1024)  # קבלת ההודעה
-                if validate_offer(data):
-                    # מבצעים פענוח של ההודעה
-                    _, _, udp_port, tcp_port = struct.unpack("!I B H H", data)
-                    return udp_port, tcp_port, address[0]
-            except socket.timeout:
-                # אם נרצה לאפשר יציאה אחרי זמן מסוים - לא ממומש פה
-                break
-            except Exception as e:
-                print(f"{ac.RED}An error occurred while listening to offers: {e}{ac.RESET}")
-                break
-    return None
+    try:
+        with discovery.Discovery(BROADCAST_PORT) as servers:
+            best, entries = servers.choose()
+    except OSError as e:
+        print(f"{ac.RED}An error occurred while listening to offers: {e}{ac.RESET}")
+        return None
+    for entry in entries:
+        print(f"  {entry.describe()}")
+    return best.udp_port, best.tcp_port, best.address
 
 
 def validate_offer(message):
-    if len(message) < 8:  # בודקים שהמבנה מינימלי
-        return False
-    try:
-        cookie, msg_type, _, _ = struct.unpack("!I B H H", message)
-        return (cookie == MAGIC_COOKIE) and (msg_type == MESSAGE_TYPE)
-    except:
-        return False
+    return protocol.decode_offer(message) is not None
 
 
 # ===== שלב 3: ביצוע בדיקות ה-TCP וה-UDP =====
 def perform_tests(file_size, tcp_conns, udp_conns, udp_port, tcp_port, server_ip):
     print(f"{ac.GREEN}Starting speed tests...{ac.RESET}")
+    threads = []
 
     # בדיקת TCP
     if tcp_conns > 0:
@@ -116,6 +104,7 @@ def perform_tests(file_size, tcp_conns, udp_conns, udp_port, tcp_port, server_ip
                 args=(file_size, tcp_port, server_ip, i+1)
             )
             thr.start()
+            threads.append(thr)
 
     # בדיקת UDP
     if udp_conns > 0:
@@ -127,36 +116,30 @@ def perform_tests(file_size, tcp_conns, udp_conns, udp_port, tcp_port, server_ip
                 args=(file_size, udp_port, server_ip, i+1)
             )
             thr.start()
+            threads.append(thr)
 
-    print(f"{ac.GREEN}All tests have been initiated. Check logs above for details.{ac.RESET}")
+    for thr in threads:
+        thr.join()
+    print(f"{ac.GREEN}All tests have finished.{ac.RESET}")
 
 
 # === פונקציית עזר לבניית הודעת בקשה (מתקבלת ע"י השרת) ===
-def create_request_packet(file_size):
-    # כאן 3 השדות: magic_cookie, message_type, file_size
-    return struct.pack("!I B Q", MAGIC_COOKIE, MESSAGE_TYPE, file_size)
+def create_request_packet(file_size, bitrate=0, segment_size=0):
+    # השדות: magic_cookie, message_type, file_size, bitrate, segment_size
+    return protocol.encode_request(file_size, bitrate, segment_size)
 
 
 # === פונקציית עזר לפענוח הנתונים שמגיעים מהשרת (לפי הפורמט) ===
 def decode_payload(data):
-    try:
-        header_part = data[:PAYLOAD_HEADER_SIZE]
-        cookie, msg_type, total_segs, current_seg = struct.unpack(PAYLOAD_FMT, header_part)
-        payload = data[PAYLOAD_HEADER_SIZE:]
-        if cookie != MAGIC_COOKIE or msg_type != RESPONSE_MESSAGE_TYPE:
-            # הודעה לא תקינה/שגויה
-            return None
-        return total_segs, current_seg, payload
-    except struct.error as err:
-        print(f"{ac.RED}Error decoding server payload: {err}{ac.RESET}")
-        return None
+    # מחזיר (total_segments, current_segment, payload) או None להודעה לא תקינה
+    return protocol.decode_payload(data)
 
 
 # === Test Functions (TCP) ===
 def run_tcp_download(file_size, tcp_port, server_ip, conn_id):
     request = create_request_packet(file_size)
 
-    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as tcp_sock:
+    with socketTuning.tune_tcp(socket.socket(socket.AF_INET, socket.SOCK_STREAM)) as tcp_sock:
         tcp_sock.settimeout(TCP_TIMEOUT)
         try:
             print(f"[TCP-{conn_id}] Connecting to {server_ip}:{tcp_port}...")
@@ -164,23 +147,13 @@ def run_tcp_download(file_size, tcp_port, server_ip, conn_id):
             print(f"[TCP-{conn_id}] Connected. Sending request...")
             tcp_sock.sendall(request)
 
-            total_received = 0
             # כל עוד לא קיבלנו את כל הבייטים
-            while total_received < file_size:
-                data = tcp_sock.recv(TCP_PAYLOAD_SIZE + PAYLOAD_HEADER_SIZE)
-                if not data:
-                    print(f"[TCP-{conn_id}] Server closed the connection unexpectedly.")
-                    break
-
-                decoded = decode_payload(data)
-                if decoded is None:
-                    continue
-
-                _, _, payload = decoded
-                total_received += len(payload)
-                print(f"[TCP-{conn_id}] Received {total_received}/{file_size} bytes.")
+            total_received = receiver.receive_stream(tcp_sock, file_size)
+            if total_received < file_size:
+                print(f"[TCP-{conn_id}] Server closed the connection unexpectedly.")
 
             print(f"[TCP-{conn_id}] Download complete! Total bytes: {total_received}")
+            print(f"[TCP-{conn_id}] Socket: {socketTuning.describe(tcp_sock)}")
 
         except socket.timeout:
             print(f"[TCP-{conn_id}] Connection timed out after {TCP_TIMEOUT} seconds.")
@@ -189,48 +162,51 @@ def run_tcp_download(file_size, tcp_port, server_ip, conn_id):
 
 
 # === Test Functions (UDP) ===
-def run_udp_speed_test(file_size, udp_port, server_ip, conn_id):
-    packet = create_request_packet(file_size)
+def run_udp_speed_test(file_size, udp_port, server_ip, conn_id, segment_size=UDP_PAYLOAD_SIZE):
+    segment_size = udpSender.clamp_segment_size(segment_size)
+    packet = create_request_packet(file_size, segment_size=segment_size)
 
-    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as udp_sock:
+    with socketTuning.tune_udp(socket.socket(socket.AF_INET, socket.SOCK_DGRAM)) as udp_sock:
         udp_sock.settimeout(UDP_TIMEOUT)
 
         try:
-            start = time.time()
+            start = time.perf_counter()
             print(f"[UDP-{conn_id}] Sending request to {server_ip}:{udp_port}...")
             udp_sock.sendto(packet, (server_ip, udp_port))
 
-            segments_received = {}
-            total_segments = None
+            tracker = None
+            total_downloaded = 0
+            # השרת לא שולח סגמנטים גדולים מהגודל שביקשנו
+            buffer = receiver.allocate_buffer(segment_size + PAYLOAD_HEADER_SIZE)
 
             with tqdm(total=file_size, unit='B', unit_scale=True, desc=f"[UDP-{conn_id}] Downloading") as pbar:
                 while True:
-                    response, addr = udp_sock.recvfrom(UDP_PAYLOAD_SIZE + PAYLOAD_HEADER_SIZE)
+                    response, addr = receiver.receive_datagram(udp_sock, buffer)
                     decoded = decode_payload(response)
                     if decoded is None:
                         continue
 
                     t_segments, current_seg, payload_data = decoded
                     # אם עדיין לא הכרנו את כמות הסגמנטים, נשמור אותה
-                    if total_segments is None:
-                        total_segments = t_segments
+                    if tracker is None:
+                        tracker = SegmentTracker(t_segments)
 
-                    # שומרים רק סגמנטים חדשים
-                    if current_seg not in segments_received:
-                        segments_received[current_seg] = payload_data
+                    # סופרים רק סגמנטים חדשים
+                    if tracker.add(current_seg):
+                        total_downloaded += len(payload_data)
                         pbar.update(len(payload_data))
-                    if len(segments_received) == total_segments:
+                    if tracker.complete:
                         break
 
-            end = time.time()
-            total_downloaded = sum(len(seg) for seg in segments_received.values())
+            end = time.perf_counter()
             duration = end - start
             speed_kb = (total_downloaded / duration) / 1024
 
-            print(f"[UDP-{conn_id}] Received {len(segments_received)}/{total_segments} segments.")
+            print(f"[UDP-{conn_id}] Segments: {tracker.summary()}")
             print(f"[UDP-{conn_id}] Total size: {total_downloaded} bytes.")
             print(f"[UDP-{conn_id}] Time elapsed: {duration:.2f} seconds.")
             print(f"[UDP-{conn_id}] Approx. speed: {speed_kb:.2f} KB/s")
+            print(f"[UDP-{conn_id}] Socket: {socketTuning.describe(udp_sock)}")
 
         except socket.timeout:
             print(f"[UDP-{conn_id}] No response within {UDP_TIMEOUT} seconds.")
@@ -0,0 +1,153 @@
+"""
+Server discovery: a live table of the servers whose offers this client hears.
+
+A Discovery listens for offers on a background thread and keeps one entry
+per server, which expires ttl seconds after its last offer. choose() waits
+a little to hear from every server, pings each on its UDP port, and picks
+the lowest-RTT server (or the least-loaded one, by the load servers
+advertise in their offers).
+"""
+import math
+import socket
+import statistics
+import threading
+import time
+
+import protocol
+
+DEFAULT_TTL = 3.0  # servers offer every second, so this survives two lost offers
+DEFAULT_WAIT = 1.5  # after the first offer, listen this long for the others
+PING_COUNT = 3
+PING_TIMEOUT = 0.2
+POLICIES = ("rtt", "load")
+
+
+class ServerEntry:
+    """One server heard from, with its latest offer and, once probed, its RTT."""
+
+    def __init__(self, address, offer):
+        self.address = address
+        self.tcp_port = offer.tcp_port
+        self.udp_port = offer.udp_port
+        self.load = offer.load
+        self.last_seen = time.monotonic()
+        self.rtt = None
+
+    def update(self, offer):
+        self.load = offer.load
+        self.last_seen = time.monotonic()
+
+    def describe(self):
+        load = "unknown" if self.load is None else self.load
+        rtt = "no answer" if self.rtt is None else f"{self.rtt * 1000:.3f} ms"
+        return f"{self.address}: UDP Port {self.udp_port}, TCP Port {self.tcp_port}, load {load}, RTT {rtt}"
+
+
+def ping(address, udp_port, count=PING_COUNT, timeout=PING_TIMEOUT):
+    """Return the median round-trip time in seconds of count pings to a server's UDP port, or None if none came back."""
+    samples = []
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.settimeout(timeout)
+        for _ in range(count):
+            token = time.perf_counter_ns()
+            sock.sendto(protocol.encode_ping(token), (address, udp_port))
+            try:
+                # Skip late pongs of earlier pings that timed out
+                while protocol.decode_pong(sock.recv(1024)) != token:
+                    pass
+            except socket.timeout:
+                continue
+            samples.append((time.perf_counter_ns() - token) / 1e9)
+    return statistics.median(samples) if samples else None
+
+
+class Discovery:
+    """Keeps the table of live servers from the offers broadcast to port."""
+
+    def __init__(self, port, ttl=DEFAULT_TTL):
+        self.port = port
+        self.ttl = ttl
+        self.entries = {}
+        self.lock = threading.Lock()
+        self.heard = threading.Event()
+        self.stopped = threading.Event()
+        self.sock = None
+        self.thread = threading.Thread(target=self.run, name="discovery", daemon=True)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def start(self):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        self.sock.bind(("", self.port))
+        self.sock.settimeout(0.5)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread.is_alive():
+            self.thread.join()
+        if self.sock is not None:
+            self.sock.close()
+
+    def run(self):
+        while not self.stopped.is_set():
+            try:
+                data, (address, _) = self.sock.recvfrom(1024)
+            except socket.timeout:
+                continue
+            except OSError:
+                break
+            offer = protocol.decode_offer(data)
+            if offer is None:
+                continue
+            key = (address, offer.tcp_port, offer.udp_port)
+            with self.lock:
+                entry = self.entries.get(key)
+                if entry is None:
+                    self.entries[key] = ServerEntry(address, offer)
+                else:
+                    entry.update(offer)
+            self.heard.set()
+
+    def live(self):
+        """Drop servers whose offers stopped ttl seconds ago and return the rest."""
+        expiry = time.monotonic() - self.ttl
+        with self.lock:
+            for key in [key for key, entry in self.entries.items() if entry.last_seen < expiry]:
+                del self.entries[key]
+            return list(self.entries.values())
+
+    def choose(self, wait=DEFAULT_WAIT, policy="rtt", timeout=None):
+        """
+        Wait for a first offer (up to timeout seconds, None for ever), listen wait seconds more, then ping every
+        live server and return (the best entry, all live entries); the entry is None only if timeout ran out.
+
+        "rtt" picks the lowest RTT and "load" the fewest sessions, each breaking
+        ties with the other. Servers that do not answer pings only win if none do.
+        If every server heard has expired by then, keep waiting for the next offer.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            if not self.heard.wait(None if deadline is None else max(deadline - time.monotonic(), 0)):
+                return None, []
+            time.sleep(wait)
+            entries = self.live()
+            if entries:
+                break
+            self.heard.clear()
+        for entry in entries:
+            entry.rtt = ping(entry.address, entry.udp_port)
+
+        def score(entry):
+            rtt = math.inf if entry.rtt is None else entry.rtt
+            load = math.inf if entry.load is None else entry.load
+            return (entry.rtt is None,) + ((load, rtt) if policy == "load" else (rtt, load))
+
+        return min(entries, key=score), entries
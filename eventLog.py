@@ -0,0 +1,126 @@
+"""
+Logging for the servers and clients.
+
+Records from every "speedtest.*" logger go through a queue to one background
+writer thread, so the threads that send and receive never block on terminal
+or file I/O. Per-packet events go through a Sampler, and hot loops test
+Sampler.enabled once up front so they do no logging work at all when debug is
+off.
+"""
+import atexit
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+import threading
+import time
+
+ROOT = "speedtest"
+FORMAT = "%(asctime)s %(levelname)-7s %(name)s: %(message)s"
+DEFAULT_LEVEL = logging.INFO
+
+_lock = threading.Lock()
+_listener = None
+_stream = None
+
+
+def _start(stream):
+    """Attach a QueueHandler to the root speedtest logger and start its writer thread."""
+    global _listener, _stream
+    records = queue.SimpleQueue()
+    writer = logging.StreamHandler(stream)
+    writer.setFormatter(logging.Formatter(FORMAT))
+    root = logging.getLogger(ROOT)
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(logging.handlers.QueueHandler(records))
+    root.propagate = False
+    _listener = logging.handlers.QueueListener(records, writer)
+    _listener.start()
+    _stream = stream
+
+
+def _restart_after_fork():
+    # The writer thread does not survive fork(); without a new one the child's queue would only grow
+    global _listener
+    if _listener is not None:
+        _listener = None
+        _start(_stream)
+
+
+def setup(level=None, stream=None):
+    """Start the background writer if needed and set the level ("DEBUG", logging.INFO, ...)."""
+    with _lock:
+        if _listener is None:
+            _start(stream or sys.stdout)
+    root = logging.getLogger(ROOT)
+    if level is not None:
+        root.setLevel(level.upper() if isinstance(level, str) else level)
+    elif root.level == logging.NOTSET:
+        root.setLevel(DEFAULT_LEVEL)
+
+
+def shutdown():
+    """Flush queued records and stop the writer thread."""
+    global _listener
+    with _lock:
+        if _listener is not None:
+            _listener.stop()
+            _listener = None
+
+
+def get_logger(name):
+    """Return the logger for one module, starting the writer on first use."""
+    if _listener is None:
+        setup()
+    return logging.getLogger(f"{ROOT}.{name}")
+
+
+class Sampler:
+    """
+    Keeps a per-packet event from flooding the log.
+
+    With every=N one event in N is logged; otherwise at most one event is
+    logged per interval seconds. Each logged record reports how many events
+    were skipped since the previous one.
+    """
+
+    def __init__(self, logger, interval=1.0, every=0, level=logging.DEBUG):
+        self.logger = logger
+        self.interval = interval
+        self.every = every
+        self.level = level
+        self.skipped = 0
+        self.next_time = 0.0
+
+    @property
+    def enabled(self):
+        return self.logger.isEnabledFor(self.level)
+
+    def event(self, message, *args):
+        if self.every:
+            due = self.skipped + 1 >= self.every
+        else:
+            now = time.monotonic()
+            due = now >= self.next_time
+            if due:
+                self.next_time = now + self.interval
+        if not due:
+            self.skipped += 1
+            return
+        if self.skipped:
+            message += f" ({self.skipped} similar events skipped)"
+            self.skipped = 0
+        self.logger.log(self.level, message, *args)
+
+
+def add_arguments(parser):
+    """Add the shared --log_level option to an argparse parser."""
+    parser.add_argument("--log_level", default="INFO", choices=["DEBUG", "INFO", "WARNING", "ERROR"],
+                        help="Log level; DEBUG adds sampled per-packet events.")
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_restart_after_fork)
+atexit.register(shutdown)
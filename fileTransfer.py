@@ -0,0 +1,275 @@
+"""
+Real files over TCP: the server sends files from its directory, the client streams them to disk.
+
+The server sends with sendfile(), so file pages go from the page cache to
+the socket without a copy in Python, and tells the kernel how it will read:
+POSIX_FADV_SEQUENTIAL for the whole file, and POSIX_FADV_WILLNEED for the
+next READAHEAD bytes ahead of where it is sending. Where os.sendfile() is
+missing the file is mapped with mmap and sent from the mapping instead.
+
+The client never holds the file in memory: a FileSink gathers what arrives
+into one WRITE_BUFFER-sized buffer and writes it with os.pwrite() at its
+offset in the file, so several connections of a split download can write
+their ranges into the same file at once. Time spent writing is measured on
+its own, so reports can tell network throughput from disk throughput.
+"""
+import mmap
+import os
+import threading
+import time
+
+import eventLog
+import protocol
+import tcpSender
+
+READAHEAD = 8 * 1024 * 1024
+SEND_CHUNK = 4 * 1024 * 1024  # bytes per sendfile() call
+WRITE_BUFFER = 4 * 1024 * 1024
+
+log = eventLog.get_logger("fileTransfer")
+
+
+def _advise(fd, offset, length, advice):
+    if hasattr(os, "posix_fadvise"):
+        try:
+            os.posix_fadvise(fd, offset, length, advice)
+        except OSError:
+            pass
+
+
+def resolve(directory, name):
+    """The path of name inside directory, or None if it is not a regular file in there (no escaping with ..)."""
+    if directory is None:
+        return None
+    root = os.path.realpath(directory)
+    path = os.path.realpath(os.path.join(root, name))
+    if os.path.commonpath([root, path]) != root or not os.path.isfile(path):
+        return None
+    return path
+
+
+class ServedFile:
+    """A file opened for sending, with its size; send() streams byte ranges of it to a socket."""
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, "rb")
+        self.size = os.fstat(self.file.fileno()).st_size
+        self.map = None
+        self.advised_to = 0
+        if hasattr(os, "POSIX_FADV_SEQUENTIAL"):
+            _advise(self.file.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+
+    def fileno(self):
+        return self.file.fileno()
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+        self.file.close()
+
+    def _read_ahead(self, position):
+        """Ask for the next READAHEAD bytes once sending gets within half of that of what was asked for."""
+        if not hasattr(os, "POSIX_FADV_WILLNEED") or position < self.advised_to - READAHEAD // 2:
+            return
+        start = max(position, self.advised_to)
+        _advise(self.file.fileno(), start, READAHEAD, os.POSIX_FADV_WILLNEED)
+        self.advised_to = start + READAHEAD
+
+    def _send_mapped(self, sock, position, count):
+        if self.map is None:
+            self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        with memoryview(self.map) as view:
+            sock.sendall(view[position:position + count])
+        return count
+
+    def send(self, sock, offset, length, pacer=None):
+        """
+        Send length bytes from offset (clipped to the file) to a connected TCP socket; pacer works as in tcpSender.
+
+        :return: bytes sent
+        """
+        length = max(0, min(length, self.size - offset))
+        if not self.advised_to - READAHEAD <= offset <= self.advised_to:
+            self.advised_to = offset  # a range elsewhere in the file: read ahead from there
+        sent = 0
+        while sent < length:
+            position = offset + sent
+            count = min(SEND_CHUNK, length - sent)
+            if pacer is not None:
+                count = min(count, pacer.burst)
+            self._read_ahead(position)
+            if hasattr(os, "sendfile"):
+                done = sock.sendfile(self.file, position, count)
+            else:
+                done = self._send_mapped(sock, position, count)
+            if done == 0:
+                break
+            sent += done
+            if pacer is not None:
+                pacer.consume(done)
+        return sent
+
+
+def read_file_request(sock, data):
+    """
+    Read the name that follows a file request; data is what was read so far, starting with the request.
+
+    :return: (name, bytes read after the name), or None if the client closed or sent a bad name
+    """
+    data = data[protocol.REQUEST.size:]
+    try:
+        while True:
+            named = protocol.decode_file_name(data)
+            if named is not None:
+                return named
+            more = sock.recv(1024)
+            if not more:
+                return None
+            data += more
+    except ValueError:
+        return None
+
+
+def serve_file(sock, request, data, directory, pacer=None):
+    """
+    Answer a file request on a blocking TCP socket from directory (None serves no files).
+
+    Sends the file message, then the requested bytes; with FLAG_RANGE it goes
+    on answering the range requests that follow until the client closes.
+
+    :return: (bytes sent, elapsed seconds)
+    """
+    start = time.perf_counter()
+    named = read_file_request(sock, data)
+    if named is None:
+        return 0, 0.0
+    name, data = named
+    path = resolve(directory, name)
+    if path is None:
+        status = protocol.FILE_NOT_SERVED if directory is None else protocol.FILE_NOT_FOUND
+        log.info("File %r not served: %s", name, "no directory" if directory is None else "not found")
+        sock.sendall(protocol.encode_file(status))
+        return 0, 0.0
+    served = ServedFile(path)
+    try:
+        sock.sendall(protocol.encode_file(protocol.FILE_OK, served.size))
+        if request.flags & protocol.FLAG_RANGE:
+            sent = served.send(sock, request.offset, request.file_size, pacer)
+            for more in tcpSender.range_requests(sock, data):
+                sent += served.send(sock, more.offset, more.file_size, pacer)
+        else:
+            sent = served.send(sock, request.offset, request.file_size or served.size, pacer)
+    finally:
+        served.close()
+    elapsed = time.perf_counter() - start
+    log.info("File %s: %s", name, tcpSender.format_rate(sent, elapsed))
+    return sent, elapsed
+
+
+def read_file_answer(sock):
+    """Read the server's file message; returns (status, size), or None if the connection ended first."""
+    data = b""
+    while len(data) < protocol.FILE.size:
+        more = sock.recv(protocol.FILE.size - len(data))
+        if not more:
+            return None
+        data += more
+    return protocol.decode_file(data)
+
+
+def describe_status(status):
+    return {protocol.FILE_NOT_FOUND: "not found on the server",
+            protocol.FILE_NOT_SERVED: "the server does not serve files"}.get(status, f"refused (status {status})")
+
+
+def open_output(path, size):
+    """Create (or truncate) the output file at its final size and return its descriptor."""
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        if hasattr(os, "posix_fallocate") and size:
+            try:
+                os.posix_fallocate(fd, 0, size)
+            except OSError:
+                os.ftruncate(fd, size)
+        else:
+            os.ftruncate(fd, size)
+    except OSError:
+        os.close(fd)
+        raise
+    return fd
+
+
+class FileSink:
+    """
+    A receive sink (see receiver.receive_stream) writing the bytes into fd from offset on with os.pwrite().
+
+    Call seek() before each range of a split download and finish() after the last bytes.
+    """
+
+    _lock = threading.Lock()  # for the seek-and-write fallback where there is no os.pwrite()
+
+    def __init__(self, fd, offset=0, buffer_size=WRITE_BUFFER):
+        self.fd = fd
+        self.buffer = bytearray(buffer_size)
+        self.view = memoryview(self.buffer)
+        self.filled = 0
+        self.offset = offset  # where the buffered bytes go
+        self.written = 0
+        self.writes = 0
+        self.elapsed_ns = 0
+
+    def seek(self, offset):
+        self.flush()
+        self.offset = offset
+
+    def finish(self):
+        """Write out what is still buffered; call after the last bytes."""
+        self.flush()
+
+    def __call__(self, view):
+        position = 0
+        length = len(view)
+        while position < length:
+            take = min(length - position, len(self.buffer) - self.filled)
+            self.view[self.filled:self.filled + take] = view[position:position + take]
+            self.filled += take
+            position += take
+            if self.filled == len(self.buffer):
+                self.flush()
+
+    def flush(self):
+        start = time.perf_counter_ns()
+        done = 0
+        while done < self.filled:
+            done += self._write(self.view[done:self.filled], self.offset + done)
+            self.writes += 1
+        self.offset += self.filled
+        self.written += self.filled
+        self.filled = 0
+        self.elapsed_ns += time.perf_counter_ns() - start
+
+    def _write(self, data, offset):
+        if hasattr(os, "pwrite"):
+            return os.pwrite(self.fd, data, offset)
+        with self._lock:
+            os.lseek(self.fd, offset, os.SEEK_SET)
+            return os.write(self.fd, data)
+
+    @property
+    def seconds(self):
+        return self.elapsed_ns / 1e9
+
+    def summary(self, received, transfer_seconds):
+        """One line: network throughput with the time spent writing taken out, and disk throughput."""
+        network_seconds = max(transfer_seconds - self.seconds, 1e-9)
+        disk = self.written / self.seconds if self.elapsed_ns else 0.0
+        return (f"network {received * 8 / network_seconds:.2f} bits/second over {network_seconds:.2f} seconds; "
+                f"disk {disk:,.0f} bytes/second, {self.written} bytes in {self.writes} writes taking {self.seconds:.2f} seconds")
+
+
+def sync(fd):
+    """fsync the output file; returns the seconds it took, which count as disk time."""
+    start = time.perf_counter()
+    os.fsync(fd)
+    return time.perf_counter() - start
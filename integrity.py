@@ -0,0 +1,152 @@
+"""
+Integrity checks for seeded payloads (protocol.FLAG_RANDOM).
+
+Both ends derive the payload from the seed in the request, so the client
+knows every byte it should get and where. StreamVerifier checks a TCP
+stream block by block (VERIFY_BLOCK bytes of the logical file) with a
+running CRC32, so the received data is never copied; SegmentVerifier checks
+each UDP segment against the segment its header numbers.
+
+A block or segment whose CRC does not match is misplaced when its bytes
+belong somewhere else in the pattern (an offset or ordering bug) and
+corrupted otherwise. The time spent checking is measured on its own, so a
+report can show how much of the transfer time verification took.
+"""
+import functools
+import time
+import zlib
+
+import payloadSource
+
+VERIFY_BLOCK = 64 * 1024  # divides payloadSource.PATTERN_SIZE, so blocks never wrap around the pattern
+NS_PER_MS = 1000000
+
+
+@functools.lru_cache(maxsize=payloadSource.MAX_CACHED_PATTERNS)
+def block_crcs(seed):
+    """The CRC32 of every VERIFY_BLOCK-aligned block of the pattern of seed, in order."""
+    pattern = memoryview(payloadSource.pattern(seed))
+    return tuple(zlib.crc32(pattern[start:start + VERIFY_BLOCK])
+                 for start in range(0, payloadSource.PATTERN_SIZE, VERIFY_BLOCK))
+
+
+def _overhead(checked_bytes, elapsed_ns, transfer_seconds):
+    rate = checked_bytes / (elapsed_ns / 1e9) if elapsed_ns else 0.0
+    share = f", {elapsed_ns / 1e9 / transfer_seconds * 100:.1f}% of the transfer" if transfer_seconds else ""
+    return f"CRC32 of {checked_bytes} bytes took {elapsed_ns / NS_PER_MS:.1f} ms ({rate:,.0f} bytes/second{share})"
+
+
+class StreamVerifier:
+    """
+    A receive sink (see receiver.receive_stream) checking a TCP stream of seed's payload from offset on.
+
+    Call seek() before each range of a range download, and finish() after
+    the last bytes so a trailing partial block is checked too.
+    """
+
+    def __init__(self, seed, offset=0):
+        self.seed = seed
+        self.pattern = memoryview(payloadSource.pattern(seed))
+        self.expected = block_crcs(seed)
+        self.phases = {crc: phase for phase, crc in enumerate(self.expected)}
+        self.blocks = 0
+        self.corrupted = 0
+        self.misplaced = 0
+        self.checked_bytes = 0
+        self.elapsed_ns = 0
+        self.crc = 0
+        self.offset = self.block_start = self.block_end = offset
+        self.seek(offset)
+
+    def seek(self, offset):
+        """Check what was received of the current block, then expect the bytes at offset next."""
+        self._check()
+        self.offset = self.block_start = offset
+        self.block_end = (offset // VERIFY_BLOCK + 1) * VERIFY_BLOCK
+
+    def finish(self):
+        self._check()
+
+    def __call__(self, view):
+        start = time.perf_counter_ns()
+        position = 0
+        length = len(view)
+        while position < length:
+            take = min(length - position, self.block_end - self.offset)
+            self.crc = zlib.crc32(view[position:position + take], self.crc)
+            position += take
+            self.offset += take
+            if self.offset == self.block_end:
+                self._check()
+                self.block_start = self.offset
+                self.block_end = self.offset + VERIFY_BLOCK
+        self.checked_bytes += length
+        self.elapsed_ns += time.perf_counter_ns() - start
+
+    def _check(self):
+        length = self.offset - self.block_start
+        if not length:
+            return
+        phase, start = divmod(self.block_start % payloadSource.PATTERN_SIZE, VERIFY_BLOCK)
+        if length == VERIFY_BLOCK:
+            expected = self.expected[phase]
+        else:
+            position = phase * VERIFY_BLOCK + start
+            expected = zlib.crc32(self.pattern[position:position + length])
+        self.blocks += 1
+        if self.crc != expected:
+            # Only a whole block can be recognised as another block of the pattern
+            if length == VERIFY_BLOCK and self.crc in self.phases:
+                self.misplaced += 1
+            else:
+                self.corrupted += 1
+        self.crc = 0
+        self.block_start = self.offset
+
+    def summary(self, transfer_seconds=0):
+        """One line: blocks checked, corrupted and misplaced, and what checking cost."""
+        return (f"seed {self.seed}, {self.blocks} blocks of up to {VERIFY_BLOCK // 1024} KiB checked, "
+                f"{self.corrupted} corrupted, {self.misplaced} misplaced; "
+                f"{_overhead(self.checked_bytes, self.elapsed_ns, transfer_seconds)}")
+
+
+class SegmentVerifier:
+    """Checks UDP segments of seed's payload, segment_size bytes each, by the segment number in their header."""
+
+    def __init__(self, seed, segment_size):
+        self.seed = seed
+        self.segment_size = segment_size
+        self.source = payloadSource.seeded(2 ** 63 - 1, seed)
+        self.expected = {}  # (phase in the pattern, length) -> CRC32, filled in as segments arrive
+        self.doubled = None
+        self.segments = 0
+        self.corrupted = 0
+        self.misplaced = 0
+        self.checked_bytes = 0
+        self.elapsed_ns = 0
+
+    def check(self, segment, data):
+        """Check one segment's data; returns True if it is what the segment should hold."""
+        start = time.perf_counter_ns()
+        offset = segment * self.segment_size
+        key = (offset % payloadSource.PATTERN_SIZE, len(data))
+        expected = self.expected.get(key)
+        if expected is None:
+            expected = self.expected[key] = zlib.crc32(self.source.view(offset, len(data)))
+        valid = zlib.crc32(data) == expected
+        if not valid:
+            if self.doubled is None:
+                self.doubled = self.source.buffer.tobytes()
+            if self.doubled.find(data) >= 0:
+                self.misplaced += 1
+            else:
+                self.corrupted += 1
+        self.segments += 1
+        self.checked_bytes += len(data)
+        self.elapsed_ns += time.perf_counter_ns() - start
+        return valid
+
+    def summary(self, transfer_seconds=0):
+        """One line: segments checked, corrupted and misplaced, and what checking cost."""
+        return (f"seed {self.seed}, {self.segments} segments checked, {self.corrupted} corrupted, "
+                f"{self.misplaced} misplaced; {_overhead(self.checked_bytes, self.elapsed_ns, transfer_seconds)}")
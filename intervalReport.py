@@ -0,0 +1,154 @@
+"""
+iperf-style interval reports for client transfers.
+
+Receive loops only bump plain attributes on their TransferCounters; an
+IntervalReporter thread samples every registered connection once per interval
+and prints one line per connection plus a [SUM] line for all of them.
+
+UDP jitter is the RFC 3550 interarrival jitter, J += (|D| - J) / 16, where D
+is the change in transit time (arrival minus the sender's timestamp) between
+consecutive datagrams. The delay variation is how far a datagram's transit
+time was above the smallest one seen on its connection. Neither depends on
+the two clocks agreeing.
+"""
+import threading
+import time
+
+DEFAULT_INTERVAL = 1.0
+NS_PER_MS = 1000000
+
+
+class TransferCounters:
+    """Counters for one connection, written by its receive loop and sampled by the reporter."""
+
+    def __init__(self, name):
+        self.name = name
+        self.bytes = 0
+        self.packets = 0
+        self.tracker = None  # the SegmentTracker of a UDP transfer, once its first datagram arrives
+        self.jitter_ns = 0.0
+        self.max_delay_variation_ns = 0
+        self.min_transit = None
+        self.last_transit = None
+        self.done = False
+
+    def arrival(self, sent_ns, arrival_ns):
+        """Update jitter and delay variation for one datagram."""
+        transit = arrival_ns - sent_ns
+        if self.last_transit is not None:
+            change = transit - self.last_transit
+            self.jitter_ns += (abs(change) - self.jitter_ns) / 16
+        else:
+            self.min_transit = transit
+        self.last_transit = transit
+        if transit < self.min_transit:
+            self.min_transit = transit
+        elif transit - self.min_transit > self.max_delay_variation_ns:
+            self.max_delay_variation_ns = transit - self.min_transit
+
+    def expected(self):
+        """Segments the sender has sent so far, as far as this receiver can tell."""
+        if self.tracker is None:
+            return 0
+        return self.tracker.total_segments if self.done else self.tracker.highest + 1
+
+    def snapshot(self):
+        received = self.tracker.received if self.tracker is not None else 0
+        return self.bytes, self.packets, received, self.expected()
+
+
+def format_bytes(nbytes):
+    for unit in ("Bytes", "KBytes", "MBytes"):
+        if nbytes < 1024:
+            return f"{nbytes:.2f} {unit}" if unit != "Bytes" else f"{nbytes:.0f} {unit}"
+        nbytes /= 1024
+    return f"{nbytes:.2f} GBytes"
+
+
+def format_bits(bits_per_second):
+    for unit in ("bits/sec", "Kbits/sec", "Mbits/sec"):
+        if bits_per_second < 1000:
+            return f"{bits_per_second:.2f} {unit}"
+        bits_per_second /= 1000
+    return f"{bits_per_second:.2f} Gbits/sec"
+
+
+class IntervalReporter:
+    """Prints per-connection and aggregate throughput, jitter and loss every interval seconds."""
+
+    def __init__(self, interval=DEFAULT_INTERVAL, output=print):
+        self.interval = interval
+        self.output = output
+        self.connections = []
+        self.previous = {}
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="interval-reporter", daemon=True)
+        self.start_time = self.last_time = time.perf_counter()
+
+    def add(self, name):
+        """Register a connection and return the counters its receive loop should update."""
+        return self.register(TransferCounters(name))
+
+    def register(self, counters):
+        """Register counters kept some other way (a TransferCounters subclass) and return them."""
+        with self.lock:
+            self.connections.append(counters)
+            self.previous[id(counters)] = (0, 0, 0, 0)
+        return counters
+
+    def start(self):
+        self.start_time = self.last_time = time.perf_counter()
+        self.thread.start()
+        return self
+
+    def run(self):
+        next_report = self.start_time + self.interval
+        while not self.stopped.wait(max(0.0, next_report - time.perf_counter())):
+            self.report(next_report)
+            next_report += self.interval
+
+    def stop(self):
+        """Stop the reporter and print the last, possibly partial, interval."""
+        self.stopped.set()
+        if self.thread.is_alive():
+            self.thread.join()
+        now = time.perf_counter()
+        if now - self.last_time > self.interval / 10:
+            self.report(now)
+
+    def report(self, now):
+        begin, end = self.last_time - self.start_time, now - self.start_time
+        duration = max(now - self.last_time, 1e-9)
+        self.last_time = now
+        with self.lock:
+            connections = list(self.connections)
+        totals = [0, 0, 0, 0]
+        jitters = []
+        for counters in connections:
+            current = counters.snapshot()
+            previous = self.previous[id(counters)]
+            self.previous[id(counters)] = current
+            delta = [a - b for a, b in zip(current, previous)]
+            totals = [a + b for a, b in zip(totals, delta)]
+            if counters.tracker is not None:
+                jitters.append(counters.jitter_ns)
+            self.output(self.format_line(counters.name, begin, end, duration, delta, counters))
+            counters.max_delay_variation_ns = 0
+        if len(connections) > 1:
+            self.output(self.format_line("SUM", begin, end, duration, totals, None, jitters))
+
+    @staticmethod
+    def format_line(name, begin, end, duration, delta, counters, jitters=None):
+        nbytes, packets, received, expected = delta
+        line = (f"[{name:>6}] {begin:6.2f}-{end:6.2f} sec  {format_bytes(nbytes):>13}  "
+                f"{format_bits(nbytes * 8 / duration):>16}")
+        if counters is not None and counters.tracker is not None:
+            line += (f"  jitter {counters.jitter_ns / NS_PER_MS:.3f} ms"
+                     f"  delay var {counters.max_delay_variation_ns / NS_PER_MS:.3f} ms")
+        elif jitters:
+            line += f"  jitter {sum(jitters) / len(jitters) / NS_PER_MS:.3f} ms"
+        if expected:
+            lost = max(0, expected - received)
+            line += f"  lost {lost}/{expected} ({lost / expected:.1%})"
+        return line
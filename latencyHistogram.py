@@ -0,0 +1,85 @@
+"""
+Log-bucketed latency histogram with bounded memory, in the style of HdrHistogram.
+
+Values (nanoseconds) below 2 * SUB_BUCKETS get a bucket each; above that,
+every power of two is split into SUB_BUCKETS linear buckets, so a recorded
+value is off by at most 1 / SUB_BUCKETS (about 3%) whatever its magnitude.
+The whole range up to 2**63 ns fits in under 2000 counters.
+"""
+SUB_BUCKET_BITS = 5
+SUB_BUCKETS = 1 << SUB_BUCKET_BITS
+BUCKET_COUNT = (64 - SUB_BUCKET_BITS + 1) << SUB_BUCKET_BITS
+REPORT_PERCENTILES = (50, 90, 99, 99.9)
+NS_PER_MS = 1000000
+
+
+def bucket_index(value):
+    if value < SUB_BUCKETS:
+        return value
+    shift = value.bit_length() - SUB_BUCKET_BITS - 1
+    return ((shift + 1) << SUB_BUCKET_BITS) + (value >> shift) - SUB_BUCKETS
+
+
+def bucket_upper(index):
+    """The largest value that falls into bucket index."""
+    group = index >> SUB_BUCKET_BITS
+    if group < 2:
+        return index
+    shift = group - 1
+    return ((SUB_BUCKETS + (index & (SUB_BUCKETS - 1)) + 1) << shift) - 1
+
+
+class LatencyHistogram:
+    """Counts of latency samples in nanoseconds; percentiles are reported as their bucket's upper bound."""
+
+    def __init__(self):
+        self.counts = [0] * BUCKET_COUNT
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = 0
+
+    def record(self, value):
+        value = max(0, int(value))
+        self.counts[bucket_index(value)] += 1
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        for index, count in enumerate(other.counts):
+            if count:
+                self.counts[index] += count
+        self.count += other.count
+        self.total += other.total
+        if other.min is not None and (self.min is None or other.min < self.min):
+            self.min = other.min
+        self.max = max(self.max, other.max)
+
+    def percentile(self, percent):
+        """The value percent of the samples are at or below (0 if there are none)."""
+        if not self.count:
+            return 0
+        rank = max(1, -(-self.count * percent // 100))
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bucket_upper(index), self.max)
+        return self.max
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+    def summary(self, percentiles=REPORT_PERCENTILES):
+        """One line: count, min, mean, the given percentiles and max, in milliseconds."""
+        if not self.count:
+            return "no samples"
+        parts = [f"{self.count} samples", f"min {self.min / NS_PER_MS:.3f}", f"mean {self.mean / NS_PER_MS:.3f}"]
+        parts += [f"p{percent:g} {self.percentile(percent) / NS_PER_MS:.3f}" for percent in percentiles]
+        parts.append(f"max {self.max / NS_PER_MS:.3f} ms")
+        return ", ".join(parts)
@@ -0,0 +1,162 @@
+"""
+Latency tests: small pings echoed by the server, timed with perf_counter_ns.
+
+UDP pings go to the server's UDP port, which answers each with a pong. TCP
+pings go over one persistent connection that an echo request has turned
+into an echo service, with Nagle off at both ends. Pings are sent at a fixed
+rate whether or not earlier ones have come back, so one slow answer does
+not hide the delay of the pings queued behind it; rate 0 sends each ping as
+soon as the previous one is answered. A ping unanswered after timeout
+seconds counts as lost.
+"""
+import select
+import socket
+import time
+
+import admission
+import protocol
+import socketTuning
+from latencyHistogram import LatencyHistogram
+
+DEFAULT_COUNT = 1000
+DEFAULT_RATE = 100  # pings per second
+DEFAULT_TIMEOUT = 1.0
+MAX_UDP_PING_SIZE = 1024  # what the servers read of a datagram
+
+
+class UdpPinger:
+    """Pings the server's UDP port from a connected socket."""
+
+    def __init__(self, server_ip, udp_port, size=0):
+        self.size = min(max(size, protocol.PING.size), MAX_UDP_PING_SIZE)
+        self.sock = socketTuning.tune_udp(socket.socket(socket.AF_INET, socket.SOCK_DGRAM))
+        self.sock.connect((server_ip, udp_port))
+        self.sock.setblocking(False)
+
+    def send(self, token):
+        self.sock.send(protocol.encode_ping(token, self.size))
+
+    def receive(self, timeout):
+        """Wait up to timeout seconds for pongs and return the tokens of all that have arrived."""
+        tokens = []
+        if select.select([self.sock], [], [], timeout)[0]:
+            while True:
+                try:
+                    data = self.sock.recv(MAX_UDP_PING_SIZE)
+                except (BlockingIOError, ConnectionRefusedError):
+                    break
+                token = protocol.decode_pong(data)
+                if token is not None:
+                    tokens.append(token)
+        return tokens
+
+    def close(self):
+        self.sock.close()
+
+
+class TcpPinger:
+    """Pings over one TCP connection in echo mode; every ping comes back as the same size bytes."""
+
+    def __init__(self, server_ip, tcp_port, size=0):
+        self.size = max(size, protocol.PING.size)
+        # A first ping rides along with the request, so its echo (or a busy answer) shows the session was admitted
+        self.sock = admission.connect_when_admitted(server_ip, tcp_port,
+                                                    protocol.encode_echo_request() + protocol.encode_ping(0, self.size))
+        if self.sock is None:
+            raise ConnectionError("server busy")
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.data = b""
+        while len(self.data) < self.size:
+            more = self.sock.recv(self.size - len(self.data))
+            if not more:
+                self.sock.close()
+                raise ConnectionError("server closed the echo connection")
+            self.data += more
+        self.data = b""
+
+    def send(self, token):
+        self.sock.sendall(protocol.encode_ping(token, self.size))
+
+    def receive(self, timeout):
+        """Wait up to timeout seconds for echoes and return the tokens of every complete one."""
+        if not select.select([self.sock], [], [], timeout)[0]:
+            return []
+        more = self.sock.recv(64 * 1024)
+        if not more:
+            raise ConnectionError("server closed the echo connection")
+        data = self.data + more
+        whole = len(data) - len(data) % self.size
+        self.data = data[whole:]
+        return [protocol.decode_ping(data[i:i + self.size]) for i in range(0, whole, self.size)]
+
+    def close(self):
+        self.sock.close()
+
+
+def measure(pinger, count=DEFAULT_COUNT, rate=DEFAULT_RATE, timeout=DEFAULT_TIMEOUT):
+    """
+    Send count pings at rate per second (0 for one at a time) and time their answers.
+
+    Each ping carries its send time as its token, so answers are matched
+    without any bookkeeping on the server.
+
+    :return: (histogram of round-trip times in nanoseconds, pings sent)
+    """
+    histogram = LatencyHistogram()
+    interval = int(1e9 / rate) if rate else 0
+    timeout_ns = int(timeout * 1e9)
+    pending = {}  # tokens of unanswered pings, oldest first
+    sent = 0
+    next_send = time.perf_counter_ns()
+    while sent < count or pending:
+        now = time.perf_counter_ns()
+        while pending and next(iter(pending)) <= now - timeout_ns:
+            del pending[next(iter(pending))]
+        can_send = sent < count and (rate or not pending)
+        if can_send and now >= next_send:
+            pinger.send(now)
+            pending[now] = None
+            sent += 1
+            next_send = next_send + interval if rate else now
+            continue
+        wake = []
+        if pending:
+            wake.append(next(iter(pending)) + timeout_ns)
+        if can_send:
+            wake.append(next_send)
+        if not wake:
+            break
+        for token in pinger.receive(max(0, min(wake) - now) / 1e9):
+            arrival = time.perf_counter_ns()
+            if token in pending:
+                del pending[token]
+                histogram.record(arrival - token)
+    return histogram, sent
+
+
+def run(server_ip, tcp_port, udp_port, tcp=True, udp=True, count=DEFAULT_COUNT, rate=DEFAULT_RATE, size=0,
+        timeout=DEFAULT_TIMEOUT):
+    """Run the UDP and then the TCP latency test against a server and print a summary line for each."""
+    results = {}
+    for kind, enabled, make_pinger in (("UDP", udp, lambda: UdpPinger(server_ip, udp_port, size)),
+                                       ("TCP", tcp, lambda: TcpPinger(server_ip, tcp_port, size))):
+        if not enabled:
+            continue
+        try:
+            pinger = make_pinger()
+        except OSError as e:
+            print(f"{kind} latency test failed: {e}")
+            continue
+        try:
+            histogram, sent = measure(pinger, count, rate, timeout)
+            tuning = socketTuning.describe(pinger.sock)
+        except OSError as e:
+            print(f"{kind} latency test failed: {e}")
+            continue
+        finally:
+            pinger.close()
+        print(f"{kind} round trip to {server_ip} ({pinger.size}-byte pings): {histogram.summary()}, "
+              f"lost {sent - histogram.count}/{sent}")
+        print(f"{kind} socket: {tuning}")
+        results[kind.lower()] = histogram
+    return results
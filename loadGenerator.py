@@ -0,0 +1,198 @@
+"""
+Load generator: one client's connections spread across a pool of processes.
+
+In one process every receive loop shares the GIL, which caps what a single
+client can measure long before a fast server or link does. Here each worker
+process runs its share of the connections on a thread each, like
+main.start_client, and a publisher thread copies their TransferCounters
+into a multiprocessing.shared_memory table every PUBLISH_INTERVAL seconds,
+one row of FIELDS per connection. The receive loops still only bump plain
+attributes.
+
+The parent only reads the table: its IntervalReporter prints one line per
+process and a [SUM] line while the test runs, and the final report adds up
+every row. Start and end times are time.monotonic_ns(), one clock for all
+processes on the host. Each field is one aligned 8-byte word written by a
+single process, so it is read whole without a lock; the fields of a row can
+be one publish apart, which a report at that moment cannot tell anyway.
+"""
+import multiprocessing
+import os
+import sys
+import threading
+import time
+from multiprocessing import shared_memory
+
+import eventLog
+import intervalReport
+
+FIELDS = ("bytes", "packets", "received", "expected", "jitter_ns", "start_ns", "end_ns")
+BYTES, PACKETS, RECEIVED, EXPECTED, JITTER_NS, START_NS, END_NS = range(len(FIELDS))
+PUBLISH_INTERVAL = 0.1  # seconds
+
+log = eventLog.get_logger("loadGenerator")
+
+
+class SharedTable:
+    """rows rows of FIELDS unsigned 64-bit counters in shared memory; name attaches to an existing table."""
+
+    def __init__(self, rows, name=None):
+        if name is None:
+            self.memory = shared_memory.SharedMemory(create=True, size=max(rows, 1) * len(FIELDS) * 8)
+        else:
+            self.memory = shared_memory.SharedMemory(name=name)
+        self.values = self.memory.buf.cast("Q")
+        self.rows = rows
+
+    @property
+    def name(self):
+        return self.memory.name
+
+    def read(self, row):
+        start = row * len(FIELDS)
+        return self.values[start:start + len(FIELDS)].tolist()
+
+    def set(self, row, field, value):
+        self.values[row * len(FIELDS) + field] = value
+
+    def publish(self, row, counters):
+        """Copy one connection's TransferCounters into its row."""
+        nbytes, packets, received, expected = counters.snapshot()
+        start = row * len(FIELDS)
+        self.values[start + BYTES] = nbytes
+        self.values[start + PACKETS] = packets
+        self.values[start + RECEIVED] = received
+        self.values[start + EXPECTED] = expected
+        self.values[start + JITTER_NS] = int(counters.jitter_ns)
+
+    def close(self):
+        self.values.release()
+        self.memory.close()
+
+
+class SharedCounters(intervalReport.TransferCounters):
+    """Some rows of a SharedTable summed up, standing in for a process's connections in the parent's reporter."""
+
+    def __init__(self, name, table, rows):
+        super().__init__(name)
+        self.table = table
+        self.rows = rows
+
+    def snapshot(self):
+        totals = [0, 0, 0, 0]
+        for row in self.rows:
+            values = self.table.read(row)
+            totals = [total + value for total, value in zip(totals, values[:EXPECTED + 1])]
+        return tuple(totals)
+
+
+def _run_job(table, row, counters, target, args, kwargs):
+    table.set(row, START_NS, time.monotonic_ns())
+    try:
+        target(*args, counters=counters, **kwargs)
+    except Exception as e:
+        log.error("Load connection %s failed: %s", counters.name, e)
+    finally:
+        table.publish(row, counters)
+        table.set(row, END_NS, time.monotonic_ns())
+
+
+def _worker_main(table_name, rows, jobs):
+    table = SharedTable(rows, table_name)
+    sys.stdout = open(os.devnull, "w")  # the parent reports; a summary per connection would only interleave
+    counters = [intervalReport.TransferCounters(name) for _, name, _, _, _ in jobs]
+    stopped = threading.Event()
+
+    def publish():
+        while not stopped.wait(PUBLISH_INTERVAL):
+            for (row, _, _, _, _), job_counters in zip(jobs, counters):
+                table.publish(row, job_counters)
+
+    publisher = threading.Thread(target=publish, name="publisher", daemon=True)
+    publisher.start()
+    threads = [threading.Thread(target=_run_job, args=(table, row, job_counters, target, args, kwargs), daemon=True)
+               for (row, _, target, args, kwargs), job_counters in zip(jobs, counters)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    stopped.set()
+    publisher.join()
+    table.close()
+
+
+def _span(rows):
+    started = [row[START_NS] for row in rows if row[START_NS]]
+    ended = [row[END_NS] for row in rows if row[END_NS]]
+    if not started or not ended:
+        return 0.0
+    return max(max(ended) - min(started), 1) / 1e9
+
+
+def run(jobs, processes=None, interval=intervalReport.DEFAULT_INTERVAL):
+    """
+    Run jobs spread round-robin across processes (None for one per CPU) and print the aggregate report.
+
+    Each job is (name, target, args, kwargs), run as target(*args,
+    counters=counters, **kwargs) in a worker process, with target a
+    module-level function so it can be pickled. interval is seconds between
+    live reports, 0 for none.
+
+    :return: (bytes received by every connection, seconds from the first start to the last end)
+    """
+    processes = max(1, min(processes or os.cpu_count() or 1, len(jobs)))
+    groups = [list(range(first, len(jobs), processes)) for first in range(processes)]
+    table = SharedTable(len(jobs))
+    try:
+        workers = [multiprocessing.Process(target=_worker_main, name=f"load-{index + 1}", daemon=True,
+                                           args=(table.name, len(jobs), [(row,) + tuple(jobs[row]) for row in group]))
+                   for index, group in enumerate(groups)]
+        reporter = intervalReport.IntervalReporter(interval) if interval else None
+        if reporter:
+            for index, group in enumerate(groups):
+                reporter.register(SharedCounters(f"P-{index + 1}", table, group))
+            reporter.start()
+        for worker in workers:
+            worker.start()
+        try:
+            for worker in workers:
+                worker.join()
+        except KeyboardInterrupt:
+            for worker in workers:
+                worker.terminate()
+        finally:
+            if reporter:
+                reporter.stop()
+        for worker in workers:
+            if worker.exitcode:
+                print(f"Load process {worker.name} exited with code {worker.exitcode}")
+        rows = [table.read(row) for row in range(len(jobs))]
+    finally:
+        table.close()
+        table.memory.unlink()
+    return report(jobs, groups, rows)
+
+
+def report(jobs, groups, rows):
+    """Print one line per process and the aggregate; returns (total bytes, elapsed seconds)."""
+    for index, group in enumerate(groups):
+        group_rows = [rows[row] for row in group]
+        received = sum(row[BYTES] for row in group_rows)
+        seconds = _span(group_rows)
+        speed = received * 8 / seconds if seconds else 0.0
+        print(f"[P-{index + 1}] {len(group)} connections ({', '.join(jobs[row][0] for row in group)}), "
+              f"{received} bytes in {seconds:.2f} seconds, {speed:.2f} bits/second")
+    total = sum(row[BYTES] for row in rows)
+    elapsed = _span(rows)
+    unfinished = sum(1 for row in rows if not row[END_NS])
+    print(f"Load test over {len(jobs)} connections in {len(groups)} processes: {total} bytes in {elapsed:.2f} seconds, "
+          f"total speed: {total * 8 / elapsed if elapsed else 0.0:.2f} bits/second"
+          + (f", {unfinished} connections unfinished" if unfinished else ""))
+    udp = [row for row in rows if row[EXPECTED]]
+    if udp:
+        expected = sum(row[EXPECTED] for row in udp)
+        lost = sum(max(0, row[EXPECTED] - row[RECEIVED]) for row in udp)
+        jitter = sum(row[JITTER_NS] for row in udp) / len(udp)
+        print(f"Load test UDP: lost {lost}/{expected} ({lost / expected:.1%}), "
+              f"mean jitter {jitter / intervalReport.NS_PER_MS:.3f} ms")
+    return total, elapsed
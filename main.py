@@ -1,152 +1,716 @@
+import itertools
+import os
+import queue
 import socket
-import struct
 import threading
 import time
 
-MAGIC_COOKIE = 0xabcddcba
-OFFER_TYPE = 0x2
-REQUEST_TYPE = 0x3
-PAYLOAD_TYPE = 0x4
+import admission
+import asyncClient
+import discovery
+import eventLog
+import fileTransfer
+import integrity
+import intervalReport
+import latencyTest
+import loadGenerator
+import pacer
+import payloadSource
+import protocol
+import rangeDownload
+import receiver
+import socketTuning
+import tcpInfo
+import tcpSender
+import udpSender
+import workerPool
+from payloadSource import PayloadSource
+from segmentTracker import SegmentTracker
+
+UNLIMITED = 2 ** 63 - 1
+OPEN_ENDED_SEGMENTS = 64 * 1024  # initial tracker size for duration tests; it grows as segments arrive
+NACK_INTERVAL = 0.02  # seconds between nacks in reliable mode
+NACK_EVERY = 8  # ... or after this many arrivals; below half the smallest sender window, so the window never stalls
+RELIABLE_IDLE_TIMEOUT = 3
+DONE_WAIT = 0.5  # how long a finished reliable transfer waits for the server's datagram count
+RELIABLE_RECEIVE_BUFFER = 4 * 1024 * 1024  # the sender's window can only grow as far as this buffer absorbs bursts
+VERIFY_SEED = 1  # the payload seed --verify asks for when no --seed is given
+DEFAULT_FILE_SIZE = 1024 * 1024 * 1024  # without --file_size; a --duration test then has no byte cap
+
+log = eventLog.get_logger("main")
+_datagrams = eventLog.Sampler(log)
+
 
 # === SERVER CODE ===
-def broadcast_offer(udp_port, tcp_port):
-    """Broadcast UDP offer messages."""
+def broadcast_offer(udp_port, tcp_port, load=None):
+    """Broadcast UDP offer messages; load, if given, returns the session count to advertise."""
     with socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP) as sock:
         sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
-        message = struct.pack(">IBHH", MAGIC_COOKIE, OFFER_TYPE, udp_port, tcp_port)
         while True:
-            sock.sendto(message, ("<broadcast>", udp_port))
+            sock.sendto(protocol.encode_offer(udp_port, tcp_port, load() if load else None), ("<broadcast>", udp_port))
             time.sleep(1)
 
-def handle_tcp_connection(conn, file_data):
-    """Handle a TCP connection."""
+def handle_tcp_connection(conn, address, payload, gate, directory=None):
+    """Handle a TCP connection once gate (an Admission) lets it in; a client turned away gets a busy message."""
     try:
-        request = conn.recv(1024).decode().strip()
-        file_size = int(request)
-        conn.sendall(file_data[:file_size])
-    except (ValueError, IndexError):
-        conn.sendall(b"Invalid request")
+        socketTuning.tune_tcp(conn)
+        with gate.session(address[0], "tcp") as share:
+            if share is None:
+                conn.sendall(protocol.encode_busy(gate.retry_after_ms()))
+                tcpSender.linger(conn)
+            else:
+                with tcpInfo.sampled(conn) as info:
+                    serve_tcp_request(conn, payload, share.pacer, directory)
+                log.info("TCP path to %s: %s", address, info.summary())
     finally:
         conn.close()
 
-def handle_udp_connection(client_address, file_data, udp_socket):
-    """Send UDP packets to the client."""
-    total_segments = len(file_data) // 1024 + (1 if len(file_data) % 1024 != 0 else 0)
-    for segment in range(total_segments):
-        payload = file_data[segment * 1024:(segment + 1) * 1024]
-        message = struct.pack(">IBQQ", MAGIC_COOKIE, PAYLOAD_TYPE, total_segments, segment) + payload
-        udp_socket.sendto(message, client_address)
+def serve_tcp_request(conn, payload, bucket=None, directory=None):
+    """
+    Read one request from a TCP connection and send what it asks for, paced by bucket if given.
 
-def start_server(tcp_port, udp_port, file_size):
-    """Start the multi-threaded server."""
-    file_data = b"X" * file_size
-    print(f"Server started, listening on IP address {socket.gethostbyname(socket.gethostname())}")
-    threading.Thread(target=broadcast_offer, args=(udp_port, tcp_port), daemon=True).start()
+    File requests are served from directory; None serves no files.
+    """
+    data = conn.recv(1024)
+    request = protocol.parse_request(data)
+    if request is None:
+        conn.sendall(b"Invalid request")
+        return
+    if request.flags & protocol.FLAG_FILE:
+        sent, _ = fileTransfer.serve_file(conn, request, data, directory, bucket)
+    elif request.flags & protocol.FLAG_ECHO:
+        sent, _ = tcpSender.echo(conn, data[protocol.REQUEST.size:])
+    else:
+        data_file = tcpSender.payload_for(request, tcpSender.shared_payload(fill=b"X"))
+        if request.flags & protocol.FLAG_RANGE:
+            sent, _, _ = tcpSender.send_ranges(conn, data, data_file, limit=len(payload), pacer=bucket)
+        elif request.duration_ms:
+            sent, _ = tcpSender.send_for(conn, request.duration_ms / 1000, data_file, limit=request.file_size,
+                                         pacer=bucket)
+        else:
+            sent, _ = tcpSender.send_stream(conn, min(request.file_size, len(payload)), data_file, pacer=bucket)
+    workerPool.record("tcp_sessions")
+    workerPool.record("tcp_bytes", sent)
 
-    tcp_server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    tcp_server.bind(("", tcp_port))
-    tcp_server.listen(5)
+def handle_udp_connection(client_address, payload, udp_socket, request, inbox=None, bucket=None):
+    """
+    Send UDP packets to the client; inbox is a queue of the stop and nack messages it sends meanwhile.
 
-    udp_server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    udp_server.bind(("", udp_port))
+    bucket paces the session, by default at the bitrate it asked for.
+    """
+    feedback = None
+    if inbox is not None:
+        def feedback():
+            messages = []
+            while not inbox.empty():
+                messages.append(inbox.get_nowait())
+            return messages
+    if bucket is None:
+        bucket = pacer.make_pacer(request.bitrate)
+    segment_size, sent, size, elapsed = udpSender.send_response(udp_socket, client_address,
+                                                                payloadSource.for_request(request, payload), request,
+                                                                bucket, feedback)
+    workerPool.record("udp_sessions")
+    workerPool.record("udp_bytes", size)
+    log.info("UDP sent %d segments to %s, %s", sent, client_address[0], pacer.rate_report(size, elapsed, request.bitrate))
 
-    while True:
-        # Handle TCP connections
-        conn, addr = tcp_server.accept()
-        threading.Thread(target=handle_tcp_connection, args=(conn, file_data), daemon=True).start()
+def serve_udp(udp_server, payload, gate):
+    """
+    Answer UDP requests on udp_server; stop and nack messages go to the sender's running session.
+
+    UDP sessions are never queued: when gate (an Admission) is full the client gets a busy message at once.
+    """
+    sessions = {}
 
-        # Handle UDP requests
+    def run_session(client_address, request, inbox):
+        try:
+            with gate.session(client_address[0], "udp", request.bitrate, wait=False) as share:
+                if share is None:
+                    udp_server.sendto(protocol.encode_busy(gate.retry_after_ms()), client_address)
+                else:
+                    handle_udp_connection(client_address, payload, udp_server, request, inbox, share.pacer)
+        finally:
+            if sessions.get(client_address) is inbox:
+                del sessions[client_address]
+
+    while True:
         try:
             data, client_address = udp_server.recvfrom(1024)
-            threading.Thread(target=handle_udp_connection, args=(client_address, file_data, udp_server), daemon=True).start()
+            kind = protocol.peek_type(data)
+            if kind == protocol.PING_TYPE:
+                udp_server.sendto(protocol.encode_pong(data), client_address)
+                continue
+            if kind in (protocol.STOP_TYPE, protocol.NACK_TYPE):
+                inbox = sessions.get(client_address)
+                if inbox is not None:
+                    inbox.put(data)
+                continue
+            request = protocol.decode_request(data)
+            if request is not None:
+                inbox = sessions[client_address] = queue.SimpleQueue()
+                threading.Thread(target=run_session, args=(client_address, request, inbox), daemon=True).start()
         except socket.error:
             pass
 
+def serve(tcp_port, udp_port, file_size, reuse_port=False, max_sessions=0, max_queued=admission.DEFAULT_MAX_QUEUED,
+          egress_limit=0, directory=None):
+    """
+    Serve TCP and UDP requests until interrupted; reuse_port lets several processes share the ports.
+
+    At most max_sessions sessions run at once (0 for no cap), with up to
+    max_queued TCP connections waiting for a slot, and they share egress_limit
+    bits/second fairly (0 for no limit). Files are served from directory, if given.
+    """
+    payload = PayloadSource(file_size, fill=b"X")
+    gate = admission.Admission(max_sessions, max_queued, egress_bps=egress_limit)
+
+    tcp_server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    udp_server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    if reuse_port:
+        workerPool.reuse_port(tcp_server)
+        workerPool.reuse_port(udp_server)
+    # Accepted connections inherit the listener's buffers, which fix the window scale in the handshake
+    socketTuning.tune_tcp(tcp_server)
+    socketTuning.tune_udp(udp_server)
+    tcp_server.bind(("", tcp_port))
+    tcp_server.listen(socket.SOMAXCONN)
+    udp_server.bind(("", udp_port))
+
+    # Handle UDP requests
+    threading.Thread(target=serve_udp, args=(udp_server, payload, gate), daemon=True).start()
+    threading.Thread(target=admission.report_shares, args=(gate,), daemon=True).start()
+
+    # Handle TCP connections
+    while True:
+        conn, addr = tcp_server.accept()
+        threading.Thread(target=handle_tcp_connection, args=(conn, addr, payload, gate, directory), daemon=True).start()
+
+def start_server(tcp_port, udp_port, file_size, workers=1, max_sessions=0, max_queued=admission.DEFAULT_MAX_QUEUED,
+                 egress_limit=0, directory=None):
+    """Start the multi-threaded server, optionally as a pool of worker processes each with its own limits."""
+    log.info("Server started, listening on IP address %s", socket.gethostbyname(socket.gethostname()))
+    # Pool workers keep their own counts, so only a single process can advertise its load
+    load = workerPool.current_load if workers == 1 else None
+    threading.Thread(target=broadcast_offer, args=(udp_port, tcp_port, load), daemon=True).start()
+    if workers == 1:
+        serve(tcp_port, udp_port, file_size, False, max_sessions, max_queued, egress_limit, directory)
+    else:
+        workerPool.run_pool(serve, (tcp_port, udp_port, file_size, True, max_sessions, max_queued, egress_limit,
+                                    directory), workers or None)
+
 # === CLIENT CODE ===
-def listen_for_offers(udp_port):
-    """Listen for server offer messages."""
-    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP) as sock:
-        sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
-        sock.bind(("", udp_port))
-        print("Client started, listening for offer requests...")
-        while True:
-            data, addr = sock.recvfrom(1024)
-            try:
-                magic_cookie, message_type, server_udp_port, server_tcp_port = struct.unpack(">IBHH", data)
-                if magic_cookie == MAGIC_COOKIE and message_type == OFFER_TYPE:
-                    print(f"Received offer from {addr[0]}: UDP Port {server_udp_port}, TCP Port {server_tcp_port}")
-                    return addr[0], server_tcp_port, server_udp_port
-            except struct.error:
-                continue
+def listen_for_offers(udp_port, wait=discovery.DEFAULT_WAIT, policy="rtt"):
+    """
+    Listen for server offer messages and pick the best server heard within wait seconds of the first.
 
-def tcp_transfer(server_ip, tcp_port, file_size):
-    """Perform a TCP file transfer."""
-    start_time = time.time()
-    with socket.create_connection((server_ip, tcp_port)) as sock:
-        sock.sendall(f"{file_size}\n".encode())
-        received_data = b""
-        while len(received_data) < file_size:
-            chunk = sock.recv(1024)
-            if not chunk:
-                break
-            received_data += chunk
-    total_time = time.time() - start_time
-    speed = (len(received_data) * 8) / total_time
+    :return: (server address, TCP port, UDP port, RTT in seconds or None)
+    """
+    print("Client started, listening for offer requests...")
+    with discovery.Discovery(udp_port) as servers:
+        best, entries = servers.choose(wait, policy)
+    for entry in entries:
+        print(f"Received offer from {entry.describe()}")
+    print(f"Using {best.address} (lowest {policy})")
+    return best.address, best.tcp_port, best.udp_port, best.rtt
+
+def tcp_transfer(server_ip, tcp_port, file_size, buffer_size=receiver.DEFAULT_BUFFER_SIZE, sink=None, counters=None,
+                 duration=0, warmup=0, seed=None):
+    """
+    Perform a TCP file transfer; counters (a TransferCounters) feeds interval reports.
+
+    With a duration (seconds) the server streams until then and file_size only
+    caps the test (0 for no cap). The first warmup seconds are left out of the
+    reported steady-state rate. With a seed the server sends that seed's
+    pseudo-random payload, which an integrity.StreamVerifier sink can check.
+    """
+    buffer = receiver.allocate_buffer(buffer_size)
+    limit = (file_size or UNLIMITED) if duration else file_size
+    sock = admission.connect_when_admitted(server_ip, tcp_port,
+                                 protocol.encode_request(file_size, duration_ms=int(duration * 1000),
+                                                         flags=protocol.payload_flags(seed), seed=seed or 0))
+    if sock is None:
+        print("TCP transfer failed: server busy")
+        if counters is not None:
+            counters.done = True
+        return
+    start = time.perf_counter()
+    with sock, tcpInfo.sampled(sock) as info:
+        warm = receiver.receive_stream(sock, limit, buffer, sink, counters, until=start + warmup) if warmup else 0
+        measured_start = time.perf_counter()
+        received = warm + receiver.receive_stream(sock, limit - warm, buffer, sink, counters,
+                                                  until=start + duration if duration else None)
+        measured_end = time.perf_counter()
+        if duration:
+            # Tell the server to stop in case its clock started late, then drain whatever is in flight
+            sock.sendall(protocol.encode_stop())
+            received += receiver.receive_stream(sock, limit - received, buffer, sink, counters)
+        tuning = socketTuning.describe(sock)
+    if counters is not None:
+        counters.done = True
+    if isinstance(sink, receiver.SaveSink):
+        sink.close()
+    total_time = time.perf_counter() - start
+    speed = (received * 8) / total_time
     print(f"TCP transfer finished, total time: {total_time:.2f} seconds, total speed: {speed:.2f} bits/second")
+    print(f"TCP socket: {tuning}")
+    print(f"TCP path: {info.summary()}")
+    if warmup:
+        measured = (received - warm) * 8 / max(measured_end - measured_start, 1e-9) if received > warm else 0.0
+        print(f"TCP speed after {warmup:g}s warm-up: {measured:.2f} bits/second")
+    if isinstance(sink, integrity.StreamVerifier):
+        sink.finish()
+        print(f"TCP verify: {sink.summary(total_time)}")
 
-def udp_transfer(server_ip, udp_port, file_size):
-    """Perform a UDP file transfer."""
-    udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+def udp_transfer(server_ip, udp_port, file_size, bitrate=0, segment_size=udpSender.DEFAULT_SEGMENT_SIZE,
+                 counters=None, duration=0, warmup=0, seed=None, verify=False):
+    """
+    Perform a UDP file transfer, optionally asking the server to pace it at bitrate bits/second.
+
+    counters (a TransferCounters) feeds interval reports; the summary gives
+    the jitter either way. duration and warmup work as in tcp_transfer; a duration stream is
+    open-ended until the server's done message gives its segment count. With
+    a seed the payload is that seed's pseudo-random one, and verify checks
+    every new segment against it.
+    """
+    if counters is None:
+        counters = intervalReport.TransferCounters("UDP")  # for the jitter in the summary
+    udp_socket = socketTuning.tune_udp(socket.socket(socket.AF_INET, socket.SOCK_DGRAM))
     udp_socket.settimeout(1)
-    request_message = struct.pack(">IBQ", MAGIC_COOKIE, REQUEST_TYPE, file_size)
-    udp_socket.sendto(request_message, (server_ip, udp_port))
+    segment_size = udpSender.clamp_segment_size(segment_size)
+    server = (server_ip, udp_port)
+    request = protocol.encode_request(file_size, bitrate, segment_size, int(duration * 1000),
+                                      flags=protocol.payload_flags(seed), seed=seed or 0)
+    if not admission.request_when_admitted(udp_socket, server, request):
+        print("UDP transfer failed: server busy")
+        udp_socket.close()
+        counters.done = True
+        return
 
-    start_time = time.time()
-    received_segments = set()
-    total_segments = None
+    start_time = time.perf_counter()
+    deadline = start_time + duration if duration else None
+    warm_end = start_time + warmup if warmup else None
+    warm_bytes = warm_time = None
+    buffer = receiver.allocate_buffer(protocol.PAYLOAD_HEADER_SIZE + segment_size)
+    tracker = verifier = None
+    open_ended = False
+    received_bytes = 0
+    first_time = last_time = None
+    trace = _datagrams if _datagrams.enabled else None
     while True:
         try:
-            data, _ = udp_socket.recvfrom(2048)
-            magic_cookie, message_type, total_segments, current_segment = struct.unpack(">IBQQ", data[:21])
-            if magic_cookie != MAGIC_COOKIE or message_type != PAYLOAD_TYPE:
+            data, _ = receiver.receive_datagram(udp_socket, buffer)
+            header = protocol.decode_payload_header(data)
+            if header is None:
+                echo = protocol.decode_request(data)
+                if echo is not None:
+                    segment_size = echo.segment_size
+                sent_segments = protocol.decode_done(data)
+                if sent_segments is not None:
+                    if tracker is None:
+                        break
+                    tracker.resize(max(sent_segments, tracker.highest + 1))
+                    open_ended = False
+                    if tracker.complete:
+                        break
                 continue
-            received_segments.add(current_segment)
+            total_segments, current_segment, sent_ns = header
+            if tracker is None:
+                open_ended = total_segments == 0
+                tracker = SegmentTracker(total_segments or OPEN_ENDED_SEGMENTS)
+                first_time = time.perf_counter()
+                counters.tracker = tracker
+                if verify and seed is not None:
+                    verifier = integrity.SegmentVerifier(seed, segment_size)
+            if open_ended and current_segment >= tracker.total_segments:
+                tracker.resize(max(current_segment + 1, tracker.total_segments * 2))
+            if tracker.add(current_segment):
+                received_bytes += len(data) - protocol.PAYLOAD_HEADER_SIZE
+                if verifier is not None:
+                    verifier.check(current_segment, data[protocol.PAYLOAD_HEADER_SIZE:])
+            last_time = time.perf_counter()
+            if warm_end is not None and warm_bytes is None and last_time >= warm_end:
+                warm_bytes, warm_time = received_bytes, last_time
+            if deadline is not None and last_time >= deadline:
+                # Ask the server to stop in case its clock started late; the done message ends the loop
+                udp_socket.sendto(protocol.encode_stop(), server)
+                deadline = None
+            counters.bytes += len(data) - protocol.PAYLOAD_HEADER_SIZE
+            counters.packets += 1
+            counters.arrival(sent_ns, protocol.timestamp())
+            if trace is not None:
+                trace.event("Received segment %d of %d, %d so far", current_segment, total_segments, tracker.received)
+            if tracker.complete and not open_ended:
+                break
         except socket.timeout:
             break
 
-    total_time = time.time() - start_time
-    speed = (len(received_segments) * 1024 * 8) / total_time
-    success_rate = (len(received_segments) / total_segments) * 100 if total_segments else 0
+    if open_ended and tracker.total_segments > tracker.highest + 1:
+        # The done message was lost; assume nothing after the highest segment seen
+        tracker.resize(tracker.highest + 1)
+    counters.done = True
+    total_time = time.perf_counter() - start_time
+    received = tracker.received if tracker else 0
+    speed = (received_bytes * 8) / total_time
+    success_rate = (received / tracker.total_segments) * 100 if tracker else 0
     print(f"UDP transfer finished, total time: {total_time:.2f} seconds, total speed: {speed:.2f} bits/second, success rate: {success_rate:.2f}%")
+    print(f"UDP socket: {socketTuning.describe(udp_socket)}")
+    if tracker:
+        print(f"UDP segments: {tracker.summary()}, segment size {segment_size} bytes")
+        print(f"UDP rate: {pacer.rate_report(received_bytes, last_time - first_time, bitrate)}")
+        print(f"UDP jitter: {counters.jitter_ns / intervalReport.NS_PER_MS:.3f} ms")
+    if verifier is not None:
+        print(f"UDP verify: {verifier.summary(total_time)}")
+    if warm_bytes is not None and last_time > warm_time:
+        measured = (received_bytes - warm_bytes) * 8 / (last_time - warm_time)
+        print(f"UDP speed after {warmup:g}s warm-up: {measured:.2f} bits/second")
+    udp_socket.close()
+
+def reliable_udp_transfer(server_ip, udp_port, file_size, bitrate=0, segment_size=udpSender.DEFAULT_SEGMENT_SIZE,
+                          counters=None, seed=None, verify=False):
+    """
+    Perform a UDP file transfer with NACK-based selective retransmission.
+
+    Every NACK_INTERVAL, NACK_EVERY datagrams or new gap the client sends its highest segment and the ranges
+    still missing below it, plus everything after it when nothing arrived
+    since the last nack, and the server resends only those. When every
+    segment is in, a stop message asks the server for its datagram count.
+    seed and verify work as in udp_transfer.
+    """
+    if counters is None:
+        counters = intervalReport.TransferCounters("UDP")  # for the jitter in the summary
+    udp_socket = socketTuning.tune_udp(socket.socket(socket.AF_INET, socket.SOCK_DGRAM))
+    if udp_socket.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF) < RELIABLE_RECEIVE_BUFFER:
+        udp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, RELIABLE_RECEIVE_BUFFER)
+    udp_socket.settimeout(NACK_INTERVAL)
+    segment_size = udpSender.clamp_segment_size(segment_size)
+    server = (server_ip, udp_port)
+    request = protocol.encode_request(file_size, bitrate, segment_size,
+                                      flags=protocol.FLAG_RELIABLE | protocol.payload_flags(seed), seed=seed or 0)
+    if not admission.request_when_admitted(udp_socket, server, request):
+        print("Reliable UDP transfer failed: server busy")
+        udp_socket.close()
+        counters.done = True
+        return
+
+    start = time.perf_counter()
+    buffer = receiver.allocate_buffer(protocol.PAYLOAD_HEADER_SIZE + segment_size)
+    tracker = verifier = None
+    received_bytes = nacks = arrivals = 0
+    cursor = 0  # every segment below this has arrived
+    last_arrival = next_nack = start
+    while tracker is None or not tracker.complete:
+        now = time.perf_counter()
+        if now - last_arrival > RELIABLE_IDLE_TIMEOUT:
+            break
+        if tracker is not None and (now >= next_nack or arrivals >= NACK_EVERY):
+            ranges = list(itertools.islice(tracker.missing_ranges(cursor, tracker.highest), protocol.MAX_NACK_RANGES))
+            cursor = ranges[0][0] if ranges else tracker.highest + 1
+            if not arrivals and tracker.highest + 1 < tracker.total_segments and len(ranges) < protocol.MAX_NACK_RANGES:
+                # Nothing arrived for a whole interval: the tail may have been lost too
+                ranges.append((tracker.highest + 1, tracker.total_segments - 1))
+            udp_socket.sendto(protocol.encode_nack(tracker.highest, ranges), server)
+            nacks += 1
+            arrivals = 0
+            next_nack = now + NACK_INTERVAL
+        try:
+            data, _ = receiver.receive_datagram(udp_socket, buffer)
+        except socket.timeout:
+            continue
+        header = protocol.decode_payload_header(data)
+        if header is None:
+            echo = protocol.decode_request(data)
+            if echo is not None:
+                segment_size = echo.segment_size
+            continue
+        total_segments, current_segment, sent_ns = header
+        if tracker is None:
+            tracker = SegmentTracker(total_segments)
+            counters.tracker = tracker
+            if verify and seed is not None:
+                verifier = integrity.SegmentVerifier(seed, segment_size)
+        if current_segment > tracker.highest + 1:
+            next_nack = 0  # a gap: report it right away
+        if tracker.add(current_segment):
+            received_bytes += len(data) - protocol.PAYLOAD_HEADER_SIZE
+            if verifier is not None:
+                verifier.check(current_segment, data[protocol.PAYLOAD_HEADER_SIZE:])
+        arrivals += 1
+        last_arrival = time.perf_counter()
+        counters.bytes += len(data) - protocol.PAYLOAD_HEADER_SIZE
+        counters.packets += 1
+        counters.arrival(sent_ns, protocol.timestamp())
+    completion_time = time.perf_counter() - start
+
+    # Stop the sender and learn how many datagrams it needed; resend the stop until the done message arrives
+    datagrams_sent = None
+    wait_end = time.perf_counter() + DONE_WAIT
+    while tracker is not None and datagrams_sent is None and time.perf_counter() < wait_end:
+        udp_socket.sendto(protocol.encode_stop(), server)
+        try:
+            data, _ = receiver.receive_datagram(udp_socket, buffer)
+        except socket.timeout:
+            continue
+        datagrams_sent = protocol.decode_done(data)
+    tuning = socketTuning.describe(udp_socket)
     udp_socket.close()
+    counters.done = True
 
-def start_client(file_size, tcp_connections, udp_connections):
-    """Start the client."""
-    server_ip, tcp_port, udp_port = listen_for_offers(udp_port=13117)
+    goodput = received_bytes * 8 / completion_time
+    state = "complete" if tracker is not None and tracker.complete else "incomplete"
+    print(f"Reliable UDP transfer {state}, completion time: {completion_time:.2f} seconds, goodput: {goodput:.2f} bits/second")
+    print(f"UDP socket: {tuning}")
+    if tracker:
+        print(f"UDP segments: {tracker.summary()}, segment size {segment_size} bytes")
+        if datagrams_sent is not None:
+            retransmitted = max(0, datagrams_sent - tracker.total_segments)
+            print(f"UDP retransmissions: {retransmitted} of {datagrams_sent} datagrams sent "
+                  f"({retransmitted / max(tracker.total_segments, 1):.2%} of segments), {nacks} nacks")
+        else:
+            print(f"UDP retransmissions: unknown (no done message), {nacks} nacks")
+        print(f"UDP jitter: {counters.jitter_ns / intervalReport.NS_PER_MS:.3f} ms")
+    if verifier is not None:
+        print(f"UDP verify: {verifier.summary(completion_time)}")
+
+def make_sink(verify, seed, save_path, index):
+    """Build the optional receive sink for one TCP connection."""
+    if verify:
+        return integrity.StreamVerifier(seed)
+    if save_path:
+        return receiver.SaveSink(open(save_path if index == 0 else f"{save_path}.{index}", "wb"))
+    return None
+
+def start_client(file_size, tcp_connections, udp_connections, buffer_size=receiver.DEFAULT_BUFFER_SIZE,
+                 verify=False, save_path=None, udp_bitrate=0, segment_size=udpSender.DEFAULT_SEGMENT_SIZE,
+                 discover_mtu=False, interval=intervalReport.DEFAULT_INTERVAL, duration=0, warmup=0, reliable=False,
+                 split=False, engine="threads", select="rtt", seed=None):
+    """
+    Start the client and wait for every transfer; interval is seconds between reports, 0 for none.
+
+    With a duration (seconds) every connection streams for that long instead
+    of file_size bytes; the first warmup seconds are left out of the reported speed.
+    reliable makes the UDP connections retransmit lost segments, and split
+    makes the TCP connections share one file_size download with range
+    requests (both for file_size transfers only). engine "asyncio" runs every
+    connection on one event loop instead of a thread each. select picks among
+    several servers by lowest "rtt" or "load". seed asks for that seed's
+    pseudo-random payload instead of a repeated byte; verify (threads engine
+    only) checks it with CRC32s, using VERIFY_SEED unless a seed is given.
+    """
+    if verify and seed is None:
+        seed = VERIFY_SEED
+    server_ip, tcp_port, udp_port, rtt = listen_for_offers(udp_port=13117, policy=select)
+    socketTuning.set_path_rtt(rtt)
+    if discover_mtu:
+        mtu = udpSender.discover_path_mtu(server_ip, udp_port)
+        if mtu:
+            segment_size = udpSender.segment_size_for_mtu(mtu)
+            print(f"Path MTU to {server_ip} is {mtu}, using {segment_size}-byte segments")
+
+    reporter = intervalReport.IntervalReporter(interval) if interval else None
+    if engine == "asyncio":
+        if reporter:
+            reporter.start()
+        start = time.perf_counter()
+        results = asyncClient.run(server_ip, tcp_port, udp_port, file_size, tcp_connections, udp_connections,
+                                  udp_bitrate, segment_size, duration, reporter)
+        if reporter:
+            reporter.stop()
+        asyncClient.print_results(results, time.perf_counter() - start)
+        return results
+
+    threads = []
 
     # Start TCP connections
-    for i in range(tcp_connections):
-        threading.Thread(target=tcp_transfer, args=(server_ip, tcp_port, file_size), daemon=True).start()
+    if split and tcp_connections:
+        counters = [reporter.add(f"TCP-{i + 1}") for i in range(tcp_connections)] if reporter else None
+        threads.append(threading.Thread(target=rangeDownload.download, args=(server_ip, tcp_port, file_size or DEFAULT_FILE_SIZE, tcp_connections, buffer_size),
+                                        kwargs={"counters": counters, "seed": seed, "verify": verify}, daemon=True))
+    for i in range(0 if split else tcp_connections):
+        sink = make_sink(verify, seed, save_path, i)
+        counters = reporter.add(f"TCP-{i + 1}") if reporter else None
+        threads.append(threading.Thread(target=tcp_transfer, args=(server_ip, tcp_port, file_size, buffer_size, sink, counters, duration, warmup, seed), daemon=True))
 
     # Start UDP connections
     for i in range(udp_connections):
-        threading.Thread(target=udp_transfer, args=(server_ip, udp_port, file_size), daemon=True).start()
+        counters = reporter.add(f"UDP-{i + 1}") if reporter else None
+        if reliable:
+            threads.append(threading.Thread(target=reliable_udp_transfer, args=(server_ip, udp_port, file_size or DEFAULT_FILE_SIZE, udp_bitrate, segment_size, counters, seed, verify), daemon=True))
+        else:
+            threads.append(threading.Thread(target=udp_transfer, args=(server_ip, udp_port, file_size, udp_bitrate, segment_size, counters, duration, warmup, seed, verify), daemon=True))
+
+    if reporter:
+        reporter.start()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if reporter:
+        reporter.stop()
+
+def start_load_client(file_size, tcp_connections, udp_connections, processes=None,
+                      buffer_size=receiver.DEFAULT_BUFFER_SIZE, udp_bitrate=0,
+                      segment_size=udpSender.DEFAULT_SEGMENT_SIZE, interval=intervalReport.DEFAULT_INTERVAL,
+                      duration=0, select="rtt", seed=None, reliable=False):
+    """
+    Find a server and load it from several client processes (None for one per CPU) instead of one.
+
+    The connections are those of start_client, spread across the processes
+    so no single interpreter's GIL caps the client; loadGenerator aggregates
+    them into one report. reliable makes the UDP connections retransmit lost
+    segments, for file_size transfers only.
+    """
+    server_ip, tcp_port, udp_port, rtt = listen_for_offers(udp_port=13117, policy=select)
+    socketTuning.set_path_rtt(rtt)
+    jobs = [(f"TCP-{i + 1}", tcp_transfer, (server_ip, tcp_port, file_size, buffer_size),
+             {"duration": duration, "seed": seed}) for i in range(tcp_connections)]
+    if reliable:
+        jobs += [(f"UDP-{i + 1}", reliable_udp_transfer,
+                  (server_ip, udp_port, file_size or DEFAULT_FILE_SIZE, udp_bitrate, segment_size), {"seed": seed})
+                 for i in range(udp_connections)]
+    else:
+        jobs += [(f"UDP-{i + 1}", udp_transfer, (server_ip, udp_port, file_size, udp_bitrate, segment_size),
+                  {"duration": duration, "seed": seed}) for i in range(udp_connections)]
+    if not jobs:
+        print("Load test needs at least one TCP or UDP connection")
+        return None
+    return loadGenerator.run(jobs, processes, interval)
+
+def file_transfer(server_ip, tcp_port, name, save_path=None, buffer_size=receiver.DEFAULT_BUFFER_SIZE,
+                  connections=1, split=False, counters=None):
+    """
+    Download the file called name from the server's directory to save_path (its base name by default).
+
+    The bytes go straight from the receive buffer to disk through a
+    fileTransfer.FileSink, never all in memory; split fetches it with range
+    requests over several connections, each writing its ranges in place.
+    counters is a TransferCounters, or one per connection when split.
+    Reports network and disk throughput separately.
+    """
+    path = save_path or os.path.basename(name)
+    buffer = receiver.allocate_buffer(buffer_size)
+    flags = protocol.FLAG_RANGE if split else 0  # a split download first asks for 0 bytes, just to learn the size
+    sock = admission.connect_when_admitted(server_ip, tcp_port, protocol.encode_file_request(name, flags=flags))
+    if sock is None:
+        print("File download failed: server busy")
+        return
+    fd = None
+    try:
+        with sock, tcpInfo.sampled(sock) as info:
+            answer = fileTransfer.read_file_answer(sock)
+            if answer is None or answer[0] != protocol.FILE_OK:
+                print(f"File download failed: {name} {fileTransfer.describe_status(answer[0]) if answer else 'got no answer'}")
+                return
+            size = answer[1]
+            fd = fileTransfer.open_output(path, size)
+            if not split:
+                start = time.perf_counter()
+                sink = fileTransfer.FileSink(fd)
+                received = receiver.receive_stream(sock, size, buffer, sink, counters)
+                sink.finish()
+                elapsed = time.perf_counter() - start
+        if split:
+            received, elapsed = rangeDownload.download(server_ip, tcp_port, size, connections, buffer_size,
+                                                       counters=counters, name=name, fd=fd)
+        sync_seconds = fileTransfer.sync(fd)
+    except OSError as e:
+        print(f"File download failed: {name}: {e}")
+        return
+    finally:
+        if fd is not None:
+            os.close(fd)
+        if counters is not None and not split:
+            counters.done = True
+    state = "finished" if received >= size else f"incomplete ({received} of {size} bytes)"
+    print(f"File {name} {state}: {received} bytes to {path} in {elapsed:.2f} seconds, "
+          f"total speed: {received * 8 / max(elapsed, 1e-9):.2f} bits/second")
+    if not split:
+        print(f"File throughput: {sink.summary(received, elapsed)}")
+        print(f"TCP path: {info.summary()}")
+    print(f"File fsync took {sync_seconds:.2f} seconds")
+
+def start_file_client(name, save_path=None, tcp_connections=1, split=False, buffer_size=receiver.DEFAULT_BUFFER_SIZE,
+                      interval=intervalReport.DEFAULT_INTERVAL, select="rtt"):
+    """Find a server and download the file called name from its directory, split across tcp_connections if split."""
+    server_ip, tcp_port, _, rtt = listen_for_offers(udp_port=13117, policy=select)
+    socketTuning.set_path_rtt(rtt)
+    reporter = intervalReport.IntervalReporter(interval) if interval else None
+    if reporter:
+        counters = [reporter.add(f"TCP-{i + 1}") for i in range(tcp_connections)] if split else reporter.add("TCP-1")
+        reporter.start()
+    else:
+        counters = None
+    try:
+        file_transfer(server_ip, tcp_port, name, save_path, buffer_size, tcp_connections, split, counters)
+    finally:
+        if reporter:
+            reporter.stop()
+
+def start_latency_client(tcp=True, udp=True, count=latencyTest.DEFAULT_COUNT, rate=latencyTest.DEFAULT_RATE, size=0,
+                         select="rtt"):
+    """Find a server and measure round-trip latency to it with UDP pings and TCP echoes instead of transferring."""
+    server_ip, tcp_port, udp_port, rtt = listen_for_offers(udp_port=13117, policy=select)
+    socketTuning.set_path_rtt(rtt)
+    return latencyTest.run(server_ip, tcp_port, udp_port, tcp, udp, count, rate, size)
 
 if __name__ == "__main__":
     import argparse
 
     parser = argparse.ArgumentParser(description="Multi-threaded UDP/TCP transfer.")
     parser.add_argument("role", choices=["server", "client"], help="Start as server or client.")
-    parser.add_argument("--file_size", type=int, default=1024 * 1024 * 1024, help="Size of the file to transfer in bytes.")
+    parser.add_argument("--file_size", type=int, default=None, help="Size of the file to transfer in bytes (default 1 GiB, or no cap with --duration).")
     parser.add_argument("--tcp_port", type=int, default=8080, help="TCP port for the server.")
     parser.add_argument("--udp_port", type=int, default=9090, help="UDP port for the server.")
+    parser.add_argument("--workers", type=int, default=1, help="Server worker processes sharing the ports, 0 for one per CPU (server only).")
+    parser.add_argument("--profile", choices=sorted(socketTuning.PROFILES), default=socketTuning.DEFAULT_PROFILE, help="Socket tuning profile for every TCP and UDP socket.")
+    parser.add_argument("--max_sessions", type=int, default=0, help="Sessions served at once, 0 for no cap; per worker process (server only).")
+    parser.add_argument("--max_queued", type=int, default=admission.DEFAULT_MAX_QUEUED, help="TCP connections waiting for a session slot before clients are told to back off (server only).")
+    parser.add_argument("--directory", default=None, help="Serve the files in this directory by name (server only).")
+    parser.add_argument("--egress_limit", type=int, default=0, help="Egress bits/second shared fairly between clients, 0 for no limit; per worker process (server only).")
+    parser.add_argument("--processes", type=int, default=1, help="Spread the connections across this many client processes, 0 for one per CPU; not with --verify, --warmup, --split, --engine asyncio, --save or --pmtu (client only).")
     parser.add_argument("--tcp_connections", type=int, default=1, help="Number of TCP connections (client only).")
     parser.add_argument("--udp_connections", type=int, default=2, help="Number of UDP connections (client only).")
+    parser.add_argument("--recv_buffer", type=int, default=receiver.DEFAULT_BUFFER_SIZE, help="Receive buffer size in bytes (client only).")
+    parser.add_argument("--verify", action="store_true", help="Ask for a pseudo-random payload and check every TCP block and UDP segment of it with CRC32 (client only).")
+    parser.add_argument("--seed", type=int, default=None, help="Ask for the pseudo-random payload generated from this seed instead of a repeated byte (client only).")
+    parser.add_argument("--save", default=None, help="Write received TCP bytes to this path; with --get, where the file goes (client only).")
+    parser.add_argument("--get", default=None, metavar="NAME", help="Download this file from the server's --directory instead of a test payload; --split shares it across the TCP connections (client only).")
+    parser.add_argument("--segment_size", type=int, default=udpSender.DEFAULT_SEGMENT_SIZE, help="Requested UDP segment size in bytes, up to ~64 KiB (client only).")
+    parser.add_argument("--pmtu", action="store_true", help="Pick the largest UDP segment that fits the path MTU (client only).")
+    parser.add_argument("--udp_bitrate", type=int, default=0, help="Target UDP bitrate in bits/second, 0 for unpaced (client only).")
+    parser.add_argument("--interval", type=float, default=intervalReport.DEFAULT_INTERVAL, help="Seconds between interval reports, 0 for none (client only).")
+    parser.add_argument("--duration", type=float, default=0, help="Stream for this many seconds instead of file_size bytes, which then only caps the test (client only).")
+    parser.add_argument("--warmup", type=float, default=0, help="Seconds at the start left out of the reported speed (client only).")
+    parser.add_argument("--engine", choices=["threads", "asyncio"], default="threads", help="Run connections on a thread each or all on one event loop; asyncio does not support --verify, --warmup, --split, --reliable, --save or --seed (client only).")
+    parser.add_argument("--select", choices=discovery.POLICIES, default="rtt", help="Pick the server with the lowest RTT or load when several offer (client only).")
+    parser.add_argument("--split", action="store_true", help="Split one file_size download across the TCP connections with range requests (client only).")
+    parser.add_argument("--reliable", action="store_true", help="Retransmit lost UDP segments; ignores --duration for UDP (client only).")
+    parser.add_argument("--latency", action="store_true", help="Measure round-trip latency with small pings instead of transferring; 0 TCP or UDP connections skips that protocol (client only).")
+    parser.add_argument("--ping_count", type=int, default=latencyTest.DEFAULT_COUNT, help="Pings per protocol in a latency test (client only).")
+    parser.add_argument("--ping_rate", type=float, default=latencyTest.DEFAULT_RATE, help="Pings per second in a latency test, 0 for one at a time (client only).")
+    parser.add_argument("--ping_size", type=int, default=0, help="Ping size in bytes in a latency test, at least the 13-byte header (client only).")
+    eventLog.add_arguments(parser)
 
     args = parser.parse_args()
+    if args.file_size is None:
+        args.file_size = 0 if args.role == "client" and args.duration else DEFAULT_FILE_SIZE
+    eventLog.setup(args.log_level)
+    socketTuning.select(args.profile)
 
     if args.role == "server":
-        start_server(args.tcp_port, args.udp_port, args.file_size)
+        start_server(args.tcp_port, args.udp_port, args.file_size, args.workers, args.max_sessions, args.max_queued, args.egress_limit, args.directory)
+    elif args.latency:
+        start_latency_client(args.tcp_connections > 0, args.udp_connections > 0, args.ping_count, args.ping_rate, args.ping_size, args.select)
+    elif args.get:
+        start_file_client(args.get, args.save, args.tcp_connections, args.split, args.recv_buffer, args.interval, args.select)
+    elif args.processes != 1:
+        unsupported = [option for option, given in (("--verify", args.verify), ("--warmup", args.warmup), ("--split", args.split), ("--engine asyncio", args.engine != "threads"), ("--save", args.save), ("--pmtu", args.pmtu)) if given]
+        if unsupported:
+            parser.error(f"--processes cannot be combined with {', '.join(unsupported)}")
+        start_load_client(args.file_size, args.tcp_connections, args.udp_connections, args.processes, args.recv_buffer, args.udp_bitrate, args.segment_size, args.interval, args.duration, args.select, args.seed, args.reliable)
     elif args.role == "client":
-        start_client(args.file_size, args.tcp_connections, args.udp_connections)
+        if args.engine == "asyncio":
+            unsupported = [option for option, given in (("--verify", args.verify), ("--warmup", args.warmup), ("--split", args.split), ("--reliable", args.reliable), ("--save", args.save), ("--seed", args.seed is not None)) if given]
+            if unsupported:
+                parser.error(f"--engine asyncio cannot be combined with {', '.join(unsupported)}")
+        start_client(args.file_size, args.tcp_connections, args.udp_connections, args.recv_buffer, args.verify, args.save, args.udp_bitrate, args.segment_size, args.pmtu, args.interval, args.duration, args.warmup, args.reliable, args.split, args.engine, args.select, args.seed)
 
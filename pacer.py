@@ -0,0 +1,57 @@
+import time
+
+BURST_WINDOW = 0.002  # seconds of traffic allowed back to back
+MIN_BURST = 1500
+
+
+class TokenBucket:
+    """
+    Paces a sender to rate_bps bits/second.
+
+    Tokens are bytes. The bucket never holds more than burst bytes, so an idle
+    sender can only catch up by one short microburst; overdrafts are repaid by
+    waiting, which keeps the long-run rate exact.
+    """
+
+    def __init__(self, rate_bps, burst_bytes=None):
+        if rate_bps <= 0:
+            raise ValueError("rate_bps must be positive")
+        self.fixed_burst = burst_bytes
+        self.set_rate(rate_bps)
+        self.tokens = self.burst
+        self.stamp = time.perf_counter()
+
+    def set_rate(self, rate_bps):
+        """Change the rate from now on; the burst follows it unless it was given explicitly."""
+        self.rate_bps = rate_bps
+        self.rate = rate_bps / 8.0
+        self.burst = self.fixed_burst or max(MIN_BURST, int(self.rate * BURST_WINDOW))
+        if getattr(self, "tokens", 0) > self.burst:
+            self.tokens = self.burst
+
+    def reserve(self, nbytes):
+        """Take nbytes of tokens and return how many seconds to wait before sending them."""
+        now = time.perf_counter()
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+        self.tokens -= nbytes
+        return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def consume(self, nbytes):
+        """Block until nbytes may be sent."""
+        delay = self.reserve(nbytes)
+        if delay > 0:
+            time.sleep(delay)
+
+
+def make_pacer(rate_bps, burst_bytes=None):
+    """Return a TokenBucket for rate_bps, or None when the rate is 0 (unpaced)."""
+    return TokenBucket(rate_bps, burst_bytes) if rate_bps > 0 else None
+
+
+def rate_report(nbytes, elapsed, requested_bps):
+    """Describe the achieved bitrate, and how it compares with the requested one if there was one."""
+    achieved = (nbytes * 8) / elapsed if elapsed > 0 else 0.0
+    if not requested_bps:
+        return f"achieved {achieved:.2f} bits/second (unpaced)"
+    return f"achieved {achieved:.2f} of requested {requested_bps} bits/second ({achieved / requested_bps * 100:.1f}%)"
@@ -0,0 +1,76 @@
+import copy
+import functools
+import random
+
+import protocol
+
+DEFAULT_BLOCK_SIZE = 64 * 1024
+PATTERN_SIZE = 1024 * 1024  # the period of a seeded payload, on every server and client
+MAX_CACHED_PATTERNS = 16
+
+
+class PayloadSource:
+    """
+    A logical payload of any size backed by one small repeated block.
+
+    The block is stored twice back to back, so a slice of up to block_size bytes
+    starting at any logical offset is a single contiguous memoryview and no
+    bytes are ever copied or allocated per segment.
+    """
+
+    def __init__(self, size, block=None, fill=b'X', block_size=DEFAULT_BLOCK_SIZE):
+        if block is None:
+            block = fill * block_size
+        self.size = size
+        self.block_size = len(block)
+        self.uniform = block.count(block[:1]) == len(block)
+        self.buffer = memoryview(bytes(block) * 2)
+
+    def __len__(self):
+        return self.size
+
+    def resized(self, size):
+        """The same bytes as a payload of another size, sharing the buffer."""
+        payload = copy.copy(self)
+        payload.size = size
+        return payload
+
+    def view(self, offset, length):
+        """Return a read-only memoryview of the payload bytes at [offset, offset + length)."""
+        if offset < 0 or offset > self.size:
+            raise IndexError("payload offset out of range")
+        length = min(length, self.size - offset, self.block_size)
+        start = offset % self.block_size
+        return self.buffer[start:start + length]
+
+    def chunks(self, offset=0, length=None, chunk_size=None):
+        """Yield consecutive memoryviews covering [offset, offset + length)."""
+        end = self.size if length is None else min(self.size, offset + length)
+        chunk_size = min(chunk_size or self.block_size, self.block_size)
+        while offset < end:
+            chunk = self.view(offset, min(chunk_size, end - offset))
+            yield chunk
+            offset += len(chunk)
+
+
+@functools.lru_cache(maxsize=MAX_CACHED_PATTERNS)
+def pattern(seed):
+    """The PATTERN_SIZE pseudo-random bytes a seeded payload repeats; the same seed gives the same bytes everywhere."""
+    return random.Random(seed).randbytes(PATTERN_SIZE)
+
+
+@functools.lru_cache(maxsize=MAX_CACHED_PATTERNS)
+def _seeded_source(seed):
+    return PayloadSource(PATTERN_SIZE, block=pattern(seed))
+
+
+def seeded(size, seed):
+    """A size-byte payload of the pattern of seed, generated once per seed and shared."""
+    return _seeded_source(seed).resized(size)
+
+
+def for_request(request, payload):
+    """The payload a decoded Request asks for: payload itself, or as many bytes of its seed's pattern."""
+    if request.flags & protocol.FLAG_RANDOM:
+        return seeded(len(payload), request.seed)
+    return payload
@@ -0,0 +1,413 @@
+"""
+Wire formats shared by every client and server.
+
+All integers are big-endian. Each message starts with the magic cookie and a
+message type:
+
+    offer    >IBHH   cookie, type, server UDP port, server TCP port, then optionally
+                     >H sessions the server is running (its load)
+    request  >IBQ... cookie, type, file size, then optional fields (REQUEST_FIELDS)
+    payload  >IBQQQ  cookie, type, total segments, current segment, send time, then the data
+    stop     >IB     cookie, type: the client wants a running test to end now
+    done     >IBQ    cookie, type, segments sent: the end of an open-ended UDP stream
+                     (or datagrams sent, including retransmissions, of a reliable one)
+    nack     >IBQH   cookie, type, highest segment received, range count, then that
+                     many >QQ (first, last) inclusive ranges of missing segments
+    ping     >IBQ    cookie, type, token, then any padding: the server's UDP port
+                     answers with the same bytes as a pong
+    pong     >IBQ    the echoed ping
+    busy     >IBI    cookie, type, milliseconds to wait before retrying: the server
+                     turned the request away (and closes a TCP connection after it)
+    file     >IBBQ   cookie, type, status (FILE_OK or why not), file size: the answer
+                     to a file request, ahead of the file's bytes
+
+The payload send time is the sender's time.time_ns() when the datagram was
+handed to the kernel. Receivers only use differences between send times, so
+the two clocks need not agree.
+
+Requests may stop after any optional field; missing fields take their
+defaults, so older, shorter requests still decode. Servers also accept the
+legacy text request "<file_size> [<bitrate> [<segment_size>]]".
+
+A request with a duration_ms streams until that deadline (or a stop message)
+instead of for file_size bytes; file_size then only caps the test, with 0 for
+no cap. UDP payloads of such a test carry 0 total segments, since the total
+is not known until the done message.
+
+A UDP request with FLAG_RELIABLE set is answered with selective
+retransmission: the client sends a nack every so often (also when nothing is
+missing, as an acknowledgement), the server resends only the missing ranges,
+and the client sends stop once it has every segment.
+
+A TCP request with FLAG_RANGE set asks for file_size bytes starting at offset
+of the logical file. The connection then stays open: the server reads the
+next range request when it has sent this one, until the client closes. Range
+requests are always sent at full length (REQUEST.size), which frames them.
+
+A TCP request with FLAG_ECHO set turns the connection into an echo service
+for latency tests: the server sends back every byte that follows the request
+(pings, in practice) until the client closes. Echo requests are also sent at
+full length, so the first ping can follow in the same segment.
+
+A request with FLAG_RANDOM set asks for the pseudo-random payload generated
+from its seed (payloadSource.pattern) instead of a repeated byte, over TCP
+and UDP alike, so the client knows every byte it should receive.
+
+A TCP request with FLAG_FILE set asks for a real file from the server's
+directory instead of a payload. It is sent at full length and followed by
+the file name: its length (>H) and its UTF-8 bytes, a relative path. The
+server answers with a file message, then sends file_size bytes from offset
+(0 for the rest of the file). With FLAG_RANGE also set, that was the first
+range (0 bytes is just a look at the file's size), and later range requests
+on the connection (without a name) are ranges of the same file.
+"""
+import collections
+import struct
+import time
+import timeit
+
+MAGIC_COOKIE = 0xabcddcba
+OFFER_TYPE = 0x2
+REQUEST_TYPE = 0x3
+PAYLOAD_TYPE = 0x4
+STOP_TYPE = 0x5
+DONE_TYPE = 0x6
+NACK_TYPE = 0x7
+PING_TYPE = 0x8
+PONG_TYPE = 0x9
+BUSY_TYPE = 0xa
+FILE_TYPE = 0xb
+
+FLAG_RELIABLE = 0x01
+FLAG_RANGE = 0x02
+FLAG_ECHO = 0x04
+FLAG_RANDOM = 0x08
+FLAG_FILE = 0x10
+
+FILE_OK = 0
+FILE_NOT_FOUND = 1
+FILE_NOT_SERVED = 2  # the server has no directory to serve files from
+
+OFFER = struct.Struct(">IBHH")
+OFFER_LOAD = struct.Struct(">H")
+PING = struct.Struct(">IBQ")
+PAYLOAD = struct.Struct(">IBQQQ")
+PREFIX = struct.Struct(">IB")
+DONE = struct.Struct(">IBQ")
+BUSY = struct.Struct(">IBI")
+FILE = struct.Struct(">IBBQ")
+FILE_NAME = struct.Struct(">H")
+MAX_FILE_NAME = 1024  # bytes of UTF-8
+NACK = struct.Struct(">IBQH")
+NACK_RANGE = struct.Struct(">QQ")
+MAX_NACK_RANGES = 60  # keeps a nack within the servers' 1024-byte receive buffers
+
+# (name, struct code, default) in wire order after the cookie and type
+REQUEST_FIELDS = (
+    ("file_size", "Q", 0),
+    ("bitrate", "Q", 0),
+    ("segment_size", "H", 0),
+    ("duration_ms", "I", 0),
+    ("flags", "B", 0),
+    ("offset", "Q", 0),
+    ("seed", "Q", 0),
+)
+
+Offer = collections.namedtuple("Offer", "udp_port tcp_port load", defaults=[None])
+Request = collections.namedtuple("Request", [name for name, _, _ in REQUEST_FIELDS],
+                                 defaults=[default for _, _, default in REQUEST_FIELDS])
+
+
+def _request_layouts():
+    """One precompiled Struct per accepted request length, longest first."""
+    layouts = []
+    fmt = ">IB"
+    for _, code, _ in REQUEST_FIELDS:
+        fmt += code
+        layouts.append(struct.Struct(fmt))
+    return layouts[::-1]
+
+
+REQUEST_LAYOUTS = _request_layouts()
+REQUEST = REQUEST_LAYOUTS[0]
+MIN_REQUEST_SIZE = REQUEST_LAYOUTS[-1].size
+PAYLOAD_HEADER_SIZE = PAYLOAD.size
+
+_unpack_payload = PAYLOAD.unpack_from
+
+
+# === Offers ===
+def encode_offer(udp_port, tcp_port, load=None):
+    """Pack an offer; load (active sessions) is only included when given."""
+    message = OFFER.pack(MAGIC_COOKIE, OFFER_TYPE, udp_port, tcp_port)
+    if load is not None:
+        message += OFFER_LOAD.pack(min(max(load, 0), 0xFFFF))
+    return message
+
+
+def decode_offer(data):
+    """Return an Offer (load is None if the server did not send it), or None if data is not a valid offer message."""
+    if len(data) < OFFER.size:
+        return None
+    cookie, kind, udp_port, tcp_port = OFFER.unpack_from(data)
+    if cookie != MAGIC_COOKIE or kind != OFFER_TYPE:
+        return None
+    load = OFFER_LOAD.unpack_from(data, OFFER.size)[0] if len(data) >= OFFER.size + OFFER_LOAD.size else None
+    return Offer(udp_port, tcp_port, load)
+
+
+# === Requests ===
+def encode_request(file_size, bitrate=0, segment_size=0, duration_ms=0, flags=0, offset=0, seed=0,
+                   message_type=REQUEST_TYPE):
+    return REQUEST.pack(MAGIC_COOKIE, message_type,
+                        *Request(file_size, bitrate, segment_size, duration_ms, flags, offset, seed))
+
+
+def payload_flags(seed):
+    """The flags asking for the payload of seed: FLAG_RANDOM, or none for the plain payload when seed is None."""
+    return 0 if seed is None else FLAG_RANDOM
+
+
+def encode_range_request(offset, length, seed=None):
+    return encode_request(length, flags=FLAG_RANGE | payload_flags(seed), offset=offset, seed=seed or 0)
+
+
+def encode_echo_request():
+    return encode_request(0, flags=FLAG_ECHO)
+
+
+def encode_file_request(name, offset=0, length=0, flags=0):
+    """Ask for length bytes (0 for the rest) of the named file from offset; flags may add FLAG_RANGE."""
+    encoded = name.encode()
+    if len(encoded) > MAX_FILE_NAME:
+        raise ValueError(f"file name longer than {MAX_FILE_NAME} bytes")
+    return encode_request(length, flags=FLAG_FILE | flags, offset=offset) + FILE_NAME.pack(len(encoded)) + encoded
+
+
+def decode_file_name(data):
+    """
+    Return (file name, bytes after it) from what follows a file request, or None if it is not all there yet.
+
+    Raises ValueError for a name that is too long or not UTF-8.
+    """
+    if len(data) < FILE_NAME.size:
+        return None
+    length, = FILE_NAME.unpack_from(data)
+    if length > MAX_FILE_NAME:
+        raise ValueError("file name too long")
+    end = FILE_NAME.size + length
+    if len(data) < end:
+        return None
+    return bytes(data[FILE_NAME.size:end]).decode(), data[end:]
+
+
+def encode_request_into(buffer, offset, request, message_type=REQUEST_TYPE):
+    """Pack a Request into buffer at offset; returns the number of bytes written."""
+    REQUEST.pack_into(buffer, offset, MAGIC_COOKIE, message_type, *request)
+    return REQUEST.size
+
+
+def decode_request(data, message_type=REQUEST_TYPE):
+    """Return a Request from a binary request (or echo) message, or None."""
+    length = len(data)
+    if length < MIN_REQUEST_SIZE:
+        return None
+    for layout in REQUEST_LAYOUTS:
+        if length >= layout.size:
+            fields = layout.unpack_from(data)
+            break
+    if fields[0] != MAGIC_COOKIE or fields[1] != message_type:
+        return None
+    return Request(*fields[2:])
+
+
+def decode_text_request(data):
+    """Return a Request from the legacy text form, or None."""
+    try:
+        fields = [int(field) for field in bytes(data).decode().split()]
+    except (UnicodeDecodeError, ValueError):
+        return None
+    if not 1 <= len(fields) <= len(REQUEST_FIELDS) or min(fields) < 0:
+        return None
+    return Request(*fields)
+
+
+def parse_request(data):
+    """Decode a request in either the binary or the legacy text form."""
+    if len(data) >= PREFIX.size and PREFIX.unpack_from(data)[0] == MAGIC_COOKIE:
+        return decode_request(data)
+    return decode_text_request(data)
+
+
+def encode_stop():
+    return PREFIX.pack(MAGIC_COOKIE, STOP_TYPE)
+
+
+def is_stop(data):
+    return peek_type(data) == STOP_TYPE
+
+
+def encode_done(segments_sent):
+    return DONE.pack(MAGIC_COOKIE, DONE_TYPE, segments_sent)
+
+
+def decode_done(data):
+    """Return the segment count of a done message, or None."""
+    if len(data) < DONE.size:
+        return None
+    cookie, kind, segments_sent = DONE.unpack_from(data)
+    if cookie != MAGIC_COOKIE or kind != DONE_TYPE:
+        return None
+    return segments_sent
+
+
+def encode_nack(highest, ranges):
+    """Pack a nack; only the first MAX_NACK_RANGES ranges are included."""
+    ranges = ranges[:MAX_NACK_RANGES]
+    message = bytearray(NACK.size + NACK_RANGE.size * len(ranges))
+    NACK.pack_into(message, 0, MAGIC_COOKIE, NACK_TYPE, highest, len(ranges))
+    for index, (first, last) in enumerate(ranges):
+        NACK_RANGE.pack_into(message, NACK.size + index * NACK_RANGE.size, first, last)
+    return bytes(message)
+
+
+def decode_nack(data):
+    """Return (highest segment received, [(first, last), ...]) of a nack, or None."""
+    if len(data) < NACK.size:
+        return None
+    cookie, kind, highest, count = NACK.unpack_from(data)
+    if cookie != MAGIC_COOKIE or kind != NACK_TYPE or len(data) < NACK.size + count * NACK_RANGE.size:
+        return None
+    return highest, [NACK_RANGE.unpack_from(data, NACK.size + index * NACK_RANGE.size) for index in range(count)]
+
+
+def encode_ping(token, size=0):
+    """Pack a ping carrying token, zero-padded to size bytes if that is longer."""
+    message = PING.pack(MAGIC_COOKIE, PING_TYPE, token)
+    if size > len(message):
+        message += bytes(size - len(message))
+    return message
+
+
+def encode_pong(ping):
+    """Turn a received ping into its pong: the same bytes with the pong type."""
+    pong = bytearray(ping)
+    pong[PREFIX.size - 1] = PONG_TYPE
+    return pong
+
+
+def decode_ping(data, message_type=PING_TYPE):
+    """Return the token of a ping (or, with PONG_TYPE, a pong), or None."""
+    if len(data) < PING.size:
+        return None
+    cookie, kind, token = PING.unpack_from(data)
+    if cookie != MAGIC_COOKIE or kind != message_type:
+        return None
+    return token
+
+
+def decode_pong(data):
+    """Return the token of a pong, or None."""
+    return decode_ping(data, PONG_TYPE)
+
+
+def encode_busy(retry_after_ms):
+    return BUSY.pack(MAGIC_COOKIE, BUSY_TYPE, retry_after_ms)
+
+
+def decode_busy(data):
+    """Return the retry-after milliseconds of a busy message, or None."""
+    if len(data) < BUSY.size:
+        return None
+    cookie, kind, retry_after_ms = BUSY.unpack_from(data)
+    if cookie != MAGIC_COOKIE or kind != BUSY_TYPE:
+        return None
+    return retry_after_ms
+
+
+def encode_file(status, size=0):
+    return FILE.pack(MAGIC_COOKIE, FILE_TYPE, status, size)
+
+
+def decode_file(data):
+    """Return (status, file size) of a file message, or None."""
+    if len(data) < FILE.size:
+        return None
+    cookie, kind, status, size = FILE.unpack_from(data)
+    if cookie != MAGIC_COOKIE or kind != FILE_TYPE:
+        return None
+    return status, size
+
+
+# === Payloads ===
+timestamp = time.time_ns
+
+
+def pack_payload_header_into(buffer, offset, total_segments, segment, sent_ns=0):
+    PAYLOAD.pack_into(buffer, offset, MAGIC_COOKIE, PAYLOAD_TYPE, total_segments, segment, sent_ns)
+
+
+def decode_payload_header(data):
+    """
+    Return (total_segments, segment, sent_ns) of a valid payload message, or None.
+
+    This is the per-packet fast path for receivers that only count segments.
+    total_segments is 0 in an open-ended (duration) stream.
+    """
+    try:
+        cookie, kind, total_segments, segment, sent_ns = _unpack_payload(data)
+    except struct.error:
+        return None
+    if cookie != MAGIC_COOKIE or kind != PAYLOAD_TYPE:
+        return None
+    return total_segments, segment, sent_ns
+
+
+def decode_payload(data):
+    """Return (total_segments, segment, data) where data is a memoryview into the message (no copy), or None."""
+    try:
+        cookie, kind, total_segments, segment, _ = _unpack_payload(data)
+    except struct.error:
+        return None
+    if cookie != MAGIC_COOKIE or kind != PAYLOAD_TYPE:
+        return None
+    if not isinstance(data, memoryview):
+        data = memoryview(data)
+    return total_segments, segment, data[PAYLOAD_HEADER_SIZE:]
+
+
+def peek_type(data):
+    """Return the message type of a valid message, or None."""
+    if len(data) < PREFIX.size:
+        return None
+    cookie, kind = PREFIX.unpack_from(data)
+    return kind if cookie == MAGIC_COOKIE else None
+
+
+def benchmark(number=1000000):
+    """Print the per-packet cost of decoding payloads, compared with the old ad hoc parsing."""
+    datagram = bytearray(PAYLOAD.size + 1024)
+    pack_payload_header_into(datagram, 0, 1000, 7)
+    view = memoryview(datagram)
+
+    def legacy():
+        data = bytes(view)
+        cookie, kind, total, segment, sent_ns = struct.unpack(">IBQQQ", data[:29])
+        return cookie == MAGIC_COOKIE and kind == PAYLOAD_TYPE and data[29:]
+
+    runs = [
+        ("legacy unpack+slice", legacy),
+        ("decode_payload", lambda: decode_payload(view)),
+        ("decode_payload_header", lambda: decode_payload_header(view)),
+        ("decode_offer", lambda: decode_offer(encoded_offer)),
+        ("decode_request", lambda: decode_request(encoded_request)),
+    ]
+    encoded_offer = encode_offer(3000, 4000)
+    encoded_request = encode_request(1 << 30, 0, 1024)
+    for name, run in runs:
+        seconds = min(timeit.repeat(run, number=number, repeat=3))
+        print(f"{name:22} {seconds / number * 1e9:7.1f} ns/packet")
+
+
+if __name__ == "__main__":
+    benchmark()
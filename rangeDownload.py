@@ -0,0 +1,213 @@
+"""
+Parallel range downloads: one logical file split across several TCP connections.
+
+Every connection starts with an equal stripe of the file and fetches it in
+chunk_size range requests over one persistent connection, keeping the next
+request queued while it reads the current one. A connection that runs out
+of work steals the back half of the largest stripe left, so a slow
+connection is relieved instead of holding up the end of the download.
+
+With a seed the server sends that seed's pseudo-random payload, and each
+connection can check every range at its offset with an
+integrity.StreamVerifier. With a name the ranges are of that real file on
+the server, and each connection writes them into the output file at their
+offsets with a fileTransfer.FileSink.
+"""
+import collections
+import threading
+import time
+
+import admission
+import fileTransfer
+import integrity
+import protocol
+import receiver
+import socketTuning
+import tcpInfo
+
+DEFAULT_CHUNK_SIZE = 4 * 1024 * 1024
+PIPELINE_DEPTH = 2  # range requests outstanding per connection
+
+
+class RangeScheduler:
+    """Hands out (offset, length) ranges of a file_size-byte file to connections, with work stealing."""
+
+    def __init__(self, file_size, connections, chunk_size=DEFAULT_CHUNK_SIZE):
+        self.chunk_size = chunk_size
+        self.lock = threading.Lock()
+        stripe = -(-file_size // connections)
+        # [next offset, end] of the bytes each connection still has to request
+        self.stripes = [[min(i * stripe, file_size), min((i + 1) * stripe, file_size)] for i in range(connections)]
+        self.orphans = []  # ranges given back by connections that failed
+        self.steals = [0] * connections
+
+    def next_range(self, index):
+        """Claim the next range for connection index, or None when nothing is left to claim."""
+        with self.lock:
+            stripe = self.stripes[index]
+            if stripe[0] >= stripe[1] and not self._refill(index):
+                return None
+            offset = stripe[0]
+            length = min(self.chunk_size, stripe[1] - offset)
+            stripe[0] += length
+            return offset, length
+
+    def _refill(self, index):
+        if self.orphans:
+            self.stripes[index] = list(self.orphans.pop())
+            return True
+        victim = max(self.stripes, key=lambda stripe: stripe[1] - stripe[0])
+        remaining = victim[1] - victim[0]
+        if remaining <= self.chunk_size:
+            return False  # its owner will be done with it as soon as a thief could be
+        middle = victim[0] + remaining // 2
+        self.stripes[index] = [middle, victim[1]]
+        victim[1] = middle
+        self.steals[index] += 1
+        return True
+
+    def give_back(self, offset, length):
+        """Return an unfinished range so another connection fetches it."""
+        if length > 0:
+            with self.lock:
+                self.orphans.append((offset, offset + length))
+
+    def abandon(self, index):
+        """Give back what is left of connection index's stripe, when that connection has failed."""
+        with self.lock:
+            stripe = self.stripes[index]
+            if stripe[0] < stripe[1]:
+                self.orphans.append((stripe[0], stripe[1]))
+            stripe[0] = stripe[1]
+
+    def unclaimed(self):
+        """Bytes no connection has claimed yet, orphans included."""
+        with self.lock:
+            return (sum(end - offset for offset, end in self.stripes if end > offset) +
+                    sum(end - offset for offset, end in self.orphans))
+
+
+def fetch_ranges(server_ip, tcp_port, scheduler, index, buffer_size=receiver.DEFAULT_BUFFER_SIZE, counters=None,
+                 seed=None, sink=None, name=None):
+    """
+    Download the ranges claimed by connection index over one TCP connection into sink (seek()-able), if given.
+
+    With a name the ranges are of that file on the server: the first request
+    names it and is answered with a file message before its bytes.
+
+    :return: (bytes received, ranges fetched, elapsed seconds, socketTuning.describe() of the connection,
+              tcpInfo summary of the connection)
+    """
+    start = time.perf_counter()
+    buffer = receiver.allocate_buffer(buffer_size)
+    pending = collections.deque()
+    received = ranges = 0
+    tuning = path = "not connected"
+    try:
+        claimed = scheduler.next_range(index)
+        if claimed is None:
+            return received, ranges, time.perf_counter() - start, tuning, path
+        pending.append(claimed)
+        # The first request goes out as the connection is admitted, so a busy server is backed off from
+        if name is not None:
+            first = protocol.encode_file_request(name, *claimed, flags=protocol.FLAG_RANGE)
+        else:
+            first = protocol.encode_range_request(*claimed, seed=seed)
+        sock = admission.connect_when_admitted(server_ip, tcp_port, first)
+        if sock is None:
+            raise ConnectionError("server busy")
+        with sock, tcpInfo.sampled(sock) as info:
+            def request_next():
+                claimed = scheduler.next_range(index)
+                if claimed is not None:
+                    sock.sendall(protocol.encode_range_request(*claimed, seed=seed))
+                    pending.append(claimed)
+
+            for _ in range(PIPELINE_DEPTH - 1):
+                request_next()
+            if name is not None:
+                answer = fileTransfer.read_file_answer(sock)
+                if answer is None or answer[0] != protocol.FILE_OK:
+                    raise ConnectionError(fileTransfer.describe_status(answer[0]) if answer else "no answer")
+            while pending:
+                offset, length = pending[0]
+                if sink is not None:
+                    sink.seek(offset)
+                got = receiver.receive_stream(sock, length, buffer, sink, counters)
+                received += got
+                if got < length:
+                    pending[0] = (offset + got, length - got)
+                    break
+                pending.popleft()
+                ranges += 1
+                request_next()
+            if sink is not None:
+                sink.finish()
+            tuning = socketTuning.describe(sock)
+        path = info.summary()
+    except OSError as e:
+        print(f"[TCP-{index + 1}] Range download failed: {e}")
+        scheduler.abandon(index)
+    for offset, length in pending:
+        scheduler.give_back(offset, length)
+    return received, ranges, time.perf_counter() - start, tuning, path
+
+
+def download(server_ip, tcp_port, file_size, connections, buffer_size=receiver.DEFAULT_BUFFER_SIZE,
+             chunk_size=DEFAULT_CHUNK_SIZE, counters=None, seed=None, verify=False, name=None, fd=None):
+    """
+    Download one file_size-byte file split across connections TCP connections and print the aggregate result.
+
+    counters, if given, is one TransferCounters per connection. seed asks
+    for that seed's payload, and verify checks it. name asks for that file
+    from the server's directory instead, written to the open descriptor fd.
+
+    :return: (bytes received, elapsed seconds)
+    """
+    scheduler = RangeScheduler(file_size, connections, chunk_size)
+    results = [None] * connections
+    if fd is not None:
+        sinks = [fileTransfer.FileSink(fd) for _ in range(connections)]
+    elif verify and seed is not None:
+        sinks = [integrity.StreamVerifier(seed) for _ in range(connections)]
+    else:
+        sinks = None
+
+    def run(index):
+        results[index] = fetch_ranges(server_ip, tcp_port, scheduler, index, buffer_size,
+                                      counters[index] if counters else None, seed,
+                                      sinks[index] if sinks else None, name)
+        if counters:
+            counters[index].done = True
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=run, args=(i,), daemon=True) for i in range(connections)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    # Ranges given back after every connection had finished are retried on a fresh connection
+    retried = 0
+    while scheduler.orphans:
+        received, _, _, _, _ = fetch_ranges(server_ip, tcp_port, scheduler, 0, buffer_size, seed=seed,
+                                            sink=sinks[0] if sinks else None, name=name)
+        if not received:
+            break
+        retried += received
+    elapsed = time.perf_counter() - start
+
+    total = sum(result[0] for result in results) + retried
+    for index, (received, ranges, seconds, tuning, path) in enumerate(results):
+        print(f"[TCP-{index + 1}] {received} bytes in {ranges} ranges ({scheduler.steals[index]} stolen), "
+              f"{seconds:.2f} seconds; socket: {tuning}")
+        print(f"[TCP-{index + 1}] path: {path}")
+        if fd is not None:
+            print(f"[TCP-{index + 1}] {sinks[index].summary(received, seconds)}")
+        elif sinks:
+            print(f"[TCP-{index + 1}] verify: {sinks[index].summary(seconds)}")
+    state = "finished" if total >= file_size else f"incomplete ({total} of {file_size} bytes)"
+    print(f"Range download {state} over {connections} TCP connections, completion time: {elapsed:.2f} seconds, "
+          f"total speed: {total * 8 / elapsed:.2f} bits/second")
+    if total < file_size:
+        print(f"Range download is short by {file_size - total} bytes, {scheduler.unclaimed()} of them never fetched")
+    return total, elapsed
@@ -0,0 +1,67 @@
+import time
+
+import eventLog
+
+DEFAULT_BUFFER_SIZE = 256 * 1024
+
+log = eventLog.get_logger("receiver")
+_reads = eventLog.Sampler(log)
+
+
+def allocate_buffer(size=DEFAULT_BUFFER_SIZE):
+    """Preallocate a reusable receive buffer."""
+    return memoryview(bytearray(size))
+
+
+def receive_stream(sock, limit, buffer=None, sink=None, counters=None, until=None):
+    """
+    Read up to limit bytes from a stream socket with recv_into().
+
+    The bytes are only counted; pass a sink (any callable taking a memoryview)
+    to see the data, e.g. an integrity.StreamVerifier or a SaveSink. The view handed to the sink
+    is only valid until the next read. counters (a TransferCounters) gets
+    every read added to it for interval reports. With until (a
+    time.perf_counter() value) reading also stops at the first read after it.
+
+    :return: The number of bytes received.
+    """
+    if buffer is None:
+        buffer = allocate_buffer()
+    size = len(buffer)
+    received = 0
+    trace = _reads if _reads.enabled else None
+    while received < limit:
+        nbytes = sock.recv_into(buffer, min(size, limit - received))
+        if not nbytes:
+            break
+        if sink is not None:
+            sink(buffer[:nbytes])
+        received += nbytes
+        if counters is not None:
+            counters.bytes += nbytes
+            counters.packets += 1
+        if trace is not None:
+            trace.event("Read %d bytes, %d of %d received", nbytes, received, limit)
+        if until is not None and time.perf_counter() >= until:
+            break
+    return received
+
+
+def receive_datagram(sock, buffer):
+    """Receive one datagram into buffer and return (view of the datagram, sender address)."""
+    nbytes, address = sock.recvfrom_into(buffer)
+    return buffer[:nbytes], address
+
+
+class SaveSink:
+    """Writes received bytes to an open binary file."""
+
+    def __init__(self, file):
+        self.file = file
+
+    def __call__(self, view):
+        self.file.write(view)
+
+    def close(self):
+        self.file.close()
+
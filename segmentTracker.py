@@ -0,0 +1,111 @@
+class SegmentTracker:
+    """
+    Tracks which UDP segments arrived using one bit per segment.
+
+    add() is O(1) and keeps the received, duplicate and out-of-order counters;
+    loss runs are derived from the bitmap once the transfer is over.
+    """
+
+    def __init__(self, total_segments):
+        if total_segments <= 0:
+            raise ValueError("total_segments must be positive")
+        self.total_segments = total_segments
+        self.bitmap = bytearray((total_segments + 7) // 8)
+        self.received = 0
+        self.duplicates = 0
+        self.out_of_order = 0
+        self.invalid = 0
+        self.highest = -1
+
+    def add(self, segment):
+        """Record one segment number; returns True if it had not been seen before."""
+        if not 0 <= segment < self.total_segments:
+            self.invalid += 1
+            return False
+        index = segment >> 3
+        mask = 1 << (segment & 7)
+        if self.bitmap[index] & mask:
+            self.duplicates += 1
+            return False
+        self.bitmap[index] |= mask
+        self.received += 1
+        if segment < self.highest:
+            self.out_of_order += 1
+        else:
+            self.highest = segment
+        return True
+
+    def __contains__(self, segment):
+        return 0 <= segment < self.total_segments and bool(self.bitmap[segment >> 3] & (1 << (segment & 7)))
+
+    def resize(self, total_segments):
+        """Change the expected segment count, for open-ended streams whose length is only known at the end."""
+        if total_segments <= 0 or total_segments <= self.highest:
+            raise ValueError("total_segments must cover every segment already received")
+        self.total_segments = total_segments
+        size = (total_segments + 7) // 8
+        if size > len(self.bitmap):
+            self.bitmap.extend(bytes(size - len(self.bitmap)))
+        else:
+            del self.bitmap[size:]
+
+    @property
+    def lost(self):
+        return self.total_segments - self.received
+
+    @property
+    def complete(self):
+        return self.received == self.total_segments
+
+    def missing_ranges(self, first=0, last=None):
+        """Yield (first, last) inclusive ranges of segments that have not arrived, within [first, last]."""
+        bitmap = self.bitmap
+        last = self.total_segments - 1 if last is None else min(last, self.total_segments - 1)
+        start = None
+        for index in range(first >> 3, (last >> 3) + 1):
+            byte = bitmap[index]
+            if byte == 0xFF and start is None:
+                continue
+            if byte == 0 and start is not None:
+                continue
+            base = index << 3
+            for bit in range(8):
+                segment = base + bit
+                if segment < first or segment > last:
+                    continue
+                if byte & (1 << bit):
+                    if start is not None:
+                        yield start, segment - 1
+                        start = None
+                elif start is None:
+                    start = segment
+        if start is not None:
+            yield start, last
+
+    def loss_runs(self):
+        """Return (number of loss runs, longest run in segments)."""
+        runs = 0
+        longest = 0
+        for first, last in self.missing_ranges():
+            runs += 1
+            longest = max(longest, last - first + 1)
+        return runs, longest
+
+    def stats(self):
+        runs, longest = self.loss_runs()
+        return {
+            "total": self.total_segments,
+            "received": self.received,
+            "lost": self.lost,
+            "duplicates": self.duplicates,
+            "out_of_order": self.out_of_order,
+            "invalid": self.invalid,
+            "loss_runs": runs,
+            "longest_loss_run": longest,
+        }
+
+    def summary(self):
+        stats = self.stats()
+        return (f"received {stats['received']}/{stats['total']}, lost {stats['lost']}, "
+                f"duplicates {stats['duplicates']}, out of order {stats['out_of_order']}, "
+                f"loss runs {stats['loss_runs']} (longest {stats['longest_loss_run']})")
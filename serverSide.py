@@ -1,16 +1,30 @@
+import collections
+import select
 import socket
-import struct
 import threading
 import time
 
-MAGIC_COOKIE = 0xabcddcba
-OFFER_TYPE = 0x2
-REQUEST_TYPE = 0x3
-PAYLOAD_TYPE = 0x4
+import admission
+import asyncServer
+import eventLog
+import pacer
+import payloadSource
+import protocol
+import socketTuning
+import tcpInfo
+import tcpSender
+import udpSender
+import workerPool
+from payloadSource import PayloadSource
+
 SERVER_TCP_PORT = 4000
 SERVER_UDP_PORT = 3000
 BROADCAST_PORT=8000
 BUFFER_SIZE = 1024
+TCP_CHUNK_SIZE = tcpSender.DEFAULT_CHUNK_SIZE
+UDP_PAYLOAD = PayloadSource(2 ** 63 - 1, fill=b'B')
+
+log = eventLog.get_logger("serverSide")
 
 RESET = "\033[0m"
 BOLD = "\033[1m"
@@ -19,14 +33,14 @@ GREEN = "\033[92m"
 CYAN = "\033[96m"
 YELLOW = "\033[93m"
 
-def broadcast_offers():
-    """Broadcast UDP offer messages to clients."""
+def broadcast_offers(load=None):
+    """Broadcast UDP offer messages to clients; load, if given, returns the session count to advertise."""
     with socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP) as udp_socket:
         udp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
-        message = build_message(OFFER_TYPE, f"{SERVER_UDP_PORT} {SERVER_TCP_PORT}")
         while True:
+            message = protocol.encode_offer(SERVER_UDP_PORT, SERVER_TCP_PORT, load() if load else None)
             udp_socket.sendto(message, ('<broadcast>', BROADCAST_PORT))
-            print_in_color("Broadcast offer message sent.", color='yellow')
+            log.debug("Broadcast offer message sent.")
             time.sleep(1)
 
 
@@ -35,87 +49,227 @@ def print_in_color(message, color):
     print(f"{color}{message}\033[0m")
 
 
-def build_message(message_type, content=''):
-    """Builds a formatted UDP message."""
-    return struct.pack('>IB', MAGIC_COOKIE, message_type) + content.encode()
-
-def start_tcp_server(ip_server, server_port):
-    """TCP server to handle incoming connections and send data."""
+def start_tcp_server(ip_server, server_port, chunk_size=TCP_CHUNK_SIZE, reuse_port=False, gate=None):
+    """TCP server to handle incoming connections and send data; gate (an Admission) limits the sessions."""
+    if gate is None:
+        gate = admission.Admission()
     with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as tcp_socket:
+        # Rebind right away after a restart even while old connections sit in TIME_WAIT
+        tcp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reuse_port:
+            workerPool.reuse_port(tcp_socket)
+        socketTuning.tune_tcp(tcp_socket)
         tcp_socket.bind(("", SERVER_TCP_PORT))
-        tcp_socket.listen()
+        tcp_socket.listen(socket.SOMAXCONN)
         while True:
             client_conn, client_addr = tcp_socket.accept()
-            print_in_color(f"DBG: Server listening on {ip_server}:{server_port}", GREEN)
-            threading.Thread(target=handle_tcp_client, args=(client_conn, client_addr)).start()
+            log.debug("Accepted %s on %s:%s", client_addr, ip_server, server_port)
+            threading.Thread(target=handle_tcp_client, args=(client_conn, client_addr, chunk_size, gate)).start()
 
-def handle_tcp_client(client_socket, address):
+def handle_tcp_client(client_socket, address, chunk_size=TCP_CHUNK_SIZE, gate=None):
+    if gate is None:
+        gate = admission.Admission()
     try:
-        data = client_socket.recv(1024).decode().strip()
-        if data:
-            file_size = int(data)
-            print(f"TCP request for {file_size} bytes from {address}")
-            sent = 0
-            while sent < file_size:
-                to_send = min(1024, file_size - sent)
-                client_socket.send(b'A' * to_send)
-                sent += to_send
+        socketTuning.tune_tcp(client_socket)
+        with gate.session(address[0], "tcp") as share:
+            if share is None:
+                log.info("TCP client %s turned away, server busy", address)
+                client_socket.sendall(protocol.encode_busy(gate.retry_after_ms()))
+                tcpSender.linger(client_socket)
+                return
+            with tcpInfo.sampled(client_socket) as info:
+                data = client_socket.recv(1024)
+                request = protocol.parse_request(data)
+                if request is not None and request.flags & protocol.FLAG_FILE:
+                    log.info("TCP file request from %s, but files are only served by main.py", address)
+                    client_socket.sendall(protocol.encode_file(protocol.FILE_NOT_SERVED))
+                    tcpSender.linger(client_socket)
+                elif request is not None and request.flags & protocol.FLAG_ECHO:
+                    log.info("TCP echo request from %s", address)
+                    sent, elapsed = tcpSender.echo(client_socket, data[protocol.REQUEST.size:])
+                    workerPool.record("tcp_sessions")
+                    workerPool.record("tcp_bytes", sent)
+                    log.info("TCP echoed %s to %s", tcpSender.format_rate(sent, elapsed), address)
+                elif request is not None and request.flags & protocol.FLAG_RANGE:
+                    sent, ranges, elapsed = tcpSender.send_ranges(client_socket, data,
+                                                                  tcpSender.payload_for(request, chunk_size=chunk_size),
+                                                                  pacer=share.pacer)
+                    workerPool.record("tcp_sessions")
+                    workerPool.record("tcp_bytes", sent)
+                    log.info("TCP sent %d ranges, %s to %s; socket: %s", ranges, tcpSender.format_rate(sent, elapsed), address,
+                             socketTuning.describe(client_socket))
+                elif request is not None and request.duration_ms:
+                    log.info("TCP request for %d ms from %s", request.duration_ms, address)
+                    sent, elapsed = tcpSender.send_for(client_socket, request.duration_ms / 1000,
+                                                       tcpSender.payload_for(request, chunk_size=chunk_size),
+                                                       limit=request.file_size, pacer=share.pacer)
+                    workerPool.record("tcp_sessions")
+                    workerPool.record("tcp_bytes", sent)
+                    log.info("TCP sent %s to %s; socket: %s", tcpSender.format_rate(sent, elapsed), address,
+                             socketTuning.describe(client_socket))
+                elif request is not None:
+                    file_size = request.file_size
+                    log.info("TCP request for %d bytes from %s", file_size, address)
+                    sent, elapsed = tcpSender.send_stream(client_socket, file_size,
+                                                          tcpSender.payload_for(request, chunk_size=chunk_size),
+                                                          pacer=share.pacer)
+                    workerPool.record("tcp_sessions")
+                    workerPool.record("tcp_bytes", sent)
+                    log.info("TCP sent %s to %s; socket: %s", tcpSender.format_rate(sent, elapsed), address,
+                             socketTuning.describe(client_socket))
+            log.info("TCP path to %s: %s", address, info.summary())
     except Exception as e:
-        print(f"Error handling TCP client {address}: {e}")
+        log.error("Error handling TCP client %s: %s", address, e)
     finally:
         client_socket.close()
-        print(f"TCP connection closed with {address}")
+        log.debug("TCP connection closed with %s", address)
 
-def start_udp_server(udp_port):
+def start_udp_server(udp_port, reuse_port=False, gate=None):
     with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as server_socket:
+        if reuse_port:
+            workerPool.reuse_port(server_socket)
+        socketTuning.tune_udp(server_socket)
         server_socket.bind(('', udp_port))
-        print(f"UDP Server is listening on port {udp_port}")
-        handle_udp_client(server_socket, 1024)
+        log.info("UDP Server is listening on port %d; socket: %s", udp_port, socketTuning.describe(server_socket))
+        handle_udp_client(server_socket, 1024, timeout=None, gate=gate)
+
+def session_feedback(sock, address, pending, buffer_size=1024):
+    """
+    Return a feedback() for a UDP session with address that never blocks.
+
+    It reads whatever is waiting on the shared server socket and returns the
+    stop and nack messages from address. Pings are answered at once, so a
+    busy server still measures its true RTT; anything else is queued on
+    pending for the request loop.
+    """
+    def feedback():
+        messages = []
+        while select.select([sock], [], [], 0)[0]:
+            data, sender = sock.recvfrom(buffer_size)
+            kind = protocol.peek_type(data)
+            if kind == protocol.PING_TYPE:
+                sock.sendto(protocol.encode_pong(data), sender)
+            elif sender == address and kind in (protocol.STOP_TYPE, protocol.NACK_TYPE):
+                messages.append(data)
+            else:
+                pending.append((data, sender))
+        return messages
+    return feedback
 
-def handle_udp_client(server_socket, buffer_size, timeout=1):
+def handle_udp_client(server_socket, buffer_size, timeout=1, gate=None):
+    """Serve UDP requests one after another; a request that gate (an Admission) has no room for gets a busy message."""
+    if gate is None:
+        gate = admission.Admission()
     server_socket.settimeout(timeout)
+    pending = collections.deque()
     try:
         while True:
-            data, address = server_socket.recvfrom(buffer_size)
-            file_size = int(data.decode().strip())
-            print(f"UDP request for {file_size} bytes from {address}")
-            segments = (file_size + buffer_size - 1) // buffer_size
-            for i in range(segments):
-                payload = b'B' * min(buffer_size, file_size - (i * buffer_size))
-                server_socket.sendto(payload, address)
-            print(f"All UDP packets sent to {address}")
+            data, address = pending.popleft() if pending else server_socket.recvfrom(buffer_size)
+            if protocol.peek_type(data) == protocol.PING_TYPE:
+                server_socket.sendto(protocol.encode_pong(data), address)
+                continue
+            request = protocol.parse_request(data)
+            if request is None:
+                continue
+            if not request.segment_size:
+                request = request._replace(segment_size=buffer_size)
+            if request.duration_ms:
+                log.info("UDP request for %d ms at %s bits/second from %s", request.duration_ms, request.bitrate or "unpaced", address)
+            else:
+                log.info("UDP request for %d bytes at %s bits/second from %s", request.file_size, request.bitrate or "unpaced", address)
+            with gate.session(address[0], "udp", request.bitrate, wait=False) as share:
+                if share is None:
+                    log.info("UDP client %s turned away, server busy", address)
+                    server_socket.sendto(protocol.encode_busy(gate.retry_after_ms()), address)
+                    continue
+                segment_size, sent, size, elapsed = udpSender.send_response(
+                    server_socket, address, payloadSource.for_request(request, UDP_PAYLOAD), request, share.pacer,
+                    session_feedback(server_socket, address, pending, buffer_size))
+            workerPool.record("udp_sessions")
+            workerPool.record("udp_bytes", size)
+            log.info("All %d UDP packets (%d bytes each) sent to %s, %s", sent, segment_size, address,
+                     pacer.rate_report(size, elapsed, request.bitrate))
     except socket.timeout:
-        print("UDP listen timed out - no data received for 1 second")
+        log.info("UDP listen timed out - no data received for %s seconds", timeout)
     finally:
-        print("UDP server socket closed")
-
-def send_payload(sock, addr, file_size):
-    segments = (file_size + 1023) // 1024
-    for i in range(segments):
-        payload = b'A' * min(1024, file_size - (i * 1024))
-        packet = struct.pack('>IBQQ', MAGIC_COOKIE, PAYLOAD_TYPE, segments, i + 1) + payload
-        sock.sendto(packet, addr)
-        print(f"Sent segment {i + 1}/{segments}to{addr}")
-
-def main():
-    """Main function to start TCP and UDP servers."""
-    # Start UDP offer broadcasting in a separate thread
-    print_in_color("Starting offer broadcasting...", CYAN)
-    threading.Thread(target=broadcast_offers, daemon=True).start()
+        log.info("UDP server socket closed")
+
+def send_payload(sock, addr, file_size, bitrate=0):
+    sent, elapsed = udpSender.send_segments(sock, addr, PayloadSource(file_size, fill=b'A'), BUFFER_SIZE,
+                                            pacer=pacer.make_pacer(bitrate))
+    log.info("Sent %d segments to %s in %.2fs", sent, addr, elapsed)
+
+def serve(engine="threads", chunk_size=TCP_CHUNK_SIZE, broadcast=True, reuse_port=False, max_sessions=0,
+          max_queued=admission.DEFAULT_MAX_QUEUED, egress_limit=0):
+    """
+    Run one server instance; workers run it with broadcast off and reuse_port on.
+
+    max_sessions, max_queued and egress_limit configure its Admission (0 for no cap or limit).
+    """
+    gate = admission.Admission(max_sessions, max_queued, egress_bps=egress_limit)
+    threading.Thread(target=admission.report_shares, args=(gate,), daemon=True).start()
+    if engine == "asyncio":
+        # Serve TCP, UDP and offers from a single event loop
+        print_in_color("Starting event-loop server...", CYAN)
+        offer = protocol.encode_offer(SERVER_UDP_PORT, SERVER_TCP_PORT) if broadcast else None
+        asyncServer.run(SERVER_TCP_PORT, SERVER_UDP_PORT, BROADCAST_PORT, offer, BUFFER_SIZE, chunk_size, reuse_port,
+                        gate)
+        return
+
+    if broadcast:
+        # Start UDP offer broadcasting in a separate thread
+        print_in_color("Starting offer broadcasting...", CYAN)
+        threading.Thread(target=broadcast_offers, args=(workerPool.current_load,), daemon=True).start()
 
     # Start UDP server in a separate thread
     print_in_color("Starting UDP server...", CYAN)
-    threading.Thread(target=start_udp_server, args=(SERVER_UDP_PORT,), daemon=True).start()
+    threading.Thread(target=start_udp_server, args=(SERVER_UDP_PORT, reuse_port, gate), daemon=True).start()
 
     # Start TCP server in the main thread
     print_in_color("Starting TCP server...", CYAN)
-    start_tcp_server("", SERVER_TCP_PORT)
+    start_tcp_server("", SERVER_TCP_PORT, chunk_size, reuse_port, gate)
+
+
+def main(engine="threads", chunk_size=TCP_CHUNK_SIZE, workers=1, max_sessions=0,
+         max_queued=admission.DEFAULT_MAX_QUEUED, egress_limit=0):
+    """Main function to start TCP and UDP servers; with several workers the limits apply to each."""
+    if workers == 1:
+        serve(engine, chunk_size, True, False, max_sessions, max_queued, egress_limit)
+        return
+
+    # Broadcast once from the supervisor; the workers share the ports with SO_REUSEPORT
+    print_in_color("Starting offer broadcasting...", CYAN)
+    threading.Thread(target=broadcast_offers, daemon=True).start()
+    workerPool.run_pool(serve, (engine, chunk_size, False, True, max_sessions, max_queued, egress_limit),
+                        workers or None)
 
 
 if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Speed test server.")
+    parser.add_argument("--engine", choices=["threads", "asyncio"], default="threads",
+                        help="Thread per connection or a single asyncio event loop.")
+    parser.add_argument("--chunk_size", type=int, default=TCP_CHUNK_SIZE,
+                        help="Bytes handed to sendfile() per call on TCP connections.")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Worker processes sharing the ports, 0 for one per CPU.")
+    parser.add_argument("--profile", choices=sorted(socketTuning.PROFILES), default=socketTuning.DEFAULT_PROFILE,
+                        help="Socket tuning profile for every TCP and UDP socket.")
+    parser.add_argument("--max_sessions", type=int, default=0,
+                        help="Sessions served at once per worker, 0 for no cap.")
+    parser.add_argument("--max_queued", type=int, default=admission.DEFAULT_MAX_QUEUED,
+                        help="TCP connections waiting for a session slot before clients are told to back off.")
+    parser.add_argument("--egress_limit", type=int, default=0,
+                        help="Egress bits/second per worker, shared fairly between clients; 0 for no limit.")
+    eventLog.add_arguments(parser)
+    args = parser.parse_args()
+    eventLog.setup(args.log_level)
+    socketTuning.select(args.profile)
+
     print_in_color("Server is starting...", BOLD)
     try:
-        main()
+        main(args.engine, args.chunk_size, args.workers, args.max_sessions, args.max_queued, args.egress_limit)
     except KeyboardInterrupt:
         print_in_color("\nServer shutting down gracefully.", RED)
     except Exception as e:
@@ -0,0 +1,185 @@
+"""
+Socket tuning profiles, applied to every TCP and UDP socket on both sides.
+
+A profile picks the socket buffer sizes, TCP_NODELAY, TCP_NOTSENT_LOWAT and
+the congestion control algorithm. Buffers are either left to the kernel
+(None), fixed, or AUTO: twice the bandwidth-delay product of the profile's
+target bandwidth and the path RTT. Clients take the RTT from the discovery
+pings (set_path_rtt), servers from each connection's handshake (TCP_INFO).
+Where the kernel's own TCP buffer autotuning already reaches the wanted
+size the buffer is left alone, since setting it turns autotuning off.
+
+Options the platform or kernel refuses are skipped, so describe() is the
+place to see what a socket really got. select() picks the profile for the
+whole process, like eventLog.setup() does for logging.
+"""
+import collections
+import socket
+import sys
+
+import tcpInfo
+
+AUTO = "auto"
+MIN_BUFFER = 64 * 1024
+MAX_BUFFER = 64 * 1024 * 1024
+DEFAULT_RTT = 0.05  # seconds, for AUTO buffers when no RTT was measured
+
+LINUX = sys.platform.startswith("linux")
+SO_SNDBUFFORCE = getattr(socket, "SO_SNDBUFFORCE", 32 if LINUX else None)  # beyond wmem_max, needs CAP_NET_ADMIN
+SO_RCVBUFFORCE = getattr(socket, "SO_RCVBUFFORCE", 33 if LINUX else None)
+TCP_CONGESTION = getattr(socket, "TCP_CONGESTION", 13 if LINUX else None)
+TCP_NOTSENT_LOWAT = getattr(socket, "TCP_NOTSENT_LOWAT", 25 if LINUX else None)
+CONGESTION_NAME_SIZE = 16
+
+TuningProfile = collections.namedtuple(
+    "TuningProfile", "tcp_buffer udp_buffer nodelay notsent_lowat congestion target_bps")
+
+PROFILES = {
+    # Kernel defaults: what the sockets got before profiles existed
+    "default": TuningProfile(None, None, False, None, (), 0),
+    # Short RTTs: TCP autotuning copes, UDP receivers need room for bursts
+    "lan": TuningProfile(None, 4 * 1024 * 1024, False, None, ("cubic",), 10 * 10 ** 9),
+    # High bandwidth-delay paths: buffers sized from the RTT, BBR, and a low-water mark so
+    # the send queue does not add a second RTT of delay
+    "wan-long-fat": TuningProfile(AUTO, AUTO, False, 256 * 1024, ("bbr", "cubic"), 10 ** 9),
+    # Small messages: no Nagle, barely any queue in the kernel
+    "low-latency": TuningProfile(None, 256 * 1024, True, 16 * 1024, ("bbr", "cubic"), 100 * 10 ** 6),
+}
+DEFAULT_PROFILE = "default"
+
+_profile_name = DEFAULT_PROFILE
+_profile = PROFILES[DEFAULT_PROFILE]
+_path_rtt = None
+
+
+def select(name):
+    """Use the named profile for every socket tuned from now on."""
+    global _profile_name, _profile
+    _profile = PROFILES[name]
+    _profile_name = name
+
+
+def set_path_rtt(rtt):
+    """Remember the measured RTT to the server (seconds, or None) for sizing AUTO buffers."""
+    global _path_rtt
+    _path_rtt = rtt
+
+
+def buffer_size(target_bps, rtt):
+    """Twice the bandwidth-delay product, so the window still covers the path while losses are repaired."""
+    return max(MIN_BUFFER, min(MAX_BUFFER, int(2 * target_bps / 8 * rtt)))
+
+
+def handshake_rtt(sock):
+    """The kernel's smoothed RTT of a connected TCP socket in seconds, or None where TCP_INFO is unavailable."""
+    info = tcpInfo.read(sock)
+    return info.srtt_us / 1e6 if info is not None and info.srtt_us else None
+
+
+def _autotune_limit(sysctl):
+    """The largest buffer TCP autotuning grows to (the last field of net.ipv4.tcp_rmem/tcp_wmem), or None."""
+    try:
+        with open(f"/proc/sys/net/ipv4/{sysctl}") as f:
+            return int(f.read().split()[-1])
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def _set_buffer(sock, option, force_option, size, autotune_sysctl=None):
+    if autotune_sysctl is not None:
+        limit = _autotune_limit(autotune_sysctl)
+        if limit is not None and limit >= size:
+            return
+    if force_option is not None:
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, force_option, size)
+            return
+        except OSError:
+            pass
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, option, size)
+    except OSError:
+        pass
+
+
+def _wanted_buffer(size, rtt):
+    if size != AUTO:
+        return size
+    return buffer_size(_profile.target_bps, rtt or _path_rtt or DEFAULT_RTT)
+
+
+def tune_tcp(sock, rtt=None):
+    """
+    Apply the profile to a TCP socket; rtt (seconds) overrides the measured one for AUTO buffers.
+
+    The receive buffer decides the window scale, so clients tune before connecting.
+    """
+    profile = _profile
+    size = _wanted_buffer(profile.tcp_buffer, rtt or (handshake_rtt(sock) if profile.tcp_buffer == AUTO else None))
+    if size:
+        _set_buffer(sock, socket.SO_SNDBUF, SO_SNDBUFFORCE, size, "tcp_wmem")
+        _set_buffer(sock, socket.SO_RCVBUF, SO_RCVBUFFORCE, size, "tcp_rmem")
+    if profile.nodelay:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    if profile.notsent_lowat and TCP_NOTSENT_LOWAT is not None:
+        try:
+            sock.setsockopt(socket.IPPROTO_TCP, TCP_NOTSENT_LOWAT, profile.notsent_lowat)
+        except OSError:
+            pass
+    if TCP_CONGESTION is not None:
+        for name in profile.congestion:
+            try:
+                sock.setsockopt(socket.IPPROTO_TCP, TCP_CONGESTION, name.encode())
+                break
+            except OSError:
+                continue  # not built into this kernel, or not in tcp_allowed_congestion_control
+    return sock
+
+
+def tune_udp(sock, rtt=None):
+    """Apply the profile's buffer size to a UDP socket; UDP has no autotuning, so it is always set."""
+    size = _wanted_buffer(_profile.udp_buffer, rtt)
+    if size:
+        _set_buffer(sock, socket.SO_SNDBUF, SO_SNDBUFFORCE, size)
+        _set_buffer(sock, socket.SO_RCVBUF, SO_RCVBUFFORCE, size)
+    return sock
+
+
+def connect_tcp(address, rtt=None, timeout=None):
+    """Like socket.create_connection() for IPv4, with the socket tuned before it connects."""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        tune_tcp(sock, rtt)
+        if timeout is not None:
+            sock.settimeout(timeout)
+        sock.connect(address)
+    except OSError:
+        sock.close()
+        raise
+    return sock
+
+
+def _format_bytes(size):
+    for unit in ("bytes", "KiB", "MiB"):
+        if size < 1024 or unit == "MiB":
+            return f"{size:.0f} {unit}" if unit == "bytes" else f"{size:.1f} {unit}"
+        size /= 1024
+
+
+def describe(sock):
+    """The profile and the values the kernel actually uses for a socket, as one line."""
+    parts = []
+    try:
+        parts.append(f"sndbuf {_format_bytes(sock.getsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF))}")
+        parts.append(f"rcvbuf {_format_bytes(sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF))}")
+        if sock.type == socket.SOCK_STREAM:
+            parts.append("nodelay " + ("on" if sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY) else "off"))
+            if TCP_CONGESTION is not None:
+                name = sock.getsockopt(socket.IPPROTO_TCP, TCP_CONGESTION, CONGESTION_NAME_SIZE).split(b"\0", 1)[0]
+                parts.append(f"congestion {name.decode()}")
+            if TCP_NOTSENT_LOWAT is not None:
+                lowat = sock.getsockopt(socket.IPPROTO_TCP, TCP_NOTSENT_LOWAT)
+                parts.append(f"notsent_lowat {_format_bytes(lowat) if 0 < lowat < 2 ** 31 - 1 else 'unset'}")
+    except OSError:
+        pass
+    return f"{_profile_name} profile, " + ", ".join(parts)
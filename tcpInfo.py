@@ -0,0 +1,186 @@
+"""
+Live TCP_INFO sampling: how a connection's RTT, congestion window, retransmits
+and rates evolve during a transfer.
+
+One background thread samples every watched socket each SAMPLE_INTERVAL
+seconds with getsockopt(TCP_INFO), so the send and receive loops are left
+alone. Each connection keeps its samples as a compact time series, one
+array per field; a long transfer halves its resolution rather than growing
+past MAX_SAMPLES. summary() condenses the series into one report line.
+
+The sender's view is the telling one: the congestion window, retransmits,
+pacing and delivery rates, and how long the connection was held back by the
+peer's receive window or its own send buffer. The receiver mostly adds its
+RTT estimate. Where TCP_INFO is unavailable (not Linux) the series stays
+empty and the summary says so.
+"""
+import array
+import collections
+import contextlib
+import socket
+import struct
+import sys
+import threading
+import time
+
+SAMPLE_INTERVAL = 0.1  # seconds
+MAX_SAMPLES = 4096
+
+TCP_INFO = getattr(socket, "TCP_INFO", 11 if sys.platform.startswith("linux") else None)
+TCP_INFO_SIZE = 192  # up to tcpi_sndbuf_limited; older kernels return less
+
+# Offsets into Linux's struct tcp_info (include/uapi/linux/tcp.h)
+_FIELDS = (
+    ("snd_mss", 16, "I"),
+    ("srtt_us", 68, "I"),
+    ("rttvar_us", 72, "I"),
+    ("snd_cwnd", 80, "I"),
+    ("total_retrans", 100, "I"),
+    ("pacing_rate", 104, "Q"),  # bytes/second
+    ("delivery_rate", 160, "Q"),  # bytes/second
+    ("busy_time_us", 168, "Q"),
+    ("rwnd_limited_us", 176, "Q"),
+    ("sndbuf_limited_us", 184, "Q"),
+)
+_DECODERS = [(name, offset, struct.Struct("=" + code)) for name, offset, code in _FIELDS]
+UNLIMITED_RATE = 2 ** 64 - 1  # pacing_rate while the socket is not paced
+
+TcpInfo = collections.namedtuple("TcpInfo", [name for name, _, _ in _FIELDS])
+
+
+def read(sock):
+    """Decode the fields above from a TCP socket's TCP_INFO, or None; fields the kernel is too old for read 0."""
+    if TCP_INFO is None:
+        return None
+    try:
+        data = sock.getsockopt(socket.IPPROTO_TCP, TCP_INFO, TCP_INFO_SIZE)
+    except OSError:
+        return None
+    return TcpInfo(*[decoder.unpack_from(data, offset)[0] if offset + decoder.size <= len(data) else 0
+                     for _, offset, decoder in _DECODERS])
+
+
+class TcpInfoSeries:
+    """The sampled TCP_INFO of one connection: times in ms since watching began, and one array per field."""
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.start = time.perf_counter()
+        self.times_ms = array.array("I")
+        self.srtt_us = array.array("I")
+        self.rttvar_us = array.array("I")
+        self.snd_cwnd = array.array("I")
+        self.total_retrans = array.array("I")
+        self.pacing_rate = array.array("Q")
+        self.delivery_rate = array.array("Q")
+        self.last = None
+        self.stride = 1
+        self.ticks = 0
+
+    def sample(self, force=False):
+        """Take a sample; when thinned out, only every stride-th tick is kept unless force."""
+        self.record(read(self.sock), force)
+
+    def record(self, info, force=False):
+        """Add a TcpInfo read from the socket (None is ignored), as sample() does."""
+        if info is None:
+            return
+        self.last = info
+        self.ticks += 1
+        if self.ticks % self.stride and not force:
+            return
+        if len(self.times_ms) >= MAX_SAMPLES:
+            self._thin()
+        self.times_ms.append(int((time.perf_counter() - self.start) * 1000))
+        self.srtt_us.append(info.srtt_us)
+        self.rttvar_us.append(info.rttvar_us)
+        self.snd_cwnd.append(info.snd_cwnd)
+        self.total_retrans.append(info.total_retrans)
+        self.pacing_rate.append(info.pacing_rate)
+        self.delivery_rate.append(info.delivery_rate)
+
+    def _thin(self):
+        for name in ("times_ms", "srtt_us", "rttvar_us", "snd_cwnd", "total_retrans", "pacing_rate", "delivery_rate"):
+            setattr(self, name, getattr(self, name)[::2])
+        self.stride *= 2
+
+    def __len__(self):
+        return len(self.times_ms)
+
+    def summary(self):
+        """One line: RTT, cwnd, retransmits, rates and what the connection was limited by."""
+        if not self.times_ms:
+            return "no TCP_INFO samples"
+        parts = [f"{len(self)} samples over {self.times_ms[-1] / 1000:.2f}s"]
+        parts.append(f"srtt min {min(self.srtt_us) / 1000:.3f}, mean {sum(self.srtt_us) / len(self) / 1000:.3f}, "
+                     f"max {max(self.srtt_us) / 1000:.3f} ms (rttvar max {max(self.rttvar_us) / 1000:.3f} ms)")
+        parts.append(f"cwnd {min(self.snd_cwnd)}-{max(self.snd_cwnd)} segments of {self.last.snd_mss} bytes "
+                     f"(last {self.snd_cwnd[-1]})")
+        retransmits = self.total_retrans[-1] - self.total_retrans[0]
+        growing = sum(1 for before, after in zip(self.total_retrans, self.total_retrans[1:]) if after > before)
+        parts.append(f"retransmits {self.total_retrans[-1]}" +
+                     (f" ({retransmits} during the test, in {growing} of {len(self) - 1} intervals)" if retransmits else ""))
+        delivery = sorted(self.delivery_rate)
+        parts.append(f"delivery rate median {delivery[len(delivery) // 2] * 8:,.0f}, max {delivery[-1] * 8:,.0f} bits/second")
+        paced = [rate for rate in self.pacing_rate if rate != UNLIMITED_RATE]
+        if paced:
+            parts.append(f"pacing rate last {paced[-1] * 8:,.0f} bits/second")
+        if self.last.busy_time_us:
+            parts.append(f"busy {self.last.busy_time_us / 1e6:.2f}s, "
+                         f"receive-window-limited {self.last.rwnd_limited_us / self.last.busy_time_us * 100:.1f}%, "
+                         f"send-buffer-limited {self.last.sndbuf_limited_us / self.last.busy_time_us * 100:.1f}%")
+        return ", ".join(parts)
+
+
+_watched = set()
+_lock = threading.Lock()
+_thread = None
+
+
+def _run(interval):
+    next_tick = time.perf_counter()
+    while True:
+        next_tick = max(next_tick + interval, time.perf_counter())
+        delay = next_tick - time.perf_counter()  # a sweep that overran leaves none
+        if delay > 0:
+            time.sleep(delay)
+        # Read every socket without the lock, so watch() and unwatch() (called from event loops) never wait a sweep
+        with _lock:
+            watched = list(_watched)
+        readings = [(series, read(series.sock)) for series in watched]
+        with _lock:
+            for series, info in readings:
+                if series in _watched:
+                    series.record(info)
+
+
+def watch(sock):
+    """Start sampling a connected TCP socket and return its TcpInfoSeries."""
+    global _thread
+    series = TcpInfoSeries(sock)
+    series.sample(force=True)
+    with _lock:
+        _watched.add(series)
+        if _thread is None:
+            _thread = threading.Thread(target=_run, args=(SAMPLE_INTERVAL,), name="tcp-info", daemon=True)
+            _thread.start()
+    return series
+
+
+def unwatch(series):
+    """Stop sampling, taking one last sample so even a short transfer has its end state."""
+    info = read(series.sock)
+    with _lock:
+        _watched.discard(series)
+        series.record(info, force=True)
+    return series
+
+
+@contextlib.contextmanager
+def sampled(sock):
+    """Sample sock's TCP_INFO for the duration of the block, which gets the TcpInfoSeries."""
+    series = watch(sock)
+    try:
+        yield series
+    finally:
+        unwatch(series)
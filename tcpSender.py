@@ -0,0 +1,244 @@
+import collections
+import os
+import select
+import socket
+import tempfile
+import threading
+import time
+
+import payloadSource
+import protocol
+
+DEFAULT_CHUNK_SIZE = 4 * 1024 * 1024
+TMPFS_DIR = "/dev/shm"
+MIN_TIMED_CHUNK = 64 * 1024
+TIMED_CALL_SECONDS = 0.05  # aim for this much data per sendfile() call in timed sends
+LINGER_SECONDS = 1
+
+_shared_payloads = {}
+_seeded_payloads = collections.OrderedDict()
+_shared_lock = threading.Lock()
+
+
+class PayloadFile:
+    """A payload block kept in a tmpfs-backed file so it can be sent with sendfile(); block overrides fill."""
+
+    def __init__(self, size=DEFAULT_CHUNK_SIZE, fill=b'A', block=None):
+        directory = TMPFS_DIR if os.access(TMPFS_DIR, os.W_OK) else None
+        if block is None:
+            block = fill * size
+        self.size = len(block)
+        self.file = tempfile.TemporaryFile(dir=directory)
+        self.file.write(block)
+        self.file.flush()
+
+    def fileno(self):
+        return self.file.fileno()
+
+    def close(self):
+        self.file.close()
+
+
+def shared_payload(chunk_size=DEFAULT_CHUNK_SIZE, fill=b'A'):
+    """Return the process-wide payload file for this chunk size, creating it on first use."""
+    key = (chunk_size, fill)
+    with _shared_lock:
+        payload = _shared_payloads.get(key)
+        if payload is None:
+            payload = _shared_payloads[key] = PayloadFile(chunk_size, fill)
+        return payload
+
+
+def seeded_payload(seed):
+    """
+    Return the payload file of seed's pattern (payloadSource.pattern), creating it on first use.
+
+    Only the most recent seeds are kept; a file dropped from the cache stays
+    open until the last send using it lets go of it.
+    """
+    with _shared_lock:
+        payload = _seeded_payloads.pop(seed, None)
+        if payload is None:
+            payload = PayloadFile(block=payloadSource.pattern(seed))
+        _seeded_payloads[seed] = payload
+        while len(_seeded_payloads) > payloadSource.MAX_CACHED_PATTERNS:
+            _seeded_payloads.popitem(last=False)
+        return payload
+
+
+def payload_for(request, payload=None, chunk_size=DEFAULT_CHUNK_SIZE):
+    """The payload file a decoded Request asks for: its seed's pattern, or payload (the shared one by default)."""
+    if request.flags & protocol.FLAG_RANDOM:
+        return seeded_payload(request.seed)
+    return payload if payload is not None else shared_payload(chunk_size)
+
+
+def send_stream(sock, file_size, payload=None, chunk_size=DEFAULT_CHUNK_SIZE, offset=0, pacer=None):
+    """
+    Send file_size bytes to a connected TCP socket by repeatedly sending the payload file.
+
+    socket.sendfile() uses os.sendfile() where available and loops over partial
+    sends itself, falling back to send() on platforms without it. offset is
+    where the bytes start in the logical file the payload repeats to fill.
+    With a pacer (a TokenBucket) each call sends at most one burst.
+
+    :return: (bytes sent, elapsed seconds)
+    """
+    if payload is None:
+        payload = shared_payload(chunk_size)
+    start = time.perf_counter()
+    sent = 0
+    while sent < file_size:
+        position = (offset + sent) % payload.size
+        count = min(payload.size - position, file_size - sent)
+        if pacer is not None:
+            count = min(count, pacer.burst)
+        done = sock.sendfile(payload.file, position, count)
+        if done == 0:
+            break
+        sent += done
+        if pacer is not None:
+            pacer.consume(done)
+    return sent, time.perf_counter() - start
+
+
+def range_requests(sock, data):
+    """
+    Yield the range requests of a connection, starting with those in data (what was read so far).
+
+    Ends when the client closes or sends anything but a range request.
+    """
+    size = protocol.REQUEST.size
+    while True:
+        while len(data) < size:
+            more = sock.recv(1024)
+            if not more:
+                return
+            data += more
+        request = protocol.decode_request(data[:size])
+        data = data[size:]
+        if request is None or not request.flags & protocol.FLAG_RANGE:
+            return
+        yield request
+
+
+def send_ranges(sock, data, payload=None, chunk_size=DEFAULT_CHUNK_SIZE, limit=None, pacer=None):
+    """
+    Answer range requests on a connection until the client closes it; data holds the bytes read so far.
+
+    Ranges are clipped to limit bytes of logical file when given; pacer works as in send_stream().
+
+    :return: (bytes sent, ranges answered, elapsed seconds)
+    """
+    start = time.perf_counter()
+    sent = ranges = 0
+    for request in range_requests(sock, data):
+        length = request.file_size if limit is None else max(0, min(request.file_size, limit - request.offset))
+        done, _ = send_stream(sock, length, payload, chunk_size, request.offset, pacer)
+        sent += done
+        ranges += 1
+        if done < request.file_size:
+            break  # closing tells the client the range was cut short
+    return sent, ranges, time.perf_counter() - start
+
+
+def echo(sock, data=b""):
+    """
+    Send back every byte the client sends until it closes; data holds what was read after the echo request.
+
+    Nagle is turned off so each echo leaves at once instead of waiting for the
+    previous one to be acknowledged.
+
+    :return: (bytes echoed, elapsed seconds)
+    """
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    start = time.perf_counter()
+    if data:
+        sock.sendall(data)
+    echoed = len(data)
+    buffer = bytearray(64 * 1024)
+    view = memoryview(buffer)
+    while True:
+        count = sock.recv_into(buffer)
+        if not count:
+            break
+        sock.sendall(view[:count])
+        echoed += count
+    return echoed, time.perf_counter() - start
+
+
+def stop_requested(sock):
+    """True if the peer sent a stop message or closed its side of the connection; never blocks."""
+    readable, _, _ = select.select([sock], [], [], 0)
+    if not readable:
+        return False
+    data = sock.recv(64)
+    return not data or protocol.is_stop(data)
+
+
+def send_for(sock, duration, payload=None, chunk_size=DEFAULT_CHUNK_SIZE, limit=0, pacer=None):
+    """
+    Send the payload file over and over for duration seconds, until the peer asks to stop or after limit bytes (0 for no limit).
+
+    Each sendfile() call is sized to about TIMED_CALL_SECONDS of data at the
+    rate so far, so the deadline and stop messages are noticed promptly on slow
+    links as well as fast ones. With a pacer (a TokenBucket) calls are also
+    capped at one burst.
+
+    :return: (bytes sent, elapsed seconds)
+    """
+    if payload is None:
+        payload = shared_payload(chunk_size)
+    start = time.perf_counter()
+    deadline = start + duration
+    sent = 0
+    count = min(MIN_TIMED_CHUNK, payload.size)
+    while not limit or sent < limit:
+        if time.perf_counter() >= deadline or stop_requested(sock):
+            break
+        # Carry on from where the last call stopped, so the stream is the logical file from its start
+        position = sent % payload.size
+        count = min(count, payload.size - position)
+        if limit:
+            count = min(count, limit - sent)
+        if pacer is not None:
+            count = min(count, pacer.burst)
+        done = sock.sendfile(payload.file, position, count)
+        if done == 0:
+            break
+        sent += done
+        if pacer is not None:
+            pacer.consume(done)
+        count = timed_chunk(sent, time.perf_counter() - start, payload.size)
+    elapsed = time.perf_counter() - start
+    linger(sock)
+    return sent, elapsed
+
+
+def linger(sock, timeout=LINGER_SECONDS):
+    """
+    Half-close and wait for the client to close too.
+
+    The client's stop message may still be on its way; closing with it unread
+    would reset the connection and throw away data the client has not read yet.
+    """
+    try:
+        sock.shutdown(socket.SHUT_WR)
+        sock.settimeout(timeout)
+        while sock.recv(1024):
+            pass
+    except OSError:
+        pass
+
+
+def timed_chunk(sent, elapsed, payload_size):
+    """Bytes for the next sendfile() call of a timed send: about TIMED_CALL_SECONDS at the rate so far."""
+    if elapsed <= 0:
+        return min(MIN_TIMED_CHUNK, payload_size)
+    return max(MIN_TIMED_CHUNK, min(payload_size, int(sent / elapsed * TIMED_CALL_SECONDS)))
+
+
+def format_rate(sent, elapsed):
+    """Format a bytes/elapsed pair as a human-readable bytes/second string."""
+    rate = sent / elapsed if elapsed > 0 else 0.0
+    return f"{sent} bytes in {elapsed:.2f}s ({rate:,.0f} bytes/second)"
@@ -0,0 +1,49 @@
+import pytest
+
+import admission
+
+
+def test_max_min():
+    assert admission.max_min(100, []) == []
+    assert admission.max_min(100, [10, 20]) == [10, 20]
+    assert admission.max_min(100, [0, 0]) == [50, 50]
+    assert admission.max_min(100, [10, 0, 0]) == [10, 45, 45]
+    assert admission.max_min(100, [80, 30, 10]) == [60, 30, 10]
+    assert sum(admission.max_min(100, [30, 40, 50])) == pytest.approx(100)
+
+
+def test_unlimited_capacity_paces_only_what_was_asked():
+    shares = admission.FairShare()
+    unpaced = shares.add("a", "tcp")
+    paced = shares.add("a", "udp", 8000)
+    assert unpaced.pacer is None and unpaced.rate_bps == 0
+    assert paced.rate_bps == 8000
+
+
+def test_clients_share_fairly_whatever_their_session_count():
+    shares = admission.FairShare(1000)
+    greedy = [shares.add("a", "tcp") for _ in range(3)]
+    modest = shares.add("b", "udp", 100)
+    assert modest.rate_bps == 100
+    assert [share.rate_bps for share in greedy] == [pytest.approx(300)] * 3
+    other = shares.add("c", "tcp")
+    assert other.rate_bps == pytest.approx(450)
+    assert sum(share.rate_bps for share in greedy) == pytest.approx(450)
+
+
+def test_remove_rebalances():
+    shares = admission.FairShare(1000)
+    first = shares.add("a", "tcp")
+    second = shares.add("b", "tcp")
+    assert first.rate_bps == second.rate_bps == 500
+    shares.remove(second)
+    assert first.rate_bps == 1000
+    assert shares.snapshot() == [first]
+
+
+def test_client_with_one_unlimited_session_is_unlimited():
+    shares = admission.FairShare(1000)
+    small = shares.add("a", "udp", 100)
+    large = shares.add("a", "tcp")
+    shares.add("b", "udp", 200)
+    assert (small.rate_bps, large.rate_bps) == (pytest.approx(100), pytest.approx(700))
@@ -0,0 +1,64 @@
+import integrity
+import payloadSource
+from integrity import VERIFY_BLOCK
+
+SEED = 7
+
+
+def stream(offset, length, seed=SEED):
+    source = payloadSource.seeded(2 ** 40, seed)
+    return b"".join(bytes(chunk) for chunk in source.chunks(offset, length))
+
+
+def feed(verifier, data, chunk_size=10007):
+    for start in range(0, len(data), chunk_size):
+        verifier(memoryview(data)[start:start + chunk_size])
+    verifier.finish()
+
+
+def test_clean_stream():
+    verifier = integrity.StreamVerifier(SEED)
+    feed(verifier, stream(0, 3 * VERIFY_BLOCK + 100))
+    assert (verifier.blocks, verifier.corrupted, verifier.misplaced) == (4, 0, 0)
+    assert verifier.checked_bytes == 3 * VERIFY_BLOCK + 100
+
+
+def test_stream_wraps_around_the_pattern():
+    offset = payloadSource.PATTERN_SIZE - VERIFY_BLOCK - 5
+    verifier = integrity.StreamVerifier(SEED, offset)
+    feed(verifier, stream(offset, 3 * VERIFY_BLOCK))
+    assert verifier.blocks == 4 and verifier.corrupted == verifier.misplaced == 0
+
+
+def test_corrupted_and_misplaced_blocks():
+    data = bytearray(stream(0, 3 * VERIFY_BLOCK))
+    data[VERIFY_BLOCK + 3] ^= 1
+    data[2 * VERIFY_BLOCK:] = stream(0, VERIFY_BLOCK)
+    verifier = integrity.StreamVerifier(SEED)
+    feed(verifier, bytes(data))
+    assert (verifier.blocks, verifier.corrupted, verifier.misplaced) == (3, 1, 1)
+
+
+def test_seek_between_ranges():
+    verifier = integrity.StreamVerifier(SEED)
+    for offset, length in ((5 * VERIFY_BLOCK + 9, 1000), (0, VERIFY_BLOCK + 1)):
+        verifier.seek(offset)
+        verifier(memoryview(stream(offset, length)))
+    verifier.finish()
+    assert (verifier.blocks, verifier.corrupted) == (3, 0)
+    verifier.seek(0)
+    verifier(memoryview(stream(0, 100, seed=SEED + 1)))
+    verifier.finish()
+    assert verifier.corrupted == 1
+
+
+def test_segments():
+    size = 1400
+    verifier = integrity.SegmentVerifier(SEED, size)
+    assert verifier.check(0, stream(0, size))
+    assert verifier.check(1000, stream(1000 * size, size))
+    assert verifier.check(3, stream(3 * size, 10))
+    assert not verifier.check(1, stream(2 * size, size))
+    assert not verifier.check(1, bytes(size))
+    assert (verifier.segments, verifier.corrupted, verifier.misplaced) == (5, 1, 1)
+    assert verifier.checked_bytes == 4 * size + 10
@@ -0,0 +1,56 @@
+from latencyHistogram import (BUCKET_COUNT, NS_PER_MS, SUB_BUCKETS, LatencyHistogram, bucket_index,
+                              bucket_upper)
+
+
+def test_small_values_are_exact():
+    for value in range(2 * SUB_BUCKETS):
+        assert bucket_upper(bucket_index(value)) == value
+
+
+def test_bucket_bounds():
+    values = [2 ** shift + delta for shift in range(6, 63) for delta in (-1, 0, 1)] + [2 ** 63 - 1]
+    for value in values:
+        index = bucket_index(value)
+        assert index < BUCKET_COUNT
+        assert value <= bucket_upper(index) <= value * (1 + 1 / SUB_BUCKETS)
+        assert bucket_upper(index - 1) < value
+
+
+def test_percentiles():
+    histogram = LatencyHistogram()
+    for value in range(1, 101):
+        histogram.record(value * NS_PER_MS)
+    assert histogram.count == 100
+    assert histogram.min == NS_PER_MS and histogram.max == 100 * NS_PER_MS
+    assert histogram.mean == 50.5 * NS_PER_MS
+    for percent in (1, 50, 90, 99):
+        value = percent * NS_PER_MS
+        assert value <= histogram.percentile(percent) <= value * (1 + 1 / SUB_BUCKETS)
+    assert histogram.percentile(100) == histogram.max
+    assert histogram.percentile(0) == bucket_upper(bucket_index(NS_PER_MS))
+
+
+def test_record_clamps_negative_values():
+    histogram = LatencyHistogram()
+    histogram.record(-5)
+    histogram.record(2.7)
+    assert (histogram.min, histogram.max, histogram.total) == (0, 2, 2)
+
+
+def test_merge():
+    left, right = LatencyHistogram(), LatencyHistogram()
+    left.record(10)
+    right.record(5)
+    right.record(1000)
+    left.merge(right)
+    left.merge(LatencyHistogram())
+    assert (left.count, left.min, left.max, left.total) == (3, 5, 1000, 1015)
+    assert left.percentile(50) == 10
+
+
+def test_summary():
+    histogram = LatencyHistogram()
+    assert histogram.summary() == "no samples"
+    assert histogram.percentile(50) == 0 and histogram.mean == 0.0
+    histogram.record(NS_PER_MS)
+    assert histogram.summary((50,)) == "1 samples, min 1.000, mean 1.000, p50 1.000, max 1.000 ms"
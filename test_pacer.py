@@ -0,0 +1,55 @@
+import pytest
+
+import pacer
+
+
+def test_rejects_zero_rate():
+    with pytest.raises(ValueError):
+        pacer.TokenBucket(0)
+    assert pacer.make_pacer(0) is None
+    assert isinstance(pacer.make_pacer(8000), pacer.TokenBucket)
+
+
+def test_burst_follows_rate():
+    assert pacer.TokenBucket(8000).burst == pacer.MIN_BURST
+    assert pacer.TokenBucket(8 * 10 ** 9).burst == int(10 ** 9 * pacer.BURST_WINDOW)
+    assert pacer.TokenBucket(8 * 10 ** 9, burst_bytes=100).burst == 100
+
+
+def test_burst_then_wait(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(pacer.time, "perf_counter", lambda: now[0])
+    bucket = pacer.TokenBucket(8000, burst_bytes=1000)  # 1000 bytes/second
+    assert bucket.reserve(1000) == 0.0
+    assert bucket.reserve(500) == pytest.approx(0.5)
+    now[0] += 0.5
+    assert bucket.reserve(0) == 0.0
+    now[0] += 60
+    assert bucket.tokens == 0
+    assert bucket.reserve(0) == 0.0
+    assert bucket.tokens == 1000  # idle time only refills up to the burst
+
+
+def test_set_rate_trims_tokens(monkeypatch):
+    monkeypatch.setattr(pacer.time, "perf_counter", lambda: 0.0)
+    bucket = pacer.TokenBucket(8 * 10 ** 9)
+    bucket.set_rate(8000)
+    assert bucket.tokens == bucket.burst == pacer.MIN_BURST
+    assert bucket.reserve(pacer.MIN_BURST + 1000) == pytest.approx(1.0)
+
+
+def test_consume_sleeps_off_the_overdraft(monkeypatch):
+    now = [0.0]
+    sleeps = []
+    monkeypatch.setattr(pacer.time, "perf_counter", lambda: now[0])
+    monkeypatch.setattr(pacer.time, "sleep", sleeps.append)
+    bucket = pacer.TokenBucket(8000, burst_bytes=1000)
+    bucket.consume(1000)
+    bucket.consume(250)
+    assert sleeps == [pytest.approx(0.25)]
+
+
+def test_rate_report():
+    assert pacer.rate_report(1000, 1.0, 0) == "achieved 8000.00 bits/second (unpaced)"
+    assert pacer.rate_report(1000, 1.0, 16000).endswith("(50.0%)")
+    assert pacer.rate_report(1000, 0, 0) == "achieved 0.00 bits/second (unpaced)"
@@ -0,0 +1,138 @@
+import struct
+
+import pytest
+
+import protocol
+
+
+def test_offer_round_trip():
+    assert protocol.decode_offer(protocol.encode_offer(3000, 4000)) == (3000, 4000, None)
+    assert protocol.decode_offer(protocol.encode_offer(3000, 4000, load=7)) == (3000, 4000, 7)
+    assert protocol.decode_offer(protocol.encode_offer(1, 2, load=1 << 20)).load == 0xFFFF
+
+
+def test_offer_rejects_bad_messages():
+    offer = protocol.encode_offer(3000, 4000)
+    assert protocol.decode_offer(offer[:-1]) is None
+    assert protocol.decode_offer(b"\x00" + offer[1:]) is None
+    assert protocol.decode_offer(protocol.encode_stop() + offer[protocol.PREFIX.size:]) is None
+
+
+def test_request_round_trip():
+    request = protocol.Request(1 << 40, 10 ** 9, 1400, 5000, protocol.FLAG_RELIABLE, 123, 42)
+    assert protocol.parse_request(protocol.encode_request(*request)) == request
+    buffer = bytearray(protocol.REQUEST.size + 3)
+    assert protocol.encode_request_into(buffer, 3, request) == protocol.REQUEST.size
+    assert protocol.decode_request(buffer[3:]) == request
+
+
+def test_short_requests_take_defaults():
+    full = protocol.encode_request(1000, 2000)
+    for layout in protocol.REQUEST_LAYOUTS:
+        request = protocol.decode_request(full[:layout.size])
+        assert request.file_size == 1000 and request.seed == 0
+    assert protocol.decode_request(full[:protocol.MIN_REQUEST_SIZE - 1]) is None
+
+
+def test_text_request():
+    assert protocol.parse_request(b"1024 8000 512\n") == protocol.Request(1024, 8000, 512)
+    assert protocol.parse_request(b"-1") is None
+    assert protocol.parse_request(b"abc") is None
+    assert protocol.parse_request(b"") is None
+
+
+def test_request_types_are_not_confused():
+    echo = protocol.encode_request(0, message_type=protocol.PING_TYPE)
+    assert protocol.decode_request(echo) is None
+    assert protocol.decode_request(echo, protocol.PING_TYPE) == protocol.Request()
+
+
+def test_range_and_echo_requests():
+    request = protocol.parse_request(protocol.encode_range_request(4096, 100, seed=9))
+    assert (request.offset, request.file_size, request.seed) == (4096, 100, 9)
+    assert request.flags == protocol.FLAG_RANGE | protocol.FLAG_RANDOM
+    assert protocol.parse_request(protocol.encode_range_request(0, 1)).flags == protocol.FLAG_RANGE
+    assert protocol.parse_request(protocol.encode_echo_request()).flags == protocol.FLAG_ECHO
+
+
+def test_file_request_round_trip():
+    message = protocol.encode_file_request("dir/файл.bin", offset=10, length=20, flags=protocol.FLAG_RANGE)
+    request = protocol.parse_request(message)
+    assert request.flags == protocol.FLAG_FILE | protocol.FLAG_RANGE
+    assert (request.offset, request.file_size) == (10, 20)
+    rest = message[protocol.REQUEST.size:]
+    assert protocol.decode_file_name(rest + b"next") == ("dir/файл.bin", b"next")
+    assert protocol.decode_file_name(rest[:-1]) is None
+    assert protocol.decode_file_name(rest[:1]) is None
+
+
+def test_file_name_limits():
+    with pytest.raises(ValueError):
+        protocol.encode_file_request("x" * (protocol.MAX_FILE_NAME + 1))
+    with pytest.raises(ValueError):
+        protocol.decode_file_name(protocol.FILE_NAME.pack(protocol.MAX_FILE_NAME + 1))
+    with pytest.raises(ValueError):
+        protocol.decode_file_name(protocol.FILE_NAME.pack(1) + b"\xff")
+
+
+def test_file_busy_done_round_trip():
+    assert protocol.decode_file(protocol.encode_file(protocol.FILE_OK, 1 << 33)) == (protocol.FILE_OK, 1 << 33)
+    assert protocol.decode_file(protocol.encode_file(protocol.FILE_NOT_FOUND)) == (protocol.FILE_NOT_FOUND, 0)
+    assert protocol.decode_busy(protocol.encode_busy(1500)) == 1500
+    assert protocol.decode_done(protocol.encode_done(99)) == 99
+    assert protocol.decode_file(protocol.encode_busy(1500)) is None
+    assert protocol.decode_busy(protocol.encode_done(99)) is None
+    assert protocol.decode_done(protocol.encode_done(99)[:-1]) is None
+
+
+def test_nack_round_trip():
+    ranges = [(1, 1), (5, 9), (2 ** 40, 2 ** 40 + 3)]
+    assert protocol.decode_nack(protocol.encode_nack(2 ** 41, ranges)) == (2 ** 41, ranges)
+    assert protocol.decode_nack(protocol.encode_nack(0, [])) == (0, [])
+    assert protocol.decode_nack(protocol.encode_nack(3, ranges)[:-1]) is None
+
+
+def test_nack_is_capped():
+    ranges = [(i, i) for i in range(protocol.MAX_NACK_RANGES + 10)]
+    message = protocol.encode_nack(1000, ranges)
+    assert len(message) <= 1024
+    assert protocol.decode_nack(message)[1] == ranges[:protocol.MAX_NACK_RANGES]
+
+
+def test_ping_pong_round_trip():
+    ping = protocol.encode_ping(12345, size=100)
+    assert len(ping) == 100
+    assert protocol.decode_ping(ping) == 12345
+    assert protocol.decode_pong(ping) is None
+    pong = protocol.encode_pong(ping)
+    assert len(pong) == 100
+    assert protocol.decode_pong(pong) == 12345
+    assert protocol.decode_ping(pong) is None
+    assert len(protocol.encode_ping(1, size=1)) == protocol.PING.size
+
+
+def test_stop_and_peek_type():
+    assert protocol.is_stop(protocol.encode_stop())
+    assert not protocol.is_stop(protocol.encode_done(1))
+    assert protocol.peek_type(protocol.encode_busy(1)) == protocol.BUSY_TYPE
+    assert protocol.peek_type(b"\x00" * protocol.PREFIX.size) is None
+    assert protocol.peek_type(b"") is None
+
+
+def test_payload_header_round_trip():
+    datagram = bytearray(protocol.PAYLOAD_HEADER_SIZE + 4)
+    protocol.pack_payload_header_into(datagram, 0, 1000, 7, 555)
+    datagram[protocol.PAYLOAD_HEADER_SIZE:] = b"data"
+    assert protocol.decode_payload_header(datagram) == (1000, 7, 555)
+    total, segment, data = protocol.decode_payload(datagram)
+    assert (total, segment, bytes(data)) == (1000, 7, b"data")
+    assert isinstance(data, memoryview)
+
+
+def test_payload_rejects_bad_messages():
+    assert protocol.decode_payload_header(b"short") is None
+    assert protocol.decode_payload(b"short") is None
+    wrong = bytearray(protocol.PAYLOAD_HEADER_SIZE)
+    struct.pack_into(">IB", wrong, 0, protocol.MAGIC_COOKIE, protocol.DONE_TYPE)
+    assert protocol.decode_payload_header(wrong) is None
+    assert protocol.decode_payload(wrong) is None
@@ -0,0 +1,82 @@
+import pytest
+
+from segmentTracker import SegmentTracker
+
+
+def test_rejects_empty_transfer():
+    with pytest.raises(ValueError):
+        SegmentTracker(0)
+
+
+def test_in_order_transfer_is_complete():
+    tracker = SegmentTracker(10)
+    assert all(tracker.add(segment) for segment in range(10))
+    assert tracker.complete and tracker.lost == 0
+    assert tracker.highest == 9
+    assert list(tracker.missing_ranges()) == []
+    assert tracker.loss_runs() == (0, 0)
+
+
+def test_duplicates_out_of_order_and_invalid():
+    tracker = SegmentTracker(9)
+    assert tracker.add(8)
+    assert tracker.add(0)
+    assert not tracker.add(8)
+    assert not tracker.add(9)
+    assert not tracker.add(-1)
+    assert (tracker.received, tracker.duplicates, tracker.out_of_order, tracker.invalid) == (2, 1, 1, 2)
+    assert tracker.highest == 8
+    assert 8 in tracker and 0 in tracker
+    assert 1 not in tracker and 9 not in tracker and -1 not in tracker
+
+
+def test_missing_ranges_across_byte_boundaries():
+    tracker = SegmentTracker(20)
+    for segment in (0, 1, 7, 8, 16, 19):
+        tracker.add(segment)
+    assert list(tracker.missing_ranges()) == [(2, 6), (9, 15), (17, 18)]
+    assert list(tracker.missing_ranges(4, 10)) == [(4, 6), (9, 10)]
+    assert list(tracker.missing_ranges(17, 100)) == [(17, 18)]
+    assert tracker.loss_runs() == (3, 7)
+    assert tracker.lost == 14
+
+
+def test_nothing_received_is_one_run():
+    tracker = SegmentTracker(13)
+    assert list(tracker.missing_ranges()) == [(0, 12)]
+    assert tracker.stats()["longest_loss_run"] == 13
+
+
+def test_last_segment_of_a_partial_byte():
+    tracker = SegmentTracker(9)
+    for segment in range(8):
+        tracker.add(segment)
+    assert list(tracker.missing_ranges()) == [(8, 8)]
+    tracker.add(8)
+    assert tracker.complete
+
+
+def test_resize_grows_and_shrinks():
+    tracker = SegmentTracker(8)
+    tracker.add(3)
+    tracker.resize(20)
+    assert tracker.lost == 19
+    assert tracker.add(19)
+    tracker.resize(20)
+    with pytest.raises(ValueError):
+        tracker.resize(19)
+    tracker = SegmentTracker(100)
+    tracker.add(2)
+    tracker.resize(3)
+    assert len(tracker.bitmap) == 1
+    assert list(tracker.missing_ranges()) == [(0, 1)]
+    with pytest.raises(ValueError):
+        tracker.resize(0)
+
+
+def test_summary():
+    tracker = SegmentTracker(4)
+    tracker.add(1)
+    tracker.add(1)
+    assert tracker.summary() == ("received 1/4, lost 3, duplicates 1, out of order 0, "
+                                 "loss runs 2 (longest 2)")
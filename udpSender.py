@@ -0,0 +1,407 @@
+import collections
+import socket
+import struct
+import sys
+import time
+
+import eventLog
+import protocol
+from protocol import MAGIC_COOKIE, PAYLOAD_TYPE
+
+HEADER = protocol.PAYLOAD
+SEQUENCE = struct.Struct(">QQ")  # segment number and send time, the last two header fields
+SEQUENCE_OFFSET = HEADER.size - SEQUENCE.size
+GSO_SIZE = struct.Struct("=H")
+
+SOL_UDP = getattr(socket, "SOL_UDP", 17)
+UDP_SEGMENT = getattr(socket, "UDP_SEGMENT", 103)  # Linux >= 4.18
+MAX_GSO_BYTES = 65000
+DEFAULT_BATCH_SIZE = 64
+DONE_REPEAT = 3  # the done message is not retransmitted, so send a few copies
+UNLIMITED = 2 ** 63 - 1  # the size of a duration stream with no byte cap
+
+DEFAULT_WINDOW = 64  # reliable mode: unacknowledged segments allowed before the first nack
+MIN_WINDOW = 16
+MAX_WINDOW = 64 * 1024
+FEEDBACK_TIMEOUT = 3  # seconds without a nack before a reliable client is given up on
+RETRANSMIT_HOLDOFF = 0.1  # seconds before a retransmitted segment may be sent again, unless newer data overtook it
+WINDOW_POLL = 0.001
+
+DEFAULT_SEGMENT_SIZE = 1024
+MIN_SEGMENT_SIZE = 64
+MAX_DATAGRAM_SIZE = 65507  # largest IPv4 UDP payload
+MAX_SEGMENT_SIZE = MAX_DATAGRAM_SIZE - HEADER.size
+IP_UDP_OVERHEAD = 20 + 8
+
+IP_MTU_DISCOVER = getattr(socket, "IP_MTU_DISCOVER", 10)
+IP_PMTUDISC_DO = getattr(socket, "IP_PMTUDISC_DO", 2)
+IP_MTU = getattr(socket, "IP_MTU", 14)
+
+log = eventLog.get_logger("udpSender")
+_batches = eventLog.Sampler(log)
+
+
+class DatagramBatch:
+    """
+    A reusable buffer of batch_size datagrams with their headers precompiled.
+
+    Only the sequence number and send time (and the payload, if it is not a
+    single repeated byte) are rewritten per datagram, and a full batch is
+    either handed to the kernel in one sendmsg() with UDP_SEGMENT or sent slot
+    by slot.
+    """
+
+    def __init__(self, payload, total_segments, segment_size, batch_size=DEFAULT_BATCH_SIZE, use_gso=True):
+        self.payload = payload
+        self.total_segments = total_segments
+        self.segment_size = segment_size
+        self.datagram_size = HEADER.size + segment_size
+        self.use_gso = use_gso and sys.platform.startswith("linux")
+        if self.use_gso:
+            batch_size = max(1, min(batch_size, MAX_GSO_BYTES // self.datagram_size))
+        self.batch_size = batch_size
+        self.buffer = bytearray(self.datagram_size * batch_size)
+        self.view = memoryview(self.buffer)
+        self.gso_control = [(SOL_UDP, UDP_SEGMENT, GSO_SIZE.pack(self.datagram_size))]
+        self.static_payload = getattr(payload, "uniform", False)
+        for slot in range(batch_size):
+            offset = slot * self.datagram_size
+            protocol.pack_payload_header_into(self.buffer, offset, total_segments, 0)
+            if self.static_payload:
+                chunk = payload.view(0, segment_size)
+                self.buffer[offset + HEADER.size:offset + HEADER.size + len(chunk)] = chunk
+
+    def fill(self, first_segment, count):
+        """Write sequence numbers and the send time (and payload bytes) for count segments; returns bytes used."""
+        size = self.datagram_size
+        pack_into = SEQUENCE.pack_into
+        buffer = self.buffer
+        offset = SEQUENCE_OFFSET
+        timestamp = protocol.timestamp
+        # A send time per datagram, so the receiver's jitter does not depend on the batch size
+        for segment in range(first_segment, first_segment + count):
+            pack_into(buffer, offset, segment, timestamp())
+            offset += size
+        if not self.static_payload:
+            offset = HEADER.size
+            for segment in range(first_segment, first_segment + count):
+                chunk = self.payload.view(segment * self.segment_size, self.segment_size)
+                buffer[offset:offset + len(chunk)] = chunk
+                offset += size
+        return count * size
+
+    def send(self, sock, address, nbytes):
+        """Send the first nbytes of the batch; returns the number of datagrams sent."""
+        size = self.datagram_size
+        if self.use_gso:
+            try:
+                sock.sendmsg([self.view[:nbytes]], self.gso_control, 0, address)
+                return nbytes // size
+            except OSError:
+                self.use_gso = False
+        for offset in range(0, nbytes, size):
+            sock.sendto(self.view[offset:offset + size], address)
+        return nbytes // size
+
+
+def segment_count(file_size, segment_size):
+    return (file_size + segment_size - 1) // segment_size
+
+
+def clamp_segment_size(requested):
+    """Clamp a requested segment size to what one datagram can carry; 0 means the default."""
+    if not requested:
+        return DEFAULT_SEGMENT_SIZE
+    return max(MIN_SEGMENT_SIZE, min(requested, MAX_SEGMENT_SIZE))
+
+
+def discover_path_mtu(host, port, probe_timeout=0.2):
+    """
+    Return the path MTU towards (host, port) as the kernel sees it, or None where unsupported.
+
+    A full-size probe is sent with DF set so a router on the path can answer
+    with "fragmentation needed" and lower the cached value before it is read.
+    """
+    if not sys.platform.startswith("linux"):
+        return None
+    try:
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+            sock.setsockopt(socket.IPPROTO_IP, IP_MTU_DISCOVER, IP_PMTUDISC_DO)
+            sock.connect((host, port))
+            mtu = sock.getsockopt(socket.IPPROTO_IP, IP_MTU)
+            try:
+                sock.send(bytes(min(mtu, MAX_DATAGRAM_SIZE + IP_UDP_OVERHEAD) - IP_UDP_OVERHEAD))
+            except OSError:
+                pass
+            time.sleep(probe_timeout)
+            return sock.getsockopt(socket.IPPROTO_IP, IP_MTU)
+    except OSError:
+        return None
+
+
+def segment_size_for_mtu(mtu):
+    """Largest segment whose datagram fits in one IP packet of this MTU."""
+    return clamp_segment_size(mtu - IP_UDP_OVERHEAD - HEADER.size)
+
+
+def send_segments(sock, address, payload, segment_size=1024, batch_size=DEFAULT_BATCH_SIZE, use_gso=True,
+                  file_size=None, pacer=None, deadline=None, should_stop=None):
+    """
+    Send the first file_size bytes of payload (all of it by default) to address as numbered datagrams.
+
+    :param pacer: Optional TokenBucket; batches are then limited to its burst size.
+    :param deadline: Optional time.perf_counter() value to stop at. The stream is then open-ended and
+                     its headers carry 0 total segments.
+    :param should_stop: Optional callable checked between batches; sending ends once it returns True.
+    :return: (datagrams sent, elapsed seconds)
+    """
+    file_size = len(payload) if file_size is None else min(file_size, len(payload))
+    total_segments = segment_count(file_size, segment_size)
+    start = time.perf_counter()
+    if total_segments == 0:
+        return 0, 0.0
+    if pacer is not None:
+        batch_size = max(1, min(batch_size, pacer.burst // (HEADER.size + segment_size)))
+    batch = DatagramBatch(payload, 0 if deadline is not None else total_segments, segment_size, batch_size, use_gso)
+    full_segments = file_size // segment_size
+    trace = _batches if _batches.enabled else None
+    sent = 0
+    segment = 0
+    while segment < full_segments:
+        if deadline is not None and time.perf_counter() >= deadline:
+            return sent, time.perf_counter() - start
+        if should_stop is not None and should_stop():
+            return sent, time.perf_counter() - start
+        count = min(batch.batch_size, full_segments - segment)
+        if pacer is not None:
+            pacer.consume(count * batch.datagram_size)
+        # Fill after pacing so the send times in the headers are not stale
+        nbytes = batch.fill(segment, count)
+        sent += batch.send(sock, address, nbytes)
+        segment += count
+        if trace is not None:
+            trace.event("Sent segments up to %d of %d to %s (gso %s)", segment, total_segments, address, batch.use_gso)
+    if segment < total_segments:
+        # The short tail segment goes out on its own so GSO sizes stay uniform.
+        tail = payload.view(segment * segment_size, file_size - segment * segment_size)
+        header = bytearray(HEADER.size)
+        if pacer is not None:
+            pacer.consume(len(header) + len(tail))
+        protocol.pack_payload_header_into(header, 0, batch.total_segments, segment, protocol.timestamp())
+        sock.sendto(header + tail, address)
+        sent += 1
+    return sent, time.perf_counter() - start
+
+
+def send_reliable(sock, address, payload, segment_size, file_size, feedback, pacer=None,
+                  batch_size=DEFAULT_BATCH_SIZE, use_gso=True, window=DEFAULT_WINDOW):
+    """
+    Send file_size bytes of payload with NACK-based selective retransmission.
+
+    Data goes out while fewer than window segments, new or resent, are unacknowledged.
+    Each nack acknowledges up to its highest segment and replaces the queue of
+    ranges to resend, which go out ahead of new data. A segment already resent
+    is skipped until a nack shows it overtaken by newer data, or
+    RETRANSMIT_HOLDOFF passes. The window works like TCP Reno's: it grows by
+    the newly acknowledged segments until the first loss, then by one segment
+    per window, and halves when a nack reports a loss sent after the previous
+    halving. Sending ends when the client sends stop,
+    which is answered with a done message carrying the datagrams sent, or after
+    FEEDBACK_TIMEOUT seconds without a nack.
+
+    :param feedback: Callable returning the stop and nack messages from the client since the last call,
+                     without blocking.
+    :return: dict with segments, sent (datagrams), retransmitted, backoffs, window, complete and elapsed
+    """
+    total_segments = segment_count(file_size, segment_size)
+    start = time.perf_counter()
+    stats = {"segments": total_segments, "sent": 0, "retransmitted": 0, "backoffs": 0, "complete": False}
+    if total_segments == 0:
+        stats.update(window=window, elapsed=0.0)
+        return stats
+    if pacer is not None:
+        batch_size = max(1, min(batch_size, pacer.burst // (HEADER.size + segment_size)))
+    batch = DatagramBatch(payload, total_segments, segment_size, batch_size, use_gso)
+    tail = file_size - (total_segments - 1) * segment_size
+
+    def send_range(first, count):
+        if pacer is not None:
+            pacer.consume(count * batch.datagram_size)
+        nbytes = batch.fill(first, count)
+        if first + count == total_segments and tail < segment_size:
+            # The short last segment goes out on its own so GSO sizes stay uniform
+            nbytes -= batch.datagram_size
+            if nbytes:
+                batch.send(sock, address, nbytes)
+            sock.sendto(batch.view[nbytes:nbytes + HEADER.size + tail], address)
+        else:
+            batch.send(sock, address, nbytes)
+        stats["sent"] += count
+
+    next_segment = 0
+    highest = -1
+    recovery = -1
+    threshold = MAX_WINDOW
+    resend = collections.deque()
+    resent = collections.deque()  # (first, last, next new segment at the time, time) of each retransmission
+    last_feedback = start
+    while True:
+        for message in feedback():
+            if protocol.is_stop(message):
+                stats["complete"] = True
+                break
+            nack = protocol.decode_nack(message)
+            if nack is None:
+                continue
+            last_feedback = time.perf_counter()
+            acknowledged, ranges = nack
+            advanced = max(0, acknowledged - highest)
+            highest = max(highest, acknowledged)
+            # Forget retransmissions that arrived, were overtaken by newer data, or are overdue
+            listed = len(ranges) < protocol.MAX_NACK_RANGES
+            resent = collections.deque(
+                entry for entry in resent
+                if entry[2] > highest and last_feedback - entry[3] <= RETRANSMIT_HOLDOFF
+                and not (listed and entry[1] <= acknowledged and not _overlaps(entry, ranges)))
+            resend.clear()
+            for first, last in ranges:
+                last = min(last, next_segment - 1)
+                if first <= last:
+                    resend.extend(_subtract_ranges(first, last, resent))
+            if any(first > recovery and first <= next_segment - 1 for first, _ in ranges):
+                window = threshold = max(MIN_WINDOW, window / 2)
+                stats["backoffs"] += 1
+                recovery = next_segment - 1
+            elif window < threshold:
+                window = min(MAX_WINDOW, window + advanced)
+            else:
+                window = min(MAX_WINDOW, window + advanced / window)
+        if stats["complete"]:
+            done = protocol.encode_done(stats["sent"])
+            for _ in range(DONE_REPEAT):
+                sock.sendto(done, address)
+            break
+        in_flight = next_segment - 1 - highest + sum(last - first + 1 for first, last, _, _ in resent)
+        if in_flight >= int(window):
+            if time.perf_counter() - last_feedback > FEEDBACK_TIMEOUT:
+                break
+            time.sleep(WINDOW_POLL)
+        elif resend:
+            first, last = resend[0]
+            count = min(batch.batch_size, last - first + 1, int(window) - in_flight)
+            send_range(first, count)
+            resent.append((first, first + count - 1, next_segment, time.perf_counter()))
+            stats["retransmitted"] += count
+            if first + count > last:
+                resend.popleft()
+            else:
+                resend[0][0] = first + count
+        elif next_segment < total_segments:
+            count = min(batch.batch_size, total_segments - next_segment, int(window) - in_flight)
+            send_range(next_segment, count)
+            next_segment += count
+        elif time.perf_counter() - last_feedback > FEEDBACK_TIMEOUT:
+            break
+        else:
+            time.sleep(WINDOW_POLL)
+    stats.update(window=int(window), elapsed=time.perf_counter() - start)
+    return stats
+
+
+def _overlaps(entry, ranges):
+    return any(first <= entry[1] and entry[0] <= last for first, last in ranges)
+
+
+def _subtract_ranges(first, last, taken):
+    """Return the [first, last] pieces of an inclusive range not covered by any (first, last, ...) in taken."""
+    pieces = [[first, last]]
+    for taken_first, taken_last, *_ in taken:
+        remaining = []
+        for piece_first, piece_last in pieces:
+            if taken_last < piece_first or taken_first > piece_last:
+                remaining.append([piece_first, piece_last])
+                continue
+            if piece_first < taken_first:
+                remaining.append([piece_first, taken_first - 1])
+            if taken_last < piece_last:
+                remaining.append([taken_last + 1, piece_last])
+        pieces = remaining
+        if not pieces:
+            break
+    return pieces
+
+
+def send_response(sock, address, payload, request, pacer=None, feedback=None):
+    """
+    Answer a decoded Request: echo it back with the agreed segment size, then send the payload.
+
+    feedback, if given, returns the stop and nack messages the client sent
+    since the last call without blocking. A stop ends any stream early; a
+    request with a duration streams until the deadline and ends with a done
+    message carrying the number of segments sent. A reliable request (which
+    needs feedback) is sent with send_reliable().
+
+    :return: (the agreed segment size, datagrams sent, payload bytes sent, elapsed seconds)
+    """
+    segment_size = clamp_segment_size(request.segment_size)
+    sock.sendto(protocol.encode_request(*request._replace(segment_size=segment_size)), address)
+    if request.flags & protocol.FLAG_RELIABLE and feedback is not None:
+        size = min(request.file_size, len(payload))
+        stats = send_reliable(sock, address, payload, segment_size, size, feedback, pacer)
+        log.info("Reliable UDP to %s %s: %d segments in %d datagrams (%.1f%% retransmitted), %d backoffs, window %d",
+                 address, "complete" if stats["complete"] else "abandoned", stats["segments"], stats["sent"],
+                 stats["retransmitted"] / max(stats["segments"], 1) * 100, stats["backoffs"], stats["window"])
+        return segment_size, stats["sent"], size if stats["complete"] else 0, stats["elapsed"]
+    should_stop = None
+    if feedback is not None:
+        def should_stop():
+            return any(protocol.is_stop(message) for message in feedback())
+    if request.duration_ms:
+        # The deadline or a stop ends it, not the end of the server's payload, which just repeats
+        size = request.file_size or UNLIMITED
+        payload = payload.resized(UNLIMITED)
+        deadline = time.perf_counter() + request.duration_ms / 1000
+    else:
+        size = min(request.file_size, len(payload))
+        deadline = None
+    sent, elapsed = send_segments(sock, address, payload, segment_size, file_size=size, pacer=pacer,
+                                  deadline=deadline, should_stop=should_stop)
+    if deadline is not None:
+        done = protocol.encode_done(sent)
+        for _ in range(DONE_REPEAT):
+            sock.sendto(done, address)
+    return segment_size, sent, min(size, sent * segment_size), elapsed
+
+
+def send_segments_legacy(sock, address, payload, segment_size=1024):
+    """The original per-segment path: pack a header and concatenate a fresh payload each time."""
+    total_segments = segment_count(len(payload), segment_size)
+    start = time.perf_counter()
+    for i in range(total_segments):
+        chunk = b'A' * min(segment_size, len(payload) - (i * segment_size))
+        packet = struct.pack('>IBQQQ', MAGIC_COOKIE, PAYLOAD_TYPE, total_segments, i, time.time_ns()) + chunk
+        sock.sendto(packet, address)
+    return total_segments, time.perf_counter() - start
+
+
+def benchmark(file_size=256 * 1024 * 1024, segment_size=1024):
+    """Compare datagrams/second of the legacy, batched and GSO paths over loopback."""
+    from payloadSource import PayloadSource
+
+    payload = PayloadSource(file_size, fill=b'A')
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sink, \
+            socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sink.bind(("127.0.0.1", 0))
+        address = sink.getsockname()
+        runs = [
+            ("legacy", lambda: send_segments_legacy(sock, address, payload, segment_size)),
+            ("batched", lambda: send_segments(sock, address, payload, segment_size, use_gso=False)),
+            ("batched+gso", lambda: send_segments(sock, address, payload, segment_size, use_gso=True)),
+        ]
+        for name, run in runs:
+            sent, elapsed = run()
+            print(f"{name:12} {sent} datagrams in {elapsed:.2f}s: {sent / elapsed:,.0f} datagrams/second")
+
+
+if __name__ == "__main__":
+    benchmark()
@@ -0,0 +1,170 @@
+import collections
+import contextlib
+import multiprocessing
+import os
+import queue
+import socket
+import threading
+import time
+
+import eventLog
+
+REPORT_INTERVAL = 5
+RESTART_DELAY = 1
+GAUGES = ("active_sessions", "queued_sessions")  # current levels, not totals; a dead worker's are gone with it
+
+log = eventLog.get_logger("workerPool")
+
+
+class ServerStats:
+    """Thread-safe cumulative counters for the current process."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = collections.Counter()
+
+    def add(self, name, amount=1):
+        with self.lock:
+            self.counters[name] += amount
+
+    def snapshot(self):
+        with self.lock:
+            return dict(self.counters)
+
+
+STATS = ServerStats()
+
+
+def record(name, amount=1):
+    """Add to one of this process's server counters."""
+    STATS.add(name, amount)
+
+
+@contextlib.contextmanager
+def active_session():
+    """Count a session in the "active_sessions" gauge, the load servers advertise in their offers, while it runs."""
+    STATS.add("active_sessions")
+    try:
+        yield
+    finally:
+        STATS.add("active_sessions", -1)
+
+
+def current_load():
+    """Sessions this process is running right now."""
+    return STATS.snapshot().get("active_sessions", 0)
+
+
+def reuse_port(sock):
+    """Enable SO_REUSEPORT so every worker can bind the same address."""
+    if not hasattr(socket, "SO_REUSEPORT"):
+        raise OSError("SO_REUSEPORT is not supported on this platform")
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+
+
+def format_stats(stats):
+    return ", ".join(f"{name}={value}" for name, value in sorted(stats.items())) or "no traffic yet"
+
+
+def _report_stats(worker_id, stats_queue, interval):
+    pid = os.getpid()
+    while True:
+        time.sleep(interval)
+        stats_queue.put((worker_id, pid, STATS.snapshot()))
+
+
+def _worker_main(worker_id, target, args, stats_queue, interval):
+    threading.Thread(target=_report_stats, args=(worker_id, stats_queue, interval), daemon=True).start()
+    try:
+        target(*args)
+    except KeyboardInterrupt:
+        pass
+
+
+class WorkerPool:
+    """
+    Runs target(*args) in N worker processes and keeps them alive.
+
+    Workers are expected to bind their listening sockets with SO_REUSEPORT so
+    the kernel spreads connections across them. Each worker periodically sends
+    its STATS snapshot to the supervisor, which merges them; counters of dead
+    workers (but not their GAUGES) are retired into the totals before the
+    worker is restarted.
+    """
+
+    def __init__(self, target, args=(), workers=None, report_interval=REPORT_INTERVAL):
+        self.target = target
+        self.args = args
+        self.workers = workers or os.cpu_count() or 1
+        self.report_interval = report_interval
+        self.stats_queue = multiprocessing.Queue()
+        self.processes = {}
+        self.started = {}
+        self.latest = {}
+        self.retired = collections.Counter()
+
+    def spawn(self, worker_id):
+        process = multiprocessing.Process(
+            target=_worker_main, name=f"worker-{worker_id}", daemon=True,
+            args=(worker_id, self.target, self.args, self.stats_queue, self.report_interval))
+        process.start()
+        self.processes[worker_id] = process
+        self.started[worker_id] = time.monotonic()
+
+    def restart_dead(self):
+        for worker_id, process in list(self.processes.items()):
+            if process.is_alive():
+                continue
+            if time.monotonic() - self.started[worker_id] < RESTART_DELAY:
+                continue
+            log.warning("Worker %d (pid %d) exited with code %s, restarting", worker_id, process.pid, process.exitcode)
+            pid, snapshot = self.latest.pop(worker_id, (None, {}))
+            if pid == process.pid:
+                self.retired.update({name: value for name, value in snapshot.items() if name not in GAUGES})
+            self.spawn(worker_id)
+
+    def collect(self, timeout):
+        try:
+            worker_id, pid, snapshot = self.stats_queue.get(timeout=timeout)
+        except queue.Empty:
+            return
+        process = self.processes.get(worker_id)
+        if process is not None and process.pid == pid:
+            self.latest[worker_id] = (pid, snapshot)
+
+    def merged_stats(self):
+        """Totals across live and retired workers."""
+        merged = collections.Counter(self.retired)
+        for _, snapshot in self.latest.values():
+            merged.update(snapshot)
+        return dict(merged)
+
+    def run(self):
+        """Start the workers and supervise them until interrupted."""
+        for worker_id in range(self.workers):
+            self.spawn(worker_id)
+        log.info("Started %d worker processes", self.workers)
+        next_report = time.monotonic() + self.report_interval
+        try:
+            while True:
+                self.collect(timeout=0.5)
+                self.restart_dead()
+                if time.monotonic() >= next_report:
+                    log.info("Workers %d/%d reporting: %s", len(self.latest), self.workers, format_stats(self.merged_stats()))
+                    next_report += self.report_interval
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stop()
+        return self.merged_stats()
+
+    def stop(self):
+        for process in self.processes.values():
+            process.terminate()
+        for process in self.processes.values():
+            process.join(timeout=2)
+
+
+def run_pool(target, args=(), workers=None, report_interval=REPORT_INTERVAL):
+    """Run target(*args) in a supervised pool of worker processes; returns the merged stats."""
+    return WorkerPool(target, args, workers, report_interval).run()